@@ -30,11 +30,11 @@ from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple
 from . import bitcoin
 from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
 from .axe_ps import PSManager, PS_MIXING_TX_TYPES
-from .axe_tx import PSCoinRounds, tx_header_to_tx_type
+from .axe_tx import PSCoinRounds
 from .util import profiler, bfh, TxMinedInfo
 from .protx import ProTxManager
 from .transaction import Transaction, TxOutput
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 from .blockchain import hash_header
 from .i18n import _
@@ -82,8 +82,6 @@ class AddressSynchronizer(Logger):
         self.psman = PSManager(self)
         self.protx_manager = ProTxManager(self)
 
-        self._get_addr_balance_cache = {}
-
         self.load_and_cleanup()
 
     def with_transaction_lock(func):
@@ -94,6 +92,8 @@ class AddressSynchronizer(Logger):
 
     def load_and_cleanup(self):
         self.load_local_history()
+        self.load_utxos()
+        self.reset_balance_ledger()
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
@@ -164,7 +164,9 @@ class AddressSynchronizer(Logger):
             axe_net.register_callback(self.on_axe_islock, ['axe-islock'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        with self.transaction_lock:
+            # coinbase outputs maturity changes
+            self._balance_dirty |= self._balance_immature_addrs
         self.db.process_and_clear_islocks(self.get_local_height())
 
     def on_axe_islock(self, event, txid):
@@ -175,7 +177,7 @@ class AddressSynchronizer(Logger):
             axe_net = self.network.axe_net
             if axe_net.verify_on_recent_islocks(txid):
                 self.db.add_islock(txid)
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self._mark_tx_balance_changed(txid)
                 self.storage.write()
                 self.network.trigger_callback('verified-islock', self, txid)
 
@@ -186,7 +188,7 @@ class AddressSynchronizer(Logger):
             axe_net = self.network.axe_net
             if axe_net.verify_on_recent_islocks(txid):
                 self.db.add_islock(txid)
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self._mark_tx_balance_changed(txid)
                 self.storage.write()
                 self.network.trigger_callback('verified-islock', self, txid)
 
@@ -232,7 +234,7 @@ class AddressSynchronizer(Logger):
                     continue
                 # this outpoint has already been spent, by spending_tx
                 # annoying assert that has revealed several bugs over time:
-                assert self.db.get_transaction(spending_tx_hash), "spending tx not in wallet db"
+                assert self.db.has_transaction(spending_tx_hash), "spending tx not in wallet db"
                 conflicting_txns |= {spending_tx_hash}
             if tx_hash in conflicting_txns:
                 # this tx is already in history, so it conflicts with itself
@@ -301,7 +303,8 @@ class AddressSynchronizer(Logger):
                         if n == prevout_n:
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                                self._utxo_spend(addr, ser)
+                                self._mark_addr_balance_changed(addr)
                             return
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
@@ -318,11 +321,13 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._utxo_add(addr, ser, v, is_coinbase)
+                    self._mark_addr_balance_changed(addr)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
+                        self._utxo_spend(addr, ser)
                         self._add_tx_to_local_history(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
@@ -360,8 +365,8 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi(tx_hash), self.db.get_txo(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            self._remove_tx_from_utxos(tx_hash)
+            self._mark_tx_balance_changed(tx_hash)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
 
@@ -380,7 +385,17 @@ class AddressSynchronizer(Logger):
         self.add_transaction(tx_hash, tx, allow_unrelated=True)
         self.find_islock_pair(tx_hash)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def get_addr_status(self, addr):
+        '''Return status hash of stored address history'''
+        status = self.db.get_addr_status(addr)
+        if status is None:
+            hist = self.db.get_addr_history(addr)
+            if hist:  # status is not yet stored for this history
+                status = history_status(hist)
+                self.db.set_addr_status(addr, status)
+        return status
+
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
         old_hist_hashes = set()
         with self.lock:
             old_hist = self.get_address_history(addr)
@@ -391,9 +406,13 @@ class AddressSynchronizer(Logger):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._mark_tx_balance_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
+            if status is None:
+                status = history_status(hist)
+            self.db.set_addr_status(addr, status)
 
         local_tx_hist_hashes = list()
         for tx_hash, tx_height in hist:
@@ -401,6 +420,9 @@ class AddressSynchronizer(Logger):
                 local_tx_hist_hashes.append(tx_hash)
             # add it in case it was previously unconfirmed
             self.add_unverified_tx(tx_hash, tx_height)
+            # txi and txo for addr are already added with tx in addr history
+            if tx_hash in old_hist_hashes:
+                continue
             # if addr is new, we have to recompute txi and txo
             tx = self.db.get_transaction(tx_hash)
             if tx is None:
@@ -445,13 +467,15 @@ class AddressSynchronizer(Logger):
     def remove_local_transactions_we_dont_have(self):
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             tx_height = self.get_tx_height(txid).height
-            if tx_height == TX_HEIGHT_LOCAL and not self.db.get_transaction(txid):
+            if tx_height == TX_HEIGHT_LOCAL and not self.db.has_transaction(txid):
                 self.remove_transaction(txid)
 
     def clear_history(self):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self.load_utxos()
+                self.reset_balance_ledger()
 
     def get_txpos(self, tx_hash, islock):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -537,9 +561,9 @@ class AddressSynchronizer(Logger):
                 islock, islock_sort) in enumerate(history):
             tx_type = 0
             if show_dip2:
-                tx = self.db.get_transaction(tx_hash)
-                if tx:
-                    tx_type = tx_header_to_tx_type(bfh(tx.raw[:8]))
+                tx_summary = self.db.get_tx_summary(tx_hash)
+                if tx_summary:
+                    tx_type = tx_summary.tx_type
             if (group_ps or show_dip2) and not tx_type:  # prefer ProTx type
                 tx_type, completed = self.db.get_ps_tx(tx_hash)
 
@@ -615,6 +639,42 @@ class AddressSynchronizer(Logger):
                 else:
                     self._history_local[addr] = cur_hist
 
+    @profiler
+    def load_utxos(self):
+        with self.transaction_lock:
+            self._utxos = defaultdict(dict)  # address -> {txo: (value, is_cb)}
+            self._spent_txos = defaultdict(set)  # address -> set(txo)
+            for txid in self.db.list_txi():
+                for addr in self.db.get_txi(txid):
+                    for txi, v in self.db.get_txi_addr(txid, addr):
+                        self._spent_txos[addr].add(txi)
+            for txid in self.db.list_txo():
+                for addr in self.db.get_txo(txid):
+                    for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                        self._utxo_add(addr, txid + ':%d' % n, v, is_cb)
+
+    def _utxo_add(self, addr, txo, value, is_cb):
+        if txo not in self._spent_txos[addr]:
+            self._utxos[addr][txo] = (value, is_cb)
+
+    def _utxo_spend(self, addr, txo):
+        self._spent_txos[addr].add(txo)
+        self._utxos[addr].pop(txo, None)
+
+    def _remove_tx_from_utxos(self, txid):
+        with self.transaction_lock:
+            for addr in self.db.get_txo(txid):
+                for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                    self._utxos[addr].pop(txid + ':%d' % n, None)
+            for addr in self.db.get_txi(txid):
+                for txi, v in self.db.get_txi_addr(txid, addr):
+                    self._spent_txos[addr].discard(txi)
+                    prevout_hash, prevout_n = txi.split(':')
+                    prevout_n = int(prevout_n)
+                    for n, v, is_cb in self.db.get_txo_addr(prevout_hash, addr):
+                        if n == prevout_n:
+                            self._utxo_add(addr, txi, v, is_cb)
+
     def _mark_address_history_changed(self, addr: str) -> None:
         # history for this address changed, wake up coroutines:
         self._address_history_changed_events[addr].set()
@@ -635,24 +695,32 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._mark_tx_balance_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
+                height_changed = self.unverified_tx.get(tx_hash) != tx_height
+                if height_changed:
+                    self._mark_tx_balance_changed(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
+            if height_changed and tx_height > 0 and self.verifier:
+                self.verifier.wake_up()
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._mark_tx_balance_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._mark_tx_balance_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -672,6 +740,7 @@ class AddressSynchronizer(Logger):
                     header = blockchain.read_header(tx_height)
                     if not header or hash_header(header) != info.header_hash:
                         self.db.remove_verified_tx(tx_hash)
+                        self._mark_tx_balance_changed(tx_hash)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
                         # If on the new fork after the reorg, the txn is at the
@@ -837,37 +906,35 @@ class AddressSynchronizer(Logger):
                     sent[txi] = (height, islock)
         return received, sent
 
+    def get_ps_rounds(self, txo):
+        ps_denom = self.db.get_ps_denom(txo)
+        if ps_denom:
+            return ps_denom[2]
+        if self.db.get_ps_collateral(txo):
+            return int(PSCoinRounds.COLLATERAL)
+        if self.db.get_ps_other(txo):
+            return int(PSCoinRounds.OTHER)
+        return None
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            ps_rounds = None
-            ps_denom = self.db.get_ps_denom(txo)
-            if ps_denom:
-                ps_rounds = ps_denom[2]
-            if ps_rounds is None:
-                ps_collateral = self.db.get_ps_collateral(txo)
-                if ps_collateral:
-                    ps_rounds = int(PSCoinRounds.COLLATERAL)
-            if ps_rounds is None:
-                ps_other = self.db.get_ps_other(txo)
-                if ps_other:
-                    ps_rounds = int(PSCoinRounds.OTHER)
-            tx_height, value, is_cb, islock = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address': address,
-                'value': value,
-                'prevout_n': int(prevout_n),
-                'prevout_hash': prevout_hash,
-                'height': tx_height,
-                'coinbase': is_cb,
-                'islock': islock,
-                'ps_rounds': ps_rounds,
-            }
-            out[txo] = x
+        with self.lock, self.transaction_lock:
+            utxos = self._utxos.get(address)
+            if not utxos:
+                return out
+            for txo, (value, is_cb) in utxos.items():
+                prevout_hash, prevout_n = txo.split(':')
+                x = {
+                    'address': address,
+                    'value': value,
+                    'prevout_n': int(prevout_n),
+                    'prevout_hash': prevout_hash,
+                    'height': self.get_tx_height(prevout_hash).height,
+                    'coinbase': is_cb,
+                    'islock': self.db.get_islock(prevout_hash),
+                    'ps_rounds': self.get_ps_rounds(txo),
+                }
+                out[txo] = x
         return out
 
     # return the total amount ever received by an address
@@ -875,9 +942,88 @@ class AddressSynchronizer(Logger):
         received, sent = self.get_addr_io(address)
         return sum([v for height, v, is_cb, islock in received.values()])
 
+    def reset_balance_ledger(self):
+        with self.transaction_lock:
+            # address -> {ps_rounds: [c, u, x]}, where ps_rounds is rounds
+            # of PS denom, or None for other coins
+            self._balance_ledger = {}
+            self._balance_totals = defaultdict(lambda: [0, 0, 0])
+            self._balance_immature_addrs = set()
+            self._balance_dirty = set(self._history_local.keys())
+
+    def _mark_addr_balance_changed(self, addr):
+        with self.transaction_lock:
+            self._balance_dirty.add(addr)
+
+    def _mark_tx_balance_changed(self, txid):
+        with self.transaction_lock:
+            self._balance_dirty.update(self.db.get_txi(txid))
+            self._balance_dirty.update(self.db.get_txo(txid))
+
+    @staticmethod
+    def _add_balance_buckets(res, buckets, min_rounds=None, sign=1):
+        for ps_rounds, (c, u, x) in buckets.items():
+            if min_rounds is not None:
+                if ps_rounds is None or ps_rounds < min_rounds:
+                    continue
+            res[0] += sign * c
+            res[1] += sign * u
+            res[2] += sign * x
+
+    def _calc_addr_balance(self, address, excluded_coins=None):
+        received, sent = self.get_addr_io(address)
+        ps_denoms = self.db.get_ps_denoms()
+        local_height = self.get_local_height()
+        buckets = {}
+        for txo, (tx_height, v, is_cb, islock) in received.items():
+            if excluded_coins and txo in excluded_coins:
+                continue
+            ps_denom = ps_denoms.get(txo)
+            ps_rounds = ps_denom[2] if ps_denom else None
+            b = buckets.get(ps_rounds)
+            if b is None:
+                b = buckets[ps_rounds] = [0, 0, 0]
+            if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                b[2] += v
+            elif tx_height > 0 or islock:
+                b[0] += v
+            else:
+                b[1] += v
+            if txo in sent:
+                sent_height, sent_islock = sent[txo]
+                if sent_height > 0 or sent_islock:
+                    b[0] -= v
+                else:
+                    b[1] -= v
+        return buckets
+
+    def _flush_balance_ledger(self):
+        with self.lock, self.transaction_lock:
+            while self._balance_dirty:
+                addr = self._balance_dirty.pop()
+                old = self._balance_ledger.pop(addr, None)
+                if old:
+                    for ps_rounds, b in old.items():
+                        totals = self._balance_totals[ps_rounds]
+                        totals[0] -= b[0]
+                        totals[1] -= b[1]
+                        totals[2] -= b[2]
+                new = self._calc_addr_balance(addr)
+                self._balance_immature_addrs.discard(addr)
+                if not new:
+                    continue
+                self._balance_ledger[addr] = new
+                for ps_rounds, b in new.items():
+                    totals = self._balance_totals[ps_rounds]
+                    totals[0] += b[0]
+                    totals[1] += b[1]
+                    totals[2] += b[2]
+                    if b[2]:
+                        self._balance_immature_addrs.add(addr)
+
     @with_local_height_cached
     def get_addr_balance(self, address, *, excluded_coins: Set[str] = None,
-                         min_rounds=None, ps_denoms=None):
+                         min_rounds=None):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
 
@@ -885,44 +1031,18 @@ class AddressSynchronizer(Logger):
         """
         if min_rounds is not None and min_rounds < 0:
             min_rounds = None
-        if ps_denoms is None:
-            ps_denoms = {}
-        # cache is only used if there are no excluded_coins or min_rounds
-        if not excluded_coins and min_rounds is None:
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb, islock) in received.items():
-            if min_rounds is not None and txo not in ps_denoms:
-                continue
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0 or islock:
-                c += v
+        with self.lock, self.transaction_lock:
+            if excluded_coins:
+                buckets = self._calc_addr_balance(address, excluded_coins)
             else:
-                u += v
-            if txo in sent:
-                sent_height, sent_islock = sent[txo]
-                if sent_height > 0 or sent_islock:
-                    c -= v
-                else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins and min_rounds is None:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...);
-            # or new islock
-            self._get_addr_balance_cache[address] = result
-        return result
+                self._flush_balance_ledger()
+                buckets = self._balance_ledger.get(address, {})
+            res = [0, 0, 0]
+            self._add_balance_buckets(res, buckets, min_rounds)
+        return tuple(res)
 
     @with_local_height_cached
     def get_utxos(self, domain=None, *, excluded_addresses=None,
@@ -931,6 +1051,7 @@ class AddressSynchronizer(Logger):
                   consider_islocks=False, include_ps=False, min_rounds=None):
         coins = []
         ps_ks_domain = self.psman.get_addresses()
+        ps_ks_domain_set = set(ps_ks_domain)
         if domain is None:
             if include_ps:
                 domain = self.get_addresses() + ps_ks_domain
@@ -947,7 +1068,7 @@ class AddressSynchronizer(Logger):
         for addr in domain:
             utxos = self.get_addr_utxo(addr)
             for x in utxos.values():
-                if x['address'] in ps_ks_domain:
+                if x['address'] in ps_ks_domain_set:
                     x.update({'is_ps_ks': True})
                 else:
                     x.update({'is_ps_ks': False})
@@ -969,40 +1090,61 @@ class AddressSynchronizer(Logger):
                 continue
         return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None,
                     include_ps=True, min_rounds=None) -> Tuple[int, int, int]:
         '''min_rounds parameter consider values < 0 same as None'''
-        ps_denoms = {}
-        if min_rounds is not None:
-            if min_rounds < 0:
-                min_rounds = None
-            else:
-                ps_denoms = self.db.get_ps_denoms(min_rounds=min_rounds)
-        if domain is None:
-            if include_ps:
-                domain = self.get_addresses() + self.psman.get_addresses()
-            else:
-                if min_rounds is not None:
-                    domain = [ps_denom[0] for ps_denom in ps_denoms.values()]
-                else:
-                    ps_addrs = self.db.get_ps_addresses()
-                    domain = set(self.get_addresses() +
-                                 self.psman.get_addresses()) - ps_addrs
+        if min_rounds is not None and min_rounds < 0:
+            min_rounds = None
         if excluded_addresses is None:
             excluded_addresses = set()
         assert isinstance(excluded_addresses, set), f"excluded_addresses should be set, not {type(excluded_addresses)}"
-        domain = set(domain) - excluded_addresses
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr,
-                                            excluded_coins=excluded_coins,
-                                            min_rounds=min_rounds,
-                                            ps_denoms=ps_denoms)
-            cc += c
-            uu += u
-            xx += x
-        return cc, uu, xx
+        res = [0, 0, 0]
+        with self.lock, self.transaction_lock:
+            self._flush_balance_ledger()
+            ledger = self._balance_ledger
+            if domain is None:
+                if not include_ps and min_rounds is None:
+                    excluded_addresses = (excluded_addresses |
+                                          self.db.get_ps_addresses())
+                self._add_balance_buckets(res, self._balance_totals,
+                                          min_rounds)
+                for addr in excluded_addresses:
+                    self._add_balance_buckets(res, ledger.get(addr, {}),
+                                              min_rounds, sign=-1)
+
+                def in_domain(addr):
+                    return addr in ledger and addr not in excluded_addresses
+            else:
+                domain = set(domain) - excluded_addresses
+                for addr in domain:
+                    self._add_balance_buckets(res, ledger.get(addr, {}),
+                                              min_rounds)
+
+                def in_domain(addr):
+                    return addr in domain
+            if excluded_coins:
+                # replace balance of addresses with excluded coins
+                for addr in self._get_coins_addresses(excluded_coins):
+                    if not in_domain(addr):
+                        continue
+                    self._add_balance_buckets(res, ledger.get(addr, {}),
+                                              min_rounds, sign=-1)
+                    buckets = self._calc_addr_balance(addr, excluded_coins)
+                    self._add_balance_buckets(res, buckets, min_rounds)
+        return tuple(res)
+
+    def _get_coins_addresses(self, coins):
+        addrs = set()
+        for txo in coins:
+            prevout_hash, prevout_n = txo.split(':')
+            prevout_n = int(prevout_n)
+            for addr in self.db.get_txo(prevout_hash):
+                for n, v, is_cb in self.db.get_txo_addr(prevout_hash, addr):
+                    if n == prevout_n:
+                        addrs.add(addr)
+        return addrs
 
     def is_used(self, address):
         return self.get_address_history_len(address) != 0
@@ -333,49 +333,33 @@ class AxeInventory(namedtuple('AxeInventory', 'type hash')):
 
 
 class AxeCmd:
-    '''Class representing Axe network message packed with msg header cmd'''
+    '''Class representing Axe network message packed with msg header cmd.
+    Payload is decoded on first access of payload attribute'''
 
     def __init__(self, cmd, payload=None):
-        lcmd = cmd.lower()
-        vds = BCDataStream()
-        vds.clear_and_set_bytes(payload)
-        if lcmd == 'version':
-            self.payload = AxeVersionMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'ping':
-            self.payload = AxePingMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'pong':
-            self.payload = AxePongMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'addr':
-            self.payload = AxeAddrMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'inv':
-            self.payload = AxeInvMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'spork':
-            self.payload = AxeSporkMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'islock':
-            self.payload = AxeISLockMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'mnlistdiff':
-            self.payload = AxeMNListDiffMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'qfcommit':
-            self.payload = AxeQFCommitMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'senddsq':
-            self.payload = AxeSendDsqMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dsa':
-            self.payload = AxeDsaMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dsc':
-            self.payload = AxeDscMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dsf':
-            self.payload = AxeDsfMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dsi':
-            self.payload = AxeDsiMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dsq':
-            self.payload = AxeDsqMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dss':
-            self.payload = AxeDssMsg.read_vds(vds, alone_data=True)
-        elif lcmd == 'dssu':
-            self.payload = AxeDssuMsg.read_vds(vds, alone_data=True)
+        self.cmd = cmd.lower()
+        self.raw_payload = payload
+        self._payload = None
+        self._decoded = False
+
+    def decode(self):
+        '''Decode raw payload, can be called from executor thread'''
+        if self._decoded:
+            return
+        msg_cls = AXE_MSG_CLASSES.get(self.cmd)
+        if msg_cls is not None:
+            vds = BCDataStream()
+            vds.clear_and_set_bytes(self.raw_payload)
+            self._payload = msg_cls.read_vds(vds, alone_data=True)
         else:
-            self.payload = payload
-        self.cmd = lcmd
+            self._payload = self.raw_payload
+        self._decoded = True
+
+    @property
+    def payload(self):
+        if not self._decoded:
+            self.decode()
+        return self._payload
 
     def __str__(self):
         if not self.payload:
@@ -1128,7 +1112,7 @@ class AxeDstxMsg(AxeMsgBase):
         return AxeDstxMsg(tx, masternodeOutPoint, vchSig, sigTime)
 
     def msg_hash(self):
-        return sha256d(bfh(self.tx.serialize()) +
+        return sha256d(self.tx.serialize_to_network_bytes() +
                        self.masternodeOutPoint.serialize() +
                        pack('<q', self.sigTime))
 
@@ -1248,7 +1232,7 @@ class AxeDsfMsg(AxeMsgBase):
     def serialize(self):
         return (
             pack('<i', self.sessionID) +                # sessionID
-            bfh(self.txFinal.serialize())               # txFinal
+            self.txFinal.serialize_to_network_bytes()    # txFinal
         )
 
 
@@ -1311,3 +1295,29 @@ class AxeDscMsg(AxeMsgBase):
             pack('<i', self.sessionID) +                # sessionID
             pack('<i', self.messageID)                  # messageID
         )
+
+
+# cmd -> msg class used to read payload in AxeCmd
+AXE_MSG_CLASSES = {
+    'version': AxeVersionMsg,
+    'ping': AxePingMsg,
+    'pong': AxePongMsg,
+    'addr': AxeAddrMsg,
+    'inv': AxeInvMsg,
+    'spork': AxeSporkMsg,
+    'islock': AxeISLockMsg,
+    'mnlistdiff': AxeMNListDiffMsg,
+    'qfcommit': AxeQFCommitMsg,
+    'senddsq': AxeSendDsqMsg,
+    'dsa': AxeDsaMsg,
+    'dsc': AxeDscMsg,
+    'dsf': AxeDsfMsg,
+    'dsi': AxeDsiMsg,
+    'dsq': AxeDsqMsg,
+    'dss': AxeDssMsg,
+    'dssu': AxeDssuMsg,
+}
+
+
+# cmds with large payloads which are checked and decoded off the event loop
+AXE_HEAVY_MSGS = {'mnlistdiff', 'qfcommit'}
@@ -31,12 +31,13 @@ import os
 import queue
 import random
 import re
+import secrets
 import threading
 import time
 from aiorpcx import TaskGroup
 from binascii import unhexlify
 from bls_py import bls
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from typing import Optional, Dict
 
 from . import constants
@@ -58,6 +59,13 @@ MIN_PEERS_LIMIT = 2
 MAX_PEERS_LIMIT = 8
 MAX_PEERS_DEFAULT = 2
 NUM_RECENT_PEERS = 20
+MAX_FOUND_PEERS = 1000  # not yet connected peers stored in the address book
+MAX_TRIED_FOUND_PEERS = 250  # peers with successful connects stored
+NODE_NETWORK = 1  # service bit of relayed addrs, full node serving blocks
+FOUND_PEERS_MAX_AGE = 30*24*3600  # evict peers not seen in 30 days
+FOUND_PEERS_SAVE_INTERVAL = 60
+FOUND_PEER_RETRY_DELAY = 60  # doubled on each consecutive failed connect
+FOUND_PEER_DEFAULT_PING = 500  # ms, assumed ping of not yet connected peer
 NET_THREAD_MSG = 'must not be called from network thread'
 DNS_OVER_HTTPS_ENDPOINTS = [
     'https://dns.google.com/resolve',
@@ -67,6 +75,15 @@ ALLOWED_HOSTNAME_RE = re.compile(r'(?!-)[A-Z\d-]{1,63}(?<!-)$', re.IGNORECASE)
 INSTANCE = None
 
 IS_LLMQ_TYPE = LLMQType.LLMQ_50_60
+QUORUM_PUBKEYS_CACHE_SIZE = 32
+
+MNLISTD_MAX_INFLIGHT = 16   # mnlistdiffs downloaded in parallel
+MNLISTD_PEER_INFLIGHT = 4   # mnlistdiff requests pipelined to one peer
+MNLISTD_MAX_TRIES = 5       # tries of one height range before giving up
+MNLISTD_MAX_FAILURES = 3    # consecutive bad/slow diffs to drop the peer
+MNLISTD_BAN_SECONDS = 3600  # ban time for peer sending invalid diffs
+MNLISTD_RESET_PEERS = 3     # peers with same root mismatch to reset MNList
+MNLISTD_DEFAULT_LATENCY = 1.0  # assumed latency of not yet used peer
 
 
 def is_valid_hostname(hostname):
@@ -206,6 +223,7 @@ class AxeNet(Logger):
         self.restart_lock = asyncio.Lock()
         self.callback_lock = threading.Lock()
         self.banlist_lock = threading.Lock()
+        self.found_peers_lock = threading.Lock()
         self.peers_lock = threading.Lock()  # for mutating/iterating self.peers
 
         # callbacks set by the GUI
@@ -216,7 +234,14 @@ class AxeNet(Logger):
         self.connecting = set()
         self.peers_queue = None
         self.banlist = self._read_banlist()
-        self.found_peers = set()
+        # address book: peer -> last seen time, connects stats, ping
+        self.found_peers = self._read_found_peers()
+        self.found_peers_changed = False
+        self.found_peers_save_time = time.time()
+
+        # mnlistdiffs download in progress
+        self.mnlistd_loading = False
+        self.mnlistd_reset_done = False  # MNList reset once per getmnlistd
 
         self.is_cmd_axe_peers = not config.is_modifiable('axe_peers')
         self.read_conf()
@@ -229,7 +254,11 @@ class AxeNet(Logger):
         self.recent_islock_invs = deque([], 200)
         self.recent_islocks_lock = threading.Lock()
         self.recent_islocks_clear = time.time()
-        self.recent_islocks = list()
+        self.recent_islocks = defaultdict(list)  # txid -> pending islocks
+        self.verified_islocks = {}  # txid -> time when islock received
+        self.islocks_verify_scheduled = False
+        self.quorum_pubkeys_lock = threading.Lock()
+        self.quorum_pubkeys = OrderedDict()  # LRU of parsed bls.PublicKey
 
         # Recent broadcasted dsq data
         self.recent_dsq = deque([], 100)
@@ -285,6 +314,12 @@ class AxeNet(Logger):
                 return func(self, *args, **kwargs)
         return func_wrapper
 
+    def with_found_peers_lock(func):
+        def func_wrapper(self, *args, **kwargs):
+            with self.found_peers_lock:
+                return func(self, *args, **kwargs)
+        return func_wrapper
+
     def register_callback(self, callback, events):
         with self.callback_lock:
             for event in events:
@@ -349,6 +384,172 @@ class AxeNet(Logger):
             self._save_banlist()
             self.trigger_callback('axe-banlist-updated', 'removed', peer)
 
+    def _read_found_peers(self):
+        if not self.data_dir:
+            return {}
+        path = os.path.join(self.data_dir, 'peers.gz')
+        try:
+            with gzip.open(path, 'rb') as f:
+                data = f.read()
+                return json.loads(data.decode('utf-8'))
+        except Exception as e:
+            self.logger.info(f'failed to load peers.gz: {repr(e)}')
+            return {}
+
+    @with_found_peers_lock
+    def _save_found_peers(self):
+        self.found_peers_changed = False
+        self.found_peers_save_time = time.time()
+        if not self.data_dir:
+            return
+        path = os.path.join(self.data_dir, 'peers.gz')
+        try:
+            s = json.dumps(self.found_peers, indent=4)
+            with gzip.open(path, 'wb') as f:
+                f.write(s.encode('utf-8'))
+        except Exception as e:
+            self.logger.info(f'failed to save peers.gz: {repr(e)}')
+
+    def save_found_peers_if_changed(self):
+        if not self.found_peers_changed:
+            return
+        if time.time() - self.found_peers_save_time < FOUND_PEERS_SAVE_INTERVAL:
+            return
+        self._save_found_peers()
+
+    @staticmethod
+    def found_peer_score(info, now):
+        '''Higher is better: connect success rate, lowered with time
+        since peer was last seen and with ping time'''
+        rate = (info['ok'] + 1) / (info['tries'] + 2)
+        age_days = max(0, now - info['seen']) / 86400
+        ping = info['ping']
+        if ping is None:
+            ping = FOUND_PEER_DEFAULT_PING
+        return rate / (1 + age_days) / (1 + ping / 1000)
+
+    @staticmethod
+    def found_peer_is_tried(info):
+        '''Peer had successful connects'''
+        return info['ok'] > 0
+
+    def found_peer_rank(self, info, now):
+        '''Tried peers are ranked above not yet connected ones'''
+        return (self.found_peer_is_tried(info),
+                self.found_peer_score(info, now))
+
+    @staticmethod
+    def found_peer_can_retry(info, now):
+        '''Peer is not in the backoff after failed connects'''
+        fails = info['fails']
+        if not fails:
+            return True
+        delay = FOUND_PEER_RETRY_DELAY * 2 ** min(fails - 1, 10)
+        return now - info['last_try'] >= delay
+
+    def _evict_found_peers(self):
+        '''Remove peers not seen for too long, then lowest scored.
+        Tried and not yet connected peers are limited separately,
+        so new peers never evict tried ones.'''
+        now = time.time()
+        found_peers = self.found_peers
+        for peer in [p for p, info in found_peers.items()
+                     if now - info['seen'] > FOUND_PEERS_MAX_AGE]:
+            del found_peers[peer]
+        tried_peers = []
+        new_peers = []
+        for peer, info in found_peers.items():
+            if self.found_peer_is_tried(info):
+                tried_peers.append(peer)
+            else:
+                new_peers.append(peer)
+        for peers, max_cnt in [(new_peers, MAX_FOUND_PEERS),
+                               (tried_peers, MAX_TRIED_FOUND_PEERS)]:
+            excess = len(peers) - max_cnt
+            if excess <= 0:
+                continue
+            peers.sort(key=lambda p: self.found_peer_score(found_peers[p],
+                                                           now))
+            for peer in peers[:excess]:
+                del found_peers[peer]
+
+    def is_valid_relayed_addr(self, ip, port, services):
+        '''Check address from addr message is a public full node
+        listening on the default port'''
+        if port != self.default_port:
+            return False
+        if not services & NODE_NETWORK:
+            return False
+        ipv4_mapped = getattr(ip, 'ipv4_mapped', None)
+        if ipv4_mapped:
+            ip = ipv4_mapped
+        return ip.is_global
+
+    @with_found_peers_lock
+    def add_found_peers(self, peers):
+        '''Add or update peers from list of (peer, seen, services)'''
+        if not peers:
+            return
+        now = time.time()
+        for peer, seen, services in peers:
+            seen = min(seen, now)
+            info = self.found_peers.get(peer)
+            if info is None:
+                self.found_peers[peer] = {
+                    'seen': seen,
+                    'services': services,
+                    'tries': 0,
+                    'ok': 0,
+                    'fails': 0,
+                    'last_try': 0,
+                    'ping': None,
+                }
+            else:
+                info['seen'] = max(info['seen'], seen)
+                if services:
+                    info['services'] = services
+        self._evict_found_peers()
+        self.found_peers_changed = True
+
+    @with_found_peers_lock
+    def _update_found_peer(self, peer, connected=None, axe_peer=None):
+        '''Update peer stats on connect attempt result, or on disconnect
+        if connected is None'''
+        info = self.found_peers.get(peer)
+        if info is None:
+            return
+        now = time.time()
+        if connected is not None:
+            info['tries'] += 1
+            info['last_try'] = now
+            if connected:
+                info['ok'] += 1
+                info['fails'] = 0
+            else:
+                info['fails'] += 1
+        if axe_peer is not None:
+            info['seen'] = now
+            version = getattr(axe_peer, 'version', None)
+            if version is not None:
+                info['services'] = version.services
+            if axe_peer.ping_time is not None:
+                info['ping'] = axe_peer.ping_time
+        self.found_peers_changed = True
+
+    def get_best_found_peer(self, excluded):
+        '''Get best scored peer not in excluded, banlist, retry backoff'''
+        now = time.time()
+        with self.found_peers_lock:
+            found_peers = self.found_peers
+            available = [(self.found_peer_rank(info, now), peer)
+                         for peer, info in found_peers.items()
+                         if peer not in excluded
+                         and peer not in self.banlist
+                         and self.found_peer_can_retry(info, now)]
+        if not available:
+            return None
+        return max(available)[1]
+
     def status_icon(self):
         if self.run_axe_net:
             peers_cnt = len(self.peers)
@@ -367,30 +568,80 @@ class AxeNet(Logger):
             return 'axe_net_off.png'
 
     def append_to_recent_islocks(self, islock):
-        request_id = islock.calc_request_id()
+        self.extend_recent_islocks([islock])
+
+    def extend_recent_islocks(self, islocks):
+        request_ids = [islock.calc_request_id() for islock in islocks]
         mn_list = self.network.mn_list
-        quorum = mn_list.calc_responsible_quorum(IS_LLMQ_TYPE, request_id)
-        if quorum is None:
-            self.logger.info('no forum found to verify islock')
-            return
-        txid = bh2u(islock.txid[::-1])
+        quorums = mn_list.calc_responsible_quorums(IS_LLMQ_TYPE, request_ids)
+        now = time.time()
+        schedule_verify = False
         with self.recent_islocks_lock:
-            self.recent_islocks.append((txid,
-                                        time.time(),
-                                        islock,
-                                        quorum,
-                                        request_id))
+            for islock, quorum, request_id in zip(islocks, quorums,
+                                                  request_ids):
+                if quorum is None:
+                    self.logger.info('no forum found to verify islock')
+                    continue
+                txid = bh2u(islock.txid[::-1])
+                if txid in self.verified_islocks:
+                    continue
+                self.recent_islocks[txid].append((now,
+                                                  islock,
+                                                  quorum,
+                                                  request_id))
+                if not self.islocks_verify_scheduled:
+                    self.islocks_verify_scheduled = True
+                    schedule_verify = True
         self.clear_recent_islocks()
-        self.trigger_callback('axe-islock', txid)
+        if schedule_verify:
+            coro = self.verify_recent_islocks()
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    @log_exceptions
+    async def verify_recent_islocks(self):
+        # pairings are CPU bound, do not block network thread with them
+        await self.loop.run_in_executor(None, self.verify_pending_islocks)
+
+    def verify_pending_islocks(self):
+        with self.recent_islocks_lock:
+            self.islocks_verify_scheduled = False
+            pending = self.recent_islocks
+            self.recent_islocks = defaultdict(list)
+        entries = [(txid, ) + islock_data
+                   for txid, islocks in pending.items()
+                   for islock_data in islocks]
+        if not entries:
+            return
+        results = self.verify_islocks([e[2:] for e in entries])
+        verified_txids = []
+        with self.recent_islocks_lock:
+            for (txid, t, islock, quorum, request_id), v_ok in zip(entries,
+                                                                   results):
+                if not v_ok:
+                    self.logger.info(f'verify islock failed: {txid}')
+                elif txid not in self.verified_islocks:
+                    self.verified_islocks[txid] = t
+                    verified_txids.append(txid)
+        self.logger.info(f'verified {len(verified_txids)} of'
+                         f' {len(entries)} pending islocks')
+        for txid in verified_txids:
+            self.trigger_callback('axe-islock', txid)
 
     def verify_on_recent_islocks(self, txid):
-        found = list(filter(lambda x: x[0] == txid, self.recent_islocks))
+        with self.recent_islocks_lock:
+            if txid in self.verified_islocks:
+                self.logger.info(f'found verified islock for {txid}')
+                return True
+            found = self.recent_islocks.pop(txid, [])
         found_cnt = len(found)
         self.logger.info(f'found {found_cnt} islocks in recent for {txid}')
-        for txid, t, islock, quorum, request_id in found:
-            v_ok = self.verify_islock(islock, quorum, request_id)
+        for t, islock, quorum, request_id in found:
+            pubk = self.get_quorum_pubkey(quorum.quorumPublicKey)
+            v_ok = self.verify_islock(islock, quorum, request_id, pubk=pubk)
             if v_ok:
                 self.logger.info(f'verify islock ok: {txid}')
+                with self.recent_islocks_lock:
+                    self.verified_islocks[txid] = t
                 return True
             else:
                 self.logger.info(f'verify islock failed: {txid}')
@@ -401,10 +652,88 @@ class AxeNet(Logger):
         if now - self.recent_islocks_clear < keep_sec/15:  # clean each 60 secs
             return
         with self.recent_islocks_lock:
-            self.recent_islocks = list(filter(lambda x: now - x[1] < keep_sec,
-                                              self.recent_islocks))
+            recent_islocks = defaultdict(list)
+            for txid, islocks in self.recent_islocks.items():
+                islocks = [x for x in islocks if now - x[0] < keep_sec]
+                if islocks:
+                    recent_islocks[txid] = islocks
+            self.recent_islocks = recent_islocks
+            self.verified_islocks = {txid: t for txid, t
+                                     in self.verified_islocks.items()
+                                     if now - t < keep_sec}
             self.recent_islocks_clear = now
 
+    def get_quorum_pubkey(self, quorum_pubk_bytes):
+        with self.quorum_pubkeys_lock:
+            pubk = self.quorum_pubkeys.get(quorum_pubk_bytes)
+            if pubk is not None:
+                self.quorum_pubkeys.move_to_end(quorum_pubk_bytes)
+                return pubk
+        pubk = bls.PublicKey.from_bytes(quorum_pubk_bytes)
+        with self.quorum_pubkeys_lock:
+            self.quorum_pubkeys[quorum_pubk_bytes] = pubk
+            while len(self.quorum_pubkeys) > QUORUM_PUBKEYS_CACHE_SIZE:
+                self.quorum_pubkeys.popitem(last=False)
+        return pubk
+
+    def verify_islocks(self, islocks):
+        '''Verify list of (islock, quorum, request_id), return list of bool.
+
+        Islocks signed by the same quorum are checked with one aggregate
+        verification, falling back to individual checks if it fails.'''
+        by_quorum = defaultdict(list)
+        for i, (islock, quorum, request_id) in enumerate(islocks):
+            by_quorum[quorum.quorumPublicKey].append(i)
+        results = [False] * len(islocks)
+        for quorum_pubk_bytes, idxs in by_quorum.items():
+            pubk = self.get_quorum_pubkey(quorum_pubk_bytes)
+            msg_sigs = []
+            for i in idxs:
+                islock, quorum, request_id = islocks[i]
+                msg_sigs.append((islock.msg_hash(quorum, request_id),
+                                 islock.sig))
+            for i, v_ok in zip(idxs, self.verify_bls_batch(pubk, msg_sigs)):
+                results[i] = v_ok
+        return results
+
+    @staticmethod
+    def verify_bls_batch(pubk, msg_sigs):
+        '''Verify list of (msg_hash, sig bytes) signed by pubk
+
+        Signatures are combined with random exponents, so that invalid
+        signatures can not cancel each other out in the aggregate.'''
+        results = [False] * len(msg_sigs)
+        batch = {}  # msg_hash -> (idx, bls.Signature)
+        for i, (msg_hash, sig) in enumerate(msg_sigs):
+            if msg_hash in batch:
+                continue  # duplicates checked on fallback
+            try:
+                batch[msg_hash] = (i, bls.Signature.from_bytes(sig))
+            except Exception:
+                continue
+        if not batch:
+            return results
+        if len(batch) > 1:
+            tree = {}
+            agg_value = None
+            for msg_hash, (i, sig) in batch.items():
+                exp = secrets.randbits(64) | 1
+                tree[(msg_hash, pubk)] = exp
+                value = sig.value * exp
+                agg_value = value if agg_value is None else agg_value + value
+            agg_sig = bls.Signature.from_g2(agg_value)
+            msg_hashes = list(batch.keys())
+            pubks = [pubk] * len(msg_hashes)
+            aggr_info = bls.AggregationInfo(tree, msg_hashes, pubks)
+            agg_sig.set_aggregation_info(aggr_info)
+            if bls.BLS.verify(agg_sig):
+                for i, sig in batch.values():
+                    results[i] = True
+        for i, (msg_hash, sig) in enumerate(msg_sigs):
+            if not results[i]:
+                results[i] = AxeNet.verify_bls_sig(pubk, msg_hash, sig)
+        return results
+
     def add_recent_dsq(self, dsq):
         nDenom = dsq.nDenom
         if nDenom not in list(PSDenoms):
@@ -503,6 +832,8 @@ class AxeNet(Logger):
                              f'{repr(e)}')
         self.main_taskgroup = None  # type: TaskGroup
         self.peeers = {}  # type: Dict[str, AxePeer]
+        if self.found_peers_changed:
+            self._save_found_peers()
         self.connecting.clear()
         self.peers_queue = None
         if not full_shutdown:
@@ -538,16 +869,20 @@ class AxeNet(Logger):
         self.config.set_key('axe_max_peers', cnt, True)
 
     async def find_peers(self):
+        now = time.time()
+        with self.found_peers_lock:
+            found_peers = [p for p, info in self.found_peers.items()
+                           if self.found_peer_can_retry(info, now)]
         peers_set = set(self.peers.keys())
-        peers_union = peers_set.union(self.connecting).union(self.found_peers)
+        peers_union = peers_set.union(self.connecting).union(found_peers)
         peers_union = peers_union.difference(self.banlist)
         peers_union_len = len(peers_union)
         if peers_union_len < 2:
             for seed in self.dns_seeds:
                 new_ips = await self.resolve_dns_over_https(seed)
                 if new_ips:
-                    new_peers = [f'{ip}:{self.default_port}' for ip in new_ips]
-                    self.found_peers = self.found_peers.union(new_peers)
+                    self.add_found_peers([(f'{ip}:{self.default_port}', now, 0)
+                                          for ip in new_ips])
                     break
         elif peers_union_len < self.max_peers:
             p = await self.get_random_peer()
@@ -574,10 +909,9 @@ class AxeNet(Logger):
         else:
             while self.peers_total < self.max_peers:
                 inavailable = self.connecting.union(self.peers)
-                available = self.found_peers.difference(inavailable)
-                available = available.difference(self.banlist)
-                if available:
-                    self._start_peer(random.choice(list(available)))
+                peer = self.get_best_found_peer(inavailable)
+                if peer:
+                    self._start_peer(peer)
                 await asyncio.sleep(0.1)
 
     async def get_random_peer(self):
@@ -644,6 +978,7 @@ class AxeNet(Logger):
                 await self.queue_peers()
                 await launch_already_queued_up_new_peers()
                 await disconnect_excess_peers()
+                self.save_found_peers_if_changed()
             except asyncio.CancelledError:
                 # suppress spurious cancellations
                 group = self.main_taskgroup
@@ -665,6 +1000,8 @@ class AxeNet(Logger):
 
     async def connection_down(self, axe_peer):
         peer = axe_peer.peer
+        if peer in self.peers:
+            self._update_found_peer(peer, axe_peer=axe_peer)
         self._close_peer(peer, axe_peer)
         if self.use_static_peers and peer in self.static_peers:
             self.disconnected_static[peer] = time.time()
@@ -681,9 +1018,11 @@ class AxeNet(Logger):
             await asyncio.wait_for(axe_peer.ready, timeout)
         except (asyncio.TimeoutError, asyncio.CancelledError):
             self.logger.info(f'could not connect peer {peer}')
+            self._update_found_peer(peer, connected=False)
             axe_peer.close()
             return
         else:
+            self._update_found_peer(peer, connected=True, axe_peer=axe_peer)
             with self.peers_lock:
                 assert peer not in self.peers
                 self.peers[peer] = axe_peer
@@ -710,48 +1049,200 @@ class AxeNet(Logger):
             return
         return axe_peer
 
-    async def getmnlistd(self, get_mns=False):
+    def calc_mnlistd_heights(self, get_mns=False):
+        '''Split range from current MNList height to the tip on heights
+        of consecutive non-overlapping mnlistdiff requests'''
         mn_list = self.network.mn_list
         llmq_offset = mn_list.LLMQ_OFFSET
         base_height = mn_list.protx_height if get_mns else mn_list.llmq_height
-
-        height = self.network.get_local_height()
-        if get_mns:
-            if not height or height <= base_height:
-                return
-        else:
-            if not height or height <= base_height + llmq_offset:
-                return
-
+        tip = self.network.get_local_height()
         activation_height = constants.net.DIP3_ACTIVATION_HEIGHT
-        if base_height <= 1:
-            if height > activation_height:
-                height = activation_height + 1
-        elif height - (base_height + llmq_offset) > CHUNK_SIZE:
-            height = mn_list.calc_max_height(base_height, height)
-        elif height - base_height > llmq_offset:
-            height = height - llmq_offset
 
+        heights = [base_height]
+        while True:
+            if not tip:
+                break
+            if get_mns:
+                if tip <= base_height:
+                    break
+            else:
+                if tip <= base_height + llmq_offset:
+                    break
+            height = tip
+            if base_height <= 1:
+                if height > activation_height:
+                    height = activation_height + 1
+            elif height - (base_height + llmq_offset) > CHUNK_SIZE:
+                height = mn_list.calc_max_height(base_height, height)
+            elif height - base_height > llmq_offset:
+                height = height - llmq_offset
+            heights.append(height)
+            base_height = height
+        return heights
+
+    def mnlistd_peer_score(self, axe_peer):
+        '''Lower is better: expected wait for response from peer,
+        doubled on each consecutive bad or slow mnlistdiff'''
+        latency = axe_peer.mnlistd_latency
+        if latency is None:
+            latency = MNLISTD_DEFAULT_LATENCY
+        score = latency * (1 + axe_peer.mnlistd_inflight)
+        return score * 2 ** axe_peer.mnlistd_failures
+
+    async def get_mnlistd_peer(self, excluded=None):
+        '''Get best scored peer having free slot for mnlistdiff request,
+        peers from excluded are used only if there is no other peers'''
+        while True:
+            peers = [p for p in self.peers.values()
+                     if p.mnlistd_inflight < MNLISTD_PEER_INFLIGHT]
+            if excluded and set(self.peers).difference(excluded):
+                peers = [p for p in peers if p.peer not in excluded]
+            if peers:
+                return min(peers, key=self.mnlistd_peer_score)
+            await asyncio.sleep(0.1)
+
+    async def on_mnlistd_failure(self, axe_peer, err, invalid=False):
+        '''Demote peer, drop it after too many consecutive failures'''
+        axe_peer.mnlistd_failures += 1
+        self.logger.info(f'mnlistdiff from {axe_peer.peer}: {err}'
+                         f' (failures: {axe_peer.mnlistd_failures})')
+        if axe_peer.mnlistd_failures != MNLISTD_MAX_FAILURES:
+            return
+        if invalid:
+            axe_peer.ban(f'sent invalid mnlistdiffs: {err}',
+                         MNLISTD_BAN_SECONDS)
+        await self.connection_down(axe_peer)
+
+    async def fetch_mnlistdiff(self, params, excluded):
+        '''Fetch mnlistdiff for params, trying other peers on timeouts
+        and errors. Return (peer, diff) or raise last error'''
+        for i in range(MNLISTD_MAX_TRIES):
+            err = None
+            p = await self.get_mnlistd_peer(excluded)
+            p.mnlistd_inflight += 1
+            start = time.time()
+            try:
+                diff = await p.getmnlistd(*params)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                err = e
+            finally:
+                p.mnlistd_inflight -= 1
+            elapsed = time.time() - start
+            latency = p.mnlistd_latency
+            if latency is None:
+                p.mnlistd_latency = elapsed
+            else:
+                p.mnlistd_latency = 0.8 * latency + 0.2 * elapsed
+            if err is None:
+                return p, diff
+            excluded.add(p.peer)
+            await self.on_mnlistd_failure(p, f'getmnlistd{params}:'
+                                             f' {repr(err)}')
+        raise err
+
+    async def download_mnlistdiffs(self, heights):
+        '''Download mnlistdiffs for consecutive heights from several peers
+        in parallel, apply and verify them in order. Invalid diff is
+        downloaded again from other peer. Peers are banned only for diffs
+        with bad CbTx proof, while root mismatch on the same diff from
+        several peers means local MNList is broken and resets it.
+        Return False on failure'''
+        from .protx_list import MNListDiffBadProof, MNListDiffRootMismatch
+        mn_list = self.network.mn_list
+        ranges = list(zip(heights, heights[1:]))
+        excluded = defaultdict(set)  # range index -> peers sent bad diff
+        tries = defaultdict(int)
+        # (range index, mismatch error) -> peers with diffs failed the check
+        root_mismatches = defaultdict(set)
+        tasks = {}  # range index -> fetch task
+        applied = 0
         try:
-            params = (base_height, height)
-            mn_list.sent_getmnlistd.put_nowait(params)
-        except asyncio.QueueFull:
+            while applied < len(ranges):
+                window_end = min(applied + MNLISTD_MAX_INFLIGHT, len(ranges))
+                for i in range(applied, window_end):
+                    if i not in tasks:
+                        coro = self.fetch_mnlistdiff(ranges[i], excluded[i])
+                        tasks[i] = self.loop.create_task(coro)
+                params = ranges[applied]
+                base_height, height = params
+                try:
+                    p, diff = await tasks.pop(applied)
+                except Exception as e:
+                    self.logger.info(f'getmnlistd{params}: {repr(e)}')
+                    mn_list.notify('network-error')
+                    return False
+                if base_height not in [mn_list.llmq_height,
+                                       mn_list.protx_height]:
+                    return True  # MNList changed, heights are outdated
+                err = None
+                try:
+                    if not await mn_list.apply_mnlistdiff(base_height,
+                                                          height, diff):
+                        return True  # MNList changed, heights are outdated
+                except MNListDiffRootMismatch as e:
+                    # can be caused by broken local MNList, not demote peer
+                    err = f'getmnlistd{params}: {repr(e)}'
+                    self.logger.info(f'mnlistdiff from {p.peer}: {err}')
+                    mismatch_peers = root_mismatches[(applied, str(e))]
+                    mismatch_peers.add(p.peer)
+                    if (len(mismatch_peers) >= MNLISTD_RESET_PEERS
+                            and not self.mnlistd_reset_done):
+                        self.logger.info(f'same root mismatch from'
+                                         f' {len(mismatch_peers)} peers,'
+                                         f' reset MNList')
+                        self.mnlistd_reset_done = True
+                        mn_list.reset(request_diffs=False)
+                        return True
+                except MNListDiffBadProof as e:
+                    err = f'getmnlistd{params}: {repr(e)}'
+                    await self.on_mnlistd_failure(p, err, invalid=True)
+                except Exception as e:
+                    err = f'getmnlistd{params}: {repr(e)}'
+                    await self.on_mnlistd_failure(p, err)
+                if err:
+                    excluded[applied].add(p.peer)
+                    tries[applied] += 1
+                    if tries[applied] >= MNLISTD_MAX_TRIES:
+                        mn_list.notify('network-error')
+                        return False
+                    continue
+                p.mnlistd_failures = 0
+                applied += 1
+            return True
+        finally:
+            for t in tasks.values():
+                if t.done() and not t.cancelled():
+                    t.exception()  # retrieve to not log it on t.__del__
+                t.cancel()
+
+    async def getmnlistd(self, get_mns=False):
+        '''Load mnlistdiffs from current MNList heights to the tip'''
+        if self.mnlistd_loading:
             self.logger.info('ignore excess getmnlistd request')
             return
+        self.mnlistd_loading = True
+        self.mnlistd_reset_done = False
         try:
-            res = None
-            err = None
-            p = await self.get_random_peer()
-            res = await p.getmnlistd(*params)
-        except asyncio.TimeoutError:
-            err = f'getmnlistd(get_mns={get_mns} params={params}): timeout'
-        except asyncio.CancelledError:
-            err = f'getmnlistd(get_mns={get_mns} params={params}): cancelled'
-        except Exception as e:
-            err = f'getmnlistd(get_mns={get_mns} params={params}): {repr(e)}'
-        self.trigger_callback('mnlistdiff', {'error': err,
-                                             'result': res,
-                                             'params': params})
+            mn_list = self.network.mn_list
+            while True:
+                heights = self.calc_mnlistd_heights(get_mns)
+                if len(heights) < 2:
+                    return
+                state = (mn_list.llmq_height, mn_list.protx_height)
+                if not await self.download_mnlistdiffs(heights):
+                    return
+                if state == (mn_list.llmq_height, mn_list.protx_height):
+                    return
+                if mn_list.llmq_loading:
+                    get_mns = False
+                elif mn_list.protx_loading:
+                    get_mns = True
+                else:
+                    return
+        finally:
+            self.mnlistd_loading = False
 
     async def resolve_dns_over_https(self, hostname, record_type='A'):
         params = {'ct': 'application/dns-json',
@@ -788,10 +1279,18 @@ class AxeNet(Logger):
             return bfh(block_hash)[::-1]
 
     @staticmethod
-    def verify_islock(islock, quorum, request_id):
+    def verify_islock(islock, quorum, request_id, pubk=None):
         msg_hash = islock.msg_hash(quorum, request_id)
-        pubk = bls.PublicKey.from_bytes(quorum.quorumPublicKey)
-        sig = bls.Signature.from_bytes(islock.sig)
+        if pubk is None:
+            pubk = bls.PublicKey.from_bytes(quorum.quorumPublicKey)
+        return AxeNet.verify_bls_sig(pubk, msg_hash, islock.sig)
+
+    @staticmethod
+    def verify_bls_sig(pubk, msg_hash, sig):
+        try:
+            sig = bls.Signature.from_bytes(sig)
+        except Exception:
+            return False
         aggr_info = bls.AggregationInfo.from_msg_hash(pubk, msg_hash)
         sig.set_aggregation_info(aggr_info)
         return bls.BLS.verify(sig)
@@ -812,3 +1311,15 @@ class AxeNet(Logger):
         aggr_info = bls.AggregationInfo.from_msg_hash(bpubk, msg_hash)
         bsig.set_aggregation_info(aggr_info)
         return bls.BLS.verify(bsig)
+
+    @classmethod
+    def test_bls_batch_speed(cls, n=10):
+        # Random signatures under one key, as islocks of a single quorum
+        privk = bls.PrivateKey.from_seed(os.urandom(32))
+        pubk = privk.get_public_key()
+        msg_sigs = []
+        for i in range(n):
+            msg_hash = os.urandom(32)
+            sig = privk.sign_prehashed(msg_hash)
+            msg_sigs.append((msg_hash, sig.serialize()))
+        return all(cls.verify_bls_batch(pubk, msg_sigs))
@@ -30,14 +30,15 @@ import logging
 import random
 import time
 from aiohttp_socks import open_connection
-from struct import pack, unpack
+from struct import pack, unpack_from
 from typing import Optional, Tuple
 
 from .bitcoin import public_key_to_p2pkh
 from .crypto import sha256d
 from .axe_msg import (SporkID, AxeType, AxeCmd, AxeVersionMsg,
                        AxePingMsg, AxePongMsg, AxeGetDataMsg,
-                       AxeGetMNListDMsg, AxeSendDsqMsg)
+                       AxeGetMNListDMsg, AxeSendDsqMsg, AXE_HEAVY_MSGS)
+from .axe_tx import str_ip
 from .ecc import ECPubkey
 from .interface import GracefulDisconnect
 from .logging import Logger
@@ -50,6 +51,9 @@ AXE_PROTO_VERSION = 70216
 LOCAL_IP_ADDR = ipaddress.ip_address('127.0.0.1')
 PAYLOAD_LIMIT = 32*2**20  # 32MiB
 READ_LIMIT = 64*2**10     # 64KiB
+MSG_HEADER_SIZE = 24      # start str, cmd, payload size, checksum
+MSG_QUEUE_SIZE = 100      # received msgs waiting for handler
+MNLISTD_TIMEOUT = 30      # wait for mnlistdiff response
 
 
 def deserialize_peer(peer_str: str) -> Tuple[str, str]:
@@ -63,10 +67,74 @@ def deserialize_peer(peer_str: str) -> Tuple[str, str]:
     return host, int_port
 
 
+class AxeMsgFramer:
+    '''Buffered parser extracting whole msg frames from data read'''
+
+    def __init__(self, start_str: bytes):
+        self.start_str = start_str
+        self.buf = bytearray()
+        self.skipped = 0  # bytes skipped while searching start str
+        self.last_skipped = 0  # bytes skipped before last frame
+
+    def feed(self, data: bytes):
+        self.buf += data
+
+    def _skip(self, n):
+        del self.buf[:n]
+        self.skipped += n
+        if self.skipped > PAYLOAD_LIMIT:
+            raise GracefulDisconnect(f'start str not found in '
+                                     f'{self.skipped} bytes read')
+
+    def next_frame(self) -> Optional[Tuple[str, bytes, bytes]]:
+        '''Return (cmd, payload, checksum) of next whole frame in buffer,
+        or None if more data is needed'''
+        buf = self.buf
+        start_pos = buf.find(self.start_str)
+        if start_pos < 0:
+            # keep possible start str prefix at the end of buffer
+            self._skip(max(0, len(buf) - len(self.start_str) + 1))
+            return None
+        if start_pos > 0:
+            self._skip(start_pos)
+        if len(buf) < MSG_HEADER_SIZE:
+            return None
+        payload_size = unpack_from('<I', buf, 16)[0]
+        if payload_size > PAYLOAD_LIMIT:
+            raise GracefulDisconnect('incoming msg payload to large')
+        frame_size = MSG_HEADER_SIZE + payload_size
+        if len(buf) < frame_size:
+            return None
+        with memoryview(buf) as frame:  # copy fields once from buffer
+            cmd = bytes(frame[4:16]).strip(b'\x00').decode('ascii')
+            checksum = bytes(frame[20:24])
+            payload = bytes(frame[24:frame_size])
+        del buf[:frame_size]
+        self.last_skipped = self.skipped
+        self.skipped = 0
+        return cmd, payload, checksum
+
+
 class AxePeer(Logger):
 
     LOGGING_SHORTCUT = 'P'
 
+    # cmd -> (handler method name, handler queue name).
+    # Msgs with the same queue name are handled in order of receiving
+    MSG_HANDLERS = {
+        'ping': ('on_ping', 'ping'),
+        'pong': ('on_pong', 'ping'),
+        'spork': ('on_spork', 'spork'),
+        'inv': ('on_inv', 'inv'),
+        'addr': ('on_addr', 'addr'),
+        'mnlistdiff': ('on_mnlistdiff', 'mnlistdiff'),
+        'islock': ('on_islock', 'islock'),
+        'dsq': ('on_dsq', 'ds'),
+        'dssu': ('on_mix_msg', 'ds'),
+        'dsf': ('on_mix_msg', 'ds'),
+        'dsc': ('on_mix_msg', 'ds'),
+    }
+
     def __init__(self, axe_net, peer: str, proxy: Optional[dict],
                  debug=False, sml_entry=None, mix_session=None):
         self.default_port = axe_net.default_port
@@ -86,6 +154,15 @@ class AxePeer(Logger):
 
         self.sw = None  # StreamWriter
         self.sr = None  # StreamReader
+        self.framer = AxeMsgFramer(self.start_str)
+
+        # Received msgs handlers and queues
+        self.msg_handlers = {cmd: getattr(self, handler_name)
+                             for cmd, (handler_name, queue_name)
+                             in self.MSG_HANDLERS.items()}
+        self.msg_queues = {queue_name: asyncio.Queue(MSG_QUEUE_SIZE)
+                           for handler_name, queue_name
+                           in self.MSG_HANDLERS.values()}
 
         # Dump net msgs (only for this peer). Set at runtime from the console.
         self.debug = debug
@@ -101,8 +178,11 @@ class AxePeer(Logger):
         # getaddr flag
         self.getaddr_done = False
 
-        # mnlistdiff data
-        self.mnlistdiffs = asyncio.Queue(1)
+        # mnlistdiff data: (baseBlockHash, blockHash) -> future
+        self.mnlistd_requests = {}
+        self.mnlistd_inflight = 0
+        self.mnlistd_latency = None  # moving average of response time
+        self.mnlistd_failures = 0  # consecutive bad or slow mnlistdiffs
 
         # Activity data
         self.read_bytes = 0
@@ -201,6 +281,8 @@ class AxePeer(Logger):
         try:
             async with self.group as group:
                 await group.spawn(self.process_msgs)
+                for queue in self.msg_queues.values():
+                    await group.spawn(self.process_msg_queue(queue))
                 await group.spawn(self.process_ping)
                 await group.spawn(self.monitor_connection)
         except GracefulDisconnect:
@@ -211,84 +293,109 @@ class AxePeer(Logger):
             raise GracefulDisconnect(e, log_level=logging.ERROR) from e
 
     async def process_msgs(self):
+        '''Read msgs and put them to handler queues. Waiting on full
+        queue stops reading from the peer until handler catches up'''
+        MSG_HANDLERS = self.MSG_HANDLERS
+        msg_queues = self.msg_queues
         while True:
             res = await self.read_next_msg()
-            if res:
-                axe_net = self.axe_net
-                cmd = res.cmd
-                payload = res.payload
-                if cmd == 'ping':
-                    msg = AxePongMsg(payload.nonce)
-                    await self.send_msg('pong', msg.serialize())
-                elif cmd == 'pong':
-                    now = time.time()
-                    if payload.nonce == self.ping_nonce:
-                        self.ping_time = round((now - self.ping_start) * 1000)
-                        self.ping_nonce = None
-                        self.ping_start = None
-                    else:
-                        self.logger.info(f'pong with unknonw nonce')
-                elif cmd == 'spork':
-                    spork_msg = payload
-                    spork_id = spork_msg.nSporkID
-                    if not SporkID.has_value(spork_id):
-                        self.logger.info(f'unknown spork id: {spork_id}')
-                        continue
-
-                    def verify_spork():
-                        return self.verify_spork(spork_msg)
-                    verify_ok = await self.loop.run_in_executor(None,
-                                                                verify_spork)
-                    if not verify_ok:
-                        raise GracefulDisconnect('verify_spork failed')
-                    sporks = axe_net.sporks
-                    sporks.set_spork(spork_id, spork_msg.nValue, self.peer)
-                    axe_net.set_spork_time = time.time()
-                elif cmd == 'inv':
-                    out_inventory = []
-                    for di in payload.inventory:
-                        inv_hash = di.hash
-                        if self.mix_session:
-                            if di.type == AxeType.MSG_DSTX:
-                                out_inventory.append(di)
-                        elif di.type == AxeType.MSG_ISLOCK:
-                            recent_invs = axe_net.recent_islock_invs
-                            if inv_hash not in recent_invs:
-                                recent_invs.append(inv_hash)
-                                out_inventory.append(di)
-                    if out_inventory:
-                        msg = AxeGetDataMsg(out_inventory)
-                        await self.send_msg('getdata', msg.serialize())
-                elif cmd == 'addr':
-                    addresses = [f'{a.ip}:{a.port}'
-                                 for a in payload.addresses]
-                    found_peers = self.axe_net.found_peers
-                    found_peers = found_peers.union(addresses)
-                elif cmd == 'mnlistdiff':
-                    try:
-                        self.mnlistdiffs.put_nowait(payload)
-                    except asyncio.QueueFull:
-                        self.logger.info('excess mnlistdiff msg')
-                elif cmd == 'islock':
-                    axe_net.append_to_recent_islocks(payload)
-                elif cmd == 'dsq':
-                    if self.mix_session:
-                        if payload.fReady:  # session must ignore other dsq
-                            if self.mix_session.verify_ds_msg_sig(payload):
-                                await self.mix_session.msg_queue.put(res)
-                            else:
-                                exc = Exception(f'dsq vchSig verification'
-                                                f' failed {res}')
-                                await self.mix_session.msg_queue.put(exc)
-                    else:
-                        axe_net.add_recent_dsq(payload)
-                elif cmd == 'dssu' and self.mix_session:
-                    await self.mix_session.msg_queue.put(res)
-                elif cmd == 'dsf' and self.mix_session:
-                    await self.mix_session.msg_queue.put(res)
-                elif cmd == 'dsc' and self.mix_session:
+            if not res:
+                if not self._is_open:
+                    return
+                continue
+            handler_info = MSG_HANDLERS.get(res.cmd)
+            if handler_info:
+                await msg_queues[handler_info[1]].put(res)
+
+    async def process_msg_queue(self, queue: asyncio.Queue):
+        msg_handlers = self.msg_handlers
+        while True:
+            res = await queue.get()
+            await msg_handlers[res.cmd](res)
+
+    async def on_ping(self, res):
+        msg = AxePongMsg(res.payload.nonce)
+        await self.send_msg('pong', msg.serialize())
+
+    async def on_pong(self, res):
+        now = time.time()
+        if res.payload.nonce == self.ping_nonce:
+            self.ping_time = round((now - self.ping_start) * 1000)
+            self.ping_nonce = None
+            self.ping_start = None
+        else:
+            self.logger.info(f'pong with unknonw nonce')
+
+    async def on_spork(self, res):
+        axe_net = self.axe_net
+        spork_msg = res.payload
+        spork_id = spork_msg.nSporkID
+        if not SporkID.has_value(spork_id):
+            self.logger.info(f'unknown spork id: {spork_id}')
+            return
+
+        def verify_spork():
+            return self.verify_spork(spork_msg)
+        verify_ok = await self.loop.run_in_executor(None, verify_spork)
+        if not verify_ok:
+            raise GracefulDisconnect('verify_spork failed')
+        sporks = axe_net.sporks
+        sporks.set_spork(spork_id, spork_msg.nValue, self.peer)
+        axe_net.set_spork_time = time.time()
+
+    async def on_inv(self, res):
+        axe_net = self.axe_net
+        out_inventory = []
+        for di in res.payload.inventory:
+            inv_hash = di.hash
+            if self.mix_session:
+                if di.type == AxeType.MSG_DSTX:
+                    out_inventory.append(di)
+            elif di.type == AxeType.MSG_ISLOCK:
+                recent_invs = axe_net.recent_islock_invs
+                if inv_hash not in recent_invs:
+                    recent_invs.append(inv_hash)
+                    out_inventory.append(di)
+        if out_inventory:
+            msg = AxeGetDataMsg(out_inventory)
+            await self.send_msg('getdata', msg.serialize())
+
+    async def on_addr(self, res):
+        axe_net = self.axe_net
+        axe_net.add_found_peers([(f'{str_ip(a.ip)}:{a.port}',
+                                  a.time, a.services)
+                                 for a in res.payload.addresses
+                                 if axe_net.is_valid_relayed_addr(a.ip, a.port,
+                                                                  a.services)])
+
+    async def on_mnlistdiff(self, res):
+        diff = res.payload
+        fut = self.mnlistd_requests.pop((diff.baseBlockHash, diff.blockHash),
+                                        None)
+        if fut is None or fut.done():
+            self.logger.info('unasked mnlistdiff msg')
+            return
+        fut.set_result(diff)
+
+    async def on_islock(self, res):
+        self.axe_net.append_to_recent_islocks(res.payload)
+
+    async def on_dsq(self, res):
+        payload = res.payload
+        if self.mix_session:
+            if payload.fReady:  # session must ignore other dsq
+                if self.mix_session.verify_ds_msg_sig(payload):
                     await self.mix_session.msg_queue.put(res)
-            await asyncio.sleep(0.1)
+                else:
+                    exc = Exception(f'dsq vchSig verification'
+                                    f' failed {res}')
+                    await self.mix_session.msg_queue.put(exc)
+        else:
+            self.axe_net.add_recent_dsq(payload)
+
+    async def on_mix_msg(self, res):
+        if self.mix_session:
+            await self.mix_session.msg_queue.put(res)
 
     async def monitor_connection(self):
         net_timeout = self.axe_net.network.get_network_timeout_seconds()
@@ -323,6 +430,10 @@ class AxePeer(Logger):
                 self.sw.close()
             if self.mix_session:
                 self.mix_session.msg_queue.put_nowait(None)
+            for fut in self.mnlistd_requests.values():
+                if not fut.done():
+                    fut.set_exception(GracefulDisconnect('peer closed'))
+            self.mnlistd_requests.clear()
             self._is_open = False
             # monitor_connection will cancel tasks
 
@@ -383,48 +494,27 @@ class AxePeer(Logger):
         await self.send_msg('version', msg.serialize())
 
     async def read_next_msg(self):
-        start_str = None
-        start_bytes_read = 0
         axe_net = self.axe_net
-        while not start_str:
-            try:
-                start_str = await self.sr.readuntil(self.start_str)
-                self.read_time = axe_net.read_time = time.time()
-                len_start_str = len(start_str)
-                self.read_bytes += len_start_str
-                axe_net.read_bytes += len_start_str
-                if len_start_str > 4:
-                    self.logger.info(f'extra data before start'
-                                     f' str: {len_start_str}')
-            except asyncio.LimitOverrunError:
-                self.logger.info('start str not found, read ahead')
-                await self.sr.readexactly(READ_LIMIT)
-                self.read_time = axe_net.read_time = time.time()
-                self.read_bytes += READ_LIMIT
-                axe_net.read_bytes += READ_LIMIT
-                start_bytes_read += READ_LIMIT
-                if start_bytes_read > PAYLOAD_LIMIT:
-                    raise GracefulDisconnect(f'start str not found in '
-                                             f'{start_bytes_read} bytes read')
-            except asyncio.IncompleteReadError:
-                if not self._is_open:
-                    return
-                raise GracefulDisconnect('start str not found '
-                                         'in buffer, EOF found')
-
+        framer = self.framer
         try:
-            res = None
-            cmd = await self.sr.readexactly(12)
-            cmd = cmd.strip(b'\x00').decode('ascii')
-            payload_size = await self.sr.readexactly(4)
-            payload_size = unpack('<I', payload_size)[0]
-            if payload_size > PAYLOAD_LIMIT:
-                raise GracefulDisconnect('incoming msg payload to large')
-            checksum = await self.sr.readexactly(4)
-            self.read_time = axe_net.read_time = time.time()
-            self.read_bytes += 20
-            axe_net.read_bytes += 20
-            if payload_size == 0:
+            frame = framer.next_frame()
+            while frame is None:
+                data = await self.sr.read(READ_LIMIT)
+                if not data:
+                    if not self._is_open:
+                        return
+                    raise GracefulDisconnect('error reading msg, EOF reached')
+                self.read_time = axe_net.read_time = time.time()
+                len_data = len(data)
+                self.read_bytes += len_data
+                axe_net.read_bytes += len_data
+                framer.feed(data)
+                frame = framer.next_frame()
+            if framer.last_skipped:
+                self.logger.info(f'extra data before start'
+                                 f' str: {framer.last_skipped}')
+            cmd, payload, checksum = frame
+            if not payload:
                 if checksum != EMPTY_PAYLOAD_CHECKSUM:
                     self.logger.info(f'error reading msg {cmd}, '
                                      f'checksum mismatch')
@@ -434,20 +524,28 @@ class AxePeer(Logger):
                     self.logger.info(f'<-- {res} (no payload)')
                 return res
 
-            payload = await self.sr.readexactly(payload_size)
-            self.read_time = axe_net.read_time = time.time()
-            self.read_bytes += payload_size
-            axe_net.read_bytes += payload_size
-            calc_checksum = sha256d(payload)[:4]
-            if checksum != calc_checksum:
+            res = AxeCmd(cmd, payload)
+            if res.cmd in AXE_HEAVY_MSGS:
+                if res.cmd not in self.MSG_HANDLERS:
+                    # skip msg without handler, not hashing/decoding it
+                    if self.debug or axe_net.debug:
+                        self.logger.info(f'<-- {cmd} (skipped, no handler)')
+                    return
+                def check_and_decode():
+                    if sha256d(payload)[:4] != checksum:
+                        return False
+                    res.decode()
+                    return True
+                checksum_ok = await self.loop.run_in_executor(
+                    None, check_and_decode)
+            else:
+                checksum_ok = (sha256d(payload)[:4] == checksum)
+            if not checksum_ok:
                 self.logger.info(f'error reading msg {cmd}, '
                                  f'checksum mismatch')
                 return
-            res = AxeCmd(cmd, payload)
-        except asyncio.IncompleteReadError:
-            if not self._is_open:
-                return
-            raise GracefulDisconnect('error reading msg, EOF reached')
+        except GracefulDisconnect:
+            raise
         except Exception as e:
             raise GracefulDisconnect(e) from e
         if self.debug or axe_net.debug:
@@ -488,12 +586,21 @@ class AxePeer(Logger):
         else:
             return False
 
-    async def getmnlistd(self, base_height, height):
+    async def getmnlistd(self, base_height, height, timeout=MNLISTD_TIMEOUT):
+        '''Request mnlistdiff, responses are matched on block hashes,
+        so several requests can be pipelined to the same peer'''
         base_block_hash = await self.axe_net.get_hash(base_height)
         block_hash = await self.axe_net.get_hash(height)
-        msg = AxeGetMNListDMsg(base_block_hash, block_hash)
-        if not self.mnlistdiffs.empty():
-            self.logger.info('unasked mnlistdiff msg')
-            self.mnlistdiffs.get_nowait()
-        await self.send_msg('getmnlistd', msg.serialize())
-        return await asyncio.wait_for(self.mnlistdiffs.get(), timeout=30)
+        key = (base_block_hash, block_hash)
+        fut = self.mnlistd_requests.get(key)
+        if fut is not None:  # same request is already sent
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        fut = self.loop.create_future()
+        self.mnlistd_requests[key] = fut
+        try:
+            msg = AxeGetMNListDMsg(base_block_hash, block_hash)
+            await self.send_msg('getmnlistd', msg.serialize())
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        finally:
+            if self.mnlistd_requests.get(key) is fut:
+                del self.mnlistd_requests[key]
@@ -1,5 +1,6 @@
 import asyncio
 import copy
+import heapq
 import logging
 import re
 import random
@@ -193,6 +194,10 @@ KP_ALL_TYPES = [KP_INCOMING, KP_SPENDABLE,
                 KP_PS_SPENDABLE, KP_PS_COINS, KP_PS_CHANGE]
 KP_MAX_INCOMING_TXS = 5             # max count of txs to split on denoms
                                     # need to calc keypairs count to cache
+KP_BATCH_SIZE = 100                 # private keys derived per keystore call
+KP_REFILL_TYPES = [KP_PS_COINS, KP_PS_CHANGE]
+KP_REFILL_RATIO = 0.5               # refill when below ratio of target count
+KP_REFILL_INTERVAL = 10             # secs between checks of keypairs refill
 
 
 # Keypairs cache states
@@ -830,7 +835,7 @@ class PSManager(Logger):
         self._state = PSStates.Unsupported
         self.wallet_types_supported = ['standard']
         self.keystore_types_supported = ['bip32', 'hardware']
-        keystore = wallet.db.get('keystore')
+        keystore = wallet.db.get_view('keystore')
         self._allow_others = DEFAULT_ALLOW_OTHERS
         if keystore:
             self.w_ks_type = keystore.get('type', 'unknown')
@@ -868,6 +873,8 @@ class PSManager(Logger):
         self.keypairs_state_lock = threading.Lock()
         self._keypairs_state = KPStates.Empty
         self._keypairs_cache = {}
+        self._keypairs_targets = {}  # cache_type -> keypairs count to keep
+        self._keypairs_stats = Counter()
 
         self.callback_lock = threading.Lock()
         self.callbacks = defaultdict(list)
@@ -1008,7 +1015,7 @@ class PSManager(Logger):
             raise Exception(f'can not create ps_keystore when main keystore'
                             f' type: "{self.w_ks_type}"')
         w = self.wallet
-        if w.storage.get('ps_keystore', {}):
+        if w.storage.get_view('ps_keystore', {}):
             raise Exception('ps_keystore already exists')
         keystore = from_seed(seed, seed_ext, False)
         keystore.update_password(None, password)
@@ -1110,6 +1117,7 @@ class PSManager(Logger):
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        prederived = False
         while True:
             if for_change:
                 addrs = self.get_change_addresses()
@@ -1117,6 +1125,10 @@ class PSManager(Logger):
                 addrs = self.get_receiving_addresses()
             num_addrs = len(addrs)
             if num_addrs < limit:
+                if not prederived:
+                    self.ps_keystore.derive_pubkeys(
+                        for_change, range(num_addrs, limit))
+                    prederived = True
                 self.create_new_address(for_change)
                 continue
             last_few_addresses = addrs[-limit:]
@@ -1594,6 +1606,7 @@ class PSManager(Logger):
 
     def add_ps_denom(self, outpoint, denom):  # denom is (addr, value, rounds)
         self.wallet.db._add_ps_denom(outpoint, denom)
+        self.wallet._mark_addr_balance_changed(denom[0])
         self._ps_denoms_amount_cache += denom[1]
         if denom[2] < self.mix_rounds:  # if rounds < mix_rounds
             self._denoms_to_mix_cache[outpoint] = denom
@@ -1601,6 +1614,7 @@ class PSManager(Logger):
     def pop_ps_denom(self, outpoint):
         denom = self.wallet.db._pop_ps_denom(outpoint)
         if denom:
+            self.wallet._mark_addr_balance_changed(denom[0])
             self._ps_denoms_amount_cache -= denom[1]
             self._denoms_to_mix_cache.pop(outpoint, None)
         return denom
@@ -1878,6 +1892,14 @@ class PSManager(Logger):
                     cnt = len(self._keypairs_cache[cache_type])
                     res.append(f'Keypairs cache type: {cache_type}'
                                f' cached keys: {cnt}')
+        kp_stats = self.keypairs_stats
+        if kp_stats['derived']:
+            res.append(f'Keypairs derived: {kp_stats["derived"]},'
+                       f' refills: {kp_stats["refills"]},'
+                       f' last refill time: {kp_stats["refill_time"]:.3f}s')
+        if kp_stats['hits'] or kp_stats['misses']:
+            res.append(f'Keypairs signing hits: {kp_stats["hits"]},'
+                       f' misses: {kp_stats["misses"]}')
         return res
 
     def mixing_progress(self, count_on_rounds=None):
@@ -1958,8 +1980,28 @@ class PSManager(Logger):
                 except Exception as e:
                     self.logger.info(f'_make_keypairs_cache: {str(e)}')
                     self._cleanup_unfinished_keypairs_cache()
-                return
+                    return
+                break
             await asyncio.sleep(1)
+        # refill keypairs used by mixing, to not stop on lack of keys
+        _refill = self._refill_keypairs
+        while self.state == PSStates.Mixing:
+            await asyncio.sleep(KP_REFILL_INTERVAL)
+            if self.keypairs_state != KPStates.Ready:
+                continue
+            if not self.need_keypairs_refill():
+                continue
+            try:
+                refilled = await self.loop.run_in_executor(None, _refill,
+                                                           password)
+            except Exception as e:
+                # cache is still usable by mixing, only refill is stopped
+                self.logger.info(f'_refill_keypairs: {str(e)}')
+                return
+            if refilled is None:  # mixing is stopped
+                return
+            if self.keypairs_state == KPStates.Ready:
+                self._merge_refilled_keypairs(refilled)
 
     def calc_need_sign_cnt(self, new_denoms_cnt):
         w = self.wallet
@@ -2080,6 +2122,7 @@ class PSManager(Logger):
 
     def _cache_keypairs(self, password):
         self.logger.info('Making Keyparis Cache')
+        start_time = time.time()
         with self.keypairs_state_lock:
             self.keypairs_state = KPStates.Caching
 
@@ -2097,7 +2140,8 @@ class PSManager(Logger):
             self.calc_need_new_keypairs_cnt()
 
         if not self.is_hw_ks and small_mix_funds:
-            self._cache_kp_incoming(password)
+            if not self._cache_kp_incoming(password):
+                return
 
         kp_left, kp_chg_left = self._cache_kp_ps_reserved(password,
                                                           kp_left, kp_chg_left)
@@ -2121,21 +2165,121 @@ class PSManager(Logger):
             if kp_left is None:
                 return
 
+        for cache_type in KP_REFILL_TYPES:
+            self._keypairs_targets[cache_type] = \
+                len(self._keypairs_cache[cache_type])
+        self._keypairs_stats['cache_time'] = time.time() - start_time
         with self.keypairs_state_lock:
             self.keypairs_state = KPStates.Ready
         self.logger.info('Keyparis Cache Done')
 
+    @property
+    def keypairs_stats(self):
+        return self._keypairs_stats
+
+    def need_keypairs_refill(self):
+        for cache_type in KP_REFILL_TYPES:
+            target = self._keypairs_targets.get(cache_type, 0)
+            cnt = len(self._keypairs_cache.get(cache_type, {}))
+            if cnt < target * KP_REFILL_RATIO:
+                return True
+        return False
+
+    def _refill_keypairs(self, password):
+        '''Derive keypairs to top up ps coins/ps change caches to targets
+        from initial caching. Mixing continues to use and move cached
+        keypairs meanwhile, so keys are derived to separate dicts, which
+        are merged on the loop thread by _merge_refilled_keypairs.
+        Return None if mixing is stopped, cache is left untouched.'''
+        start_time = time.time()
+        refilled = {}
+        for cache_type, for_change in [(KP_PS_CHANGE, True),
+                                       (KP_PS_COINS, False)]:
+            cache = self._keypairs_cache.get(cache_type)
+            target = self._keypairs_targets.get(cache_type, 0)
+            if cache is None or not target:
+                continue
+            derivations = self._get_kp_ps_addrs_derivations(cache,
+                                                            for_change,
+                                                            target)[0]
+            if derivations is None:
+                return None
+            keypairs = refilled[cache_type] = {}
+            if not self._derive_keypairs(keypairs, derivations, password,
+                                         cleanup_on_stop=False):
+                return None
+        self._keypairs_stats['refill_time'] = time.time() - start_time
+        return refilled
+
+    def _merge_refilled_keypairs(self, refilled):
+        '''Add keypairs from _refill_keypairs to the cache, skipping
+        addresses used or moved to other cache types meanwhile'''
+        w = self.wallet
+        caches = [self._keypairs_cache[cache_type]
+                  for cache_type in KP_ALL_TYPES
+                  if cache_type in self._keypairs_cache]
+        added = 0
+        for cache_type, keypairs in refilled.items():
+            cache = self._keypairs_cache.get(cache_type)
+            if cache is None:
+                continue
+            for addr, keypair in keypairs.items():
+                if w.is_used(addr) or any(addr in c for c in caches):
+                    continue
+                cache[addr] = keypair
+                added += 1
+        self._keypairs_stats['refills'] += 1
+        self.logger.info(f'Keyparis Cache Refilled with {added} keys')
+        if added:
+            self.postpone_notification('ps-keypairs-changes', self.wallet)
+
+    def _get_kp_derivation(self, addr):
+        '''Return keystore, sequence and x_pubkey for address'''
+        w = self.wallet
+        sequence = None
+        if self.ps_keystore:
+            sequence = self.get_address_index(addr)
+        if sequence:
+            ks = self.ps_keystore
+        else:
+            ks = w.keystore
+            sequence = w.get_address_index(addr)
+        return ks, sequence, ks.get_xpubkey(*sequence)
+
+    def _derive_keypairs(self, cache, derivations, password,
+                         cleanup_on_stop=True):
+        '''Derive keys for list of (addr, keystore, sequence, x_pubkey)
+        in batches to cache, return False if mixing is stopped'''
+        start_time = time.time()
+        by_keystore = defaultdict(list)
+        for d in derivations:
+            by_keystore[id(d[1])].append(d)
+        for ks_derivations in by_keystore.values():
+            ks = ks_derivations[0][1]
+            for i in range(0, len(ks_derivations), KP_BATCH_SIZE):
+                if self.state != PSStates.Mixing:
+                    if cleanup_on_stop:
+                        self._cleanup_unfinished_keypairs_cache()
+                    return False
+                batch = ks_derivations[i:i+KP_BATCH_SIZE]
+                secs = ks.get_private_keys([d[2] for d in batch], password)
+                for (addr, _, _, x_pubkey), sec in zip(batch, secs):
+                    cache[addr] = (x_pubkey, sec)
+        self._keypairs_stats['derived'] += len(derivations)
+        self._keypairs_stats['derive_time'] += time.time() - start_time
+        return True
+
     def _cache_kp_incoming(self, password):
         w = self.wallet
         first_recv_index = self.first_unused_index(for_change=False,
                                                    force_main_ks=True)
         ps_incoming_cache = self._keypairs_cache[KP_INCOMING]
-        cached = 0
+        derivations = []
         ri = first_recv_index
-        while cached < KP_MAX_INCOMING_TXS:
+        while len(derivations) < KP_MAX_INCOMING_TXS:
             if self.state != PSStates.Mixing:
                 self._cleanup_unfinished_keypairs_cache()
-                return
+                return False
             sequence = [0, ri]
             x_pubkey = w.keystore.get_xpubkey(*sequence)
             _, addr = xpubkey_to_address(x_pubkey)
@@ -2144,56 +2288,47 @@ class PSManager(Logger):
                 continue
             if addr in ps_incoming_cache:
                 continue
-            sec = w.keystore.get_private_key(sequence, password)
-            ps_incoming_cache[addr] = (x_pubkey, sec)
-            cached += 1
-        self.logger.info(f'Cached {cached} keys'
+            derivations.append((addr, w.keystore, sequence, x_pubkey))
+        if not self._derive_keypairs(ps_incoming_cache, derivations, password):
+            return False
+        self.logger.info(f'Cached {len(derivations)} keys'
                          f' of {KP_INCOMING} type')
         self.postpone_notification('ps-keypairs-changes', self.wallet)
+        return True
 
     def _cache_kp_spendable(self, password):
         '''Cache spendable regular coins keys'''
         w = self.wallet
-        cached = 0
+        spendable_cache = self._keypairs_cache[KP_SPENDABLE]
+        derivations = []
         utxos = w.get_utxos(None,
                             excluded_addresses=w.frozen_addresses,
                             mature_only=True)
         utxos = [utxo for utxo in utxos if not w.is_frozen_coin(utxo)]
         if self.is_hw_ks:
             utxos = [utxo for utxo in utxos if utxo['is_ps_ks']]
+        addrs = set()
         for c in utxos:
-            if self.state != PSStates.Mixing:
-                self._cleanup_unfinished_keypairs_cache()
-                return
             addr = c['address']
-            if addr in self._keypairs_cache[KP_SPENDABLE]:
+            if addr in spendable_cache or addr in addrs:
                 continue
-            sequence = None
-            if self.ps_keystore:
-                sequence = self.get_address_index(addr)
-            if sequence:
-                x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                sec = self.ps_keystore.get_private_key(sequence, password)
-            else:
-                sequence = w.get_address_index(addr)
-                x_pubkey = w.keystore.get_xpubkey(*sequence)
-                sec = w.keystore.get_private_key(sequence, password)
-            self._keypairs_cache[KP_SPENDABLE][addr] = (x_pubkey, sec)
-            cached += 1
-        if cached:
-            self.logger.info(f'Cached {cached} keys of {KP_SPENDABLE} type')
+            addrs.add(addr)
+            derivations.append((addr, *self._get_kp_derivation(addr)))
+        if not self._derive_keypairs(spendable_cache, derivations, password):
+            return
+        if derivations:
+            self.logger.info(f'Cached {len(derivations)} keys'
+                             f' of {KP_SPENDABLE} type')
             self.postpone_notification('ps-keypairs-changes', self.wallet)
         return True
 
     def _cache_kp_ps_spendable(self, password):
         '''Cache spendable ps coins keys (existing denoms/collaterals)'''
         w = self.wallet
-        cached = 0
         ps_spendable_cache = self._keypairs_cache[KP_PS_SPENDABLE]
+        derivations = []
+        addrs = set()
         for c in w.get_utxos(None, min_rounds=PSCoinRounds.COLLATERAL):
-            if self.state != PSStates.Mixing:
-                self._cleanup_unfinished_keypairs_cache()
-                return
             prev_h = c['prevout_hash']
             prev_n = c['prevout_n']
             outpoint = f'{prev_h}:{prev_n}'
@@ -2203,22 +2338,16 @@ class PSManager(Logger):
             addr = c['address']
             if self.is_hw_ks and not self.is_ps_ks(addr):
                 continue  # skip denoms on hw keystore
-            if addr in ps_spendable_cache:
+            if addr in ps_spendable_cache or addr in addrs:
                 continue
-            sequence = None
-            if self.ps_keystore:
-                sequence = self.get_address_index(addr)
-            if sequence:
-                x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                sec = self.ps_keystore.get_private_key(sequence, password)
-            else:
-                sequence = w.get_address_index(addr)
-                x_pubkey = w.keystore.get_xpubkey(*sequence)
-                sec = w.keystore.get_private_key(sequence, password)
-            ps_spendable_cache[addr] = (x_pubkey, sec)
-            cached += 1
-        if cached:
-            self.logger.info(f'Cached {cached} keys of {KP_PS_SPENDABLE} type')
+            addrs.add(addr)
+            derivations.append((addr, *self._get_kp_derivation(addr)))
+        if not self._derive_keypairs(ps_spendable_cache, derivations,
+                                     password):
+            return
+        if derivations:
+            self.logger.info(f'Cached {len(derivations)} keys'
+                             f' of {KP_PS_SPENDABLE} type')
             self.postpone_notification('ps-keypairs-changes', self.wallet)
         return True
 
@@ -2226,11 +2355,9 @@ class PSManager(Logger):
         w = self.wallet
         ps_change_cache = self._keypairs_cache[KP_PS_CHANGE]
         ps_coins_cache = self._keypairs_cache[KP_PS_COINS]
-        cached = 0
+        change_derivations = []
+        coins_derivations = []
         for addr, data in self.wallet.db.get_ps_reserved().items():
-            if self.state != PSStates.Mixing:
-                self._cleanup_unfinished_keypairs_cache()
-                return None, None
             if w.is_used(addr):
                 continue
             if self.is_hw_ks and not self.is_ps_ks(addr):
@@ -2239,131 +2366,89 @@ class PSManager(Logger):
                 sign_change_cnt -= 1
                 if addr in ps_change_cache:
                     continue
-                sequence = None
-                if self.ps_keystore:
-                    sequence = self.get_address_index(addr)
-                if sequence:
-                    x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                    sec = self.ps_keystore.get_private_key(sequence, password)
-                else:
-                    sequence = w.get_address_index(addr)
-                    x_pubkey = w.keystore.get_xpubkey(*sequence)
-                    sec = w.keystore.get_private_key(sequence, password)
-                ps_change_cache[addr] = (x_pubkey, sec)
-                cached += 1
+                change_derivations.append((addr,
+                                           *self._get_kp_derivation(addr)))
             else:
                 sign_cnt -= 1
                 if addr in ps_coins_cache:
                     continue
-                sequence = None
-                if self.ps_keystore:
-                    sequence = self.get_address_index(addr)
-                if sequence:
-                    x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                    sec = self.ps_keystore.get_private_key(sequence, password)
-                else:
-                    sequence = w.get_address_index(addr)
-                    x_pubkey = w.keystore.get_xpubkey(*sequence)
-                    sec = w.keystore.get_private_key(sequence, password)
-                ps_coins_cache[addr] = (x_pubkey, sec)
-                cached += 1
+                coins_derivations.append((addr,
+                                          *self._get_kp_derivation(addr)))
+        if not self._derive_keypairs(ps_change_cache, change_derivations,
+                                     password):
+            return None, None
+        if not self._derive_keypairs(ps_coins_cache, coins_derivations,
+                                     password):
+            return None, None
+        cached = len(change_derivations) + len(coins_derivations)
         if cached:
             self.logger.info(f'Cached {cached} keys for ps_reserved addresses')
             self.postpone_notification('ps-keypairs-changes', self.wallet)
         return sign_cnt, sign_change_cnt
 
+    def _get_kp_ps_addrs_derivations(self, cache, for_change, sign_cnt):
+        '''Return derivations of keys not in cache for sign_cnt unused
+        addresses from first unused and sign_cnt left,
+        derivations is None if mixing is stopped'''
+        w = self.wallet
+        ks = self.ps_keystore if self.ps_keystore else w.keystore
+        derivations = []
+        i = self.first_unused_index(for_change=for_change)
+        while sign_cnt > 0:
+            if self.state != PSStates.Mixing:
+                return None, sign_cnt
+            sequence = [int(for_change), i]
+            x_pubkey = ks.get_xpubkey(*sequence)
+            _, addr = xpubkey_to_address(x_pubkey)
+            i += 1
+            if w.is_used(addr):
+                continue
+            sign_cnt -= 1
+            if addr in cache:
+                continue
+            derivations.append((addr, ks, sequence, x_pubkey))
+        return derivations, sign_cnt
+
+    def _cache_kp_ps_addrs(self, password, cache_type, for_change, sign_cnt):
+        '''Cache keys for sign_cnt unused addresses from first unused'''
+        cache = self._keypairs_cache[cache_type]
+        derivations, sign_cnt = \
+            self._get_kp_ps_addrs_derivations(cache, for_change, sign_cnt)
+        if derivations is None:
+            self._cleanup_unfinished_keypairs_cache()
+            return None
+        if not self._derive_keypairs(cache, derivations, password):
+            return None
+        if derivations:
+            self.logger.info(f'Cached {len(derivations)} keys'
+                             f' of {cache_type} type')
+            self.postpone_notification('ps-keypairs-changes', self.wallet)
+        return sign_cnt
+
     def _cache_kp_ps_change(self, password, sign_cnt, sign_change_cnt):
         if sign_change_cnt > 0:
-            w = self.wallet
-            first_change_index = self.first_unused_index(for_change=True)
-            ps_change_cache = self._keypairs_cache[KP_PS_CHANGE]
-            cached = 0
-            ci = first_change_index
-            while sign_change_cnt > 0:
-                if self.state != PSStates.Mixing:
-                    self._cleanup_unfinished_keypairs_cache()
-                    return None, None
-                sequence = [1, ci]
-                if self.ps_keystore:
-                    x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                else:
-                    x_pubkey = w.keystore.get_xpubkey(*sequence)
-                _, addr = xpubkey_to_address(x_pubkey)
-                ci += 1
-                if w.is_used(addr):
-                    continue
-                sign_change_cnt -= 1
-                if addr in ps_change_cache:
-                    continue
-                if self.ps_keystore:
-                    sec = self.ps_keystore.get_private_key(sequence, password)
-                else:
-                    sec = w.keystore.get_private_key(sequence, password)
-                ps_change_cache[addr] = (x_pubkey, sec)
-                cached += 1
-                if not cached % 100:
-                    self.logger.info(f'Cached {cached} keys'
-                                     f' of {KP_PS_CHANGE} type')
-            if cached:
-                self.logger.info(f'Cached {cached} keys'
-                                 f' of {KP_PS_CHANGE} type')
-                self.postpone_notification('ps-keypairs-changes', self.wallet)
+            sign_change_cnt = self._cache_kp_ps_addrs(password, KP_PS_CHANGE,
+                                                      True, sign_change_cnt)
+            if sign_change_cnt is None:
+                return None, None
         return sign_cnt, sign_change_cnt
 
     def _cache_kp_ps_coins(self, password, sign_cnt, sign_change_cnt):
         if sign_cnt > 0:
-            w = self.wallet
-            first_recv_index = self.first_unused_index(for_change=False)
-            ps_coins_cache = self._keypairs_cache[KP_PS_COINS]
-            cached = 0
-            ri = first_recv_index
-            while sign_cnt > 0:
-                if self.state != PSStates.Mixing:
-                    self._cleanup_unfinished_keypairs_cache()
-                    return None, None
-                sequence = [0, ri]
-                if self.ps_keystore:
-                    x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-                else:
-                    x_pubkey = w.keystore.get_xpubkey(*sequence)
-                _, addr = xpubkey_to_address(x_pubkey)
-                ri += 1
-                if w.is_used(addr):
-                    continue
-                sign_cnt -= 1
-                if addr in ps_coins_cache:
-                    continue
-                if self.ps_keystore:
-                    sec = self.ps_keystore.get_private_key(sequence, password)
-                else:
-                    sec = w.keystore.get_private_key(sequence, password)
-                ps_coins_cache[addr] = (x_pubkey, sec)
-                cached += 1
-                if not cached % 100:
-                    self.logger.info(f'Cached {cached} keys'
-                                     f' of {KP_PS_COINS} type')
-            if cached:
-                self.logger.info(f'Cached {cached} keys'
-                                 f' of {KP_PS_COINS} type')
-                self.postpone_notification('ps-keypairs-changes', self.wallet)
+            sign_cnt = self._cache_kp_ps_addrs(password, KP_PS_COINS,
+                                               False, sign_cnt)
+            if sign_cnt is None:
+                return None, None
         return sign_cnt, sign_change_cnt
 
     def _cache_kp_tmp_reserved(self, password):
-        w = self.wallet
         addr = self.get_tmp_reserved_address()
         if not addr:
             return False
-        if self.ps_keystore:
-            sequence = self.get_address_index(addr)
-        if sequence:
-            x_pubkey = self.ps_keystore.get_xpubkey(*sequence)
-            sec = self.ps_keystore.get_private_key(sequence, password)
-        else:
-            sequence = w.get_address_index(addr)
-            x_pubkey = w.keystore.get_xpubkey(*sequence)
-            sec = w.keystore.get_private_key(sequence, password)
         spendable_cache = self._keypairs_cache[KP_SPENDABLE]
-        spendable_cache[addr] = (x_pubkey, sec)
+        derivations = [(addr, *self._get_kp_derivation(addr))]
+        if not self._derive_keypairs(spendable_cache, derivations, password):
+            return False
         self.logger.info(f'Cached key of {KP_SPENDABLE} type'
                          f' for tmp reserved address')
         self.postpone_notification('ps-keypairs-changes', self.wallet)
@@ -2375,12 +2460,11 @@ class PSManager(Logger):
             return False
 
     def _find_addrs_not_in_keypairs(self, addrs):
-        addrs = set(addrs)
-        keypairs_addrs = set()
-        for cache_type in KP_ALL_TYPES:
-            if cache_type in self._keypairs_cache:
-                keypairs_addrs |= self._keypairs_cache[cache_type].keys()
-        return addrs - keypairs_addrs
+        caches = [self._keypairs_cache[cache_type]
+                  for cache_type in KP_ALL_TYPES
+                  if cache_type in self._keypairs_cache]
+        return set([addr for addr in addrs
+                    if not any(addr in cache for cache in caches)])
 
     def unpack_mine_input_addrs(func):
         '''Decorator to prepare tx inputs addresses'''
@@ -2391,9 +2475,9 @@ class PSManager(Logger):
                 prev_h = i['prevout_hash']
                 prev_n = i['prevout_n']
                 outpoint = f'{prev_h}:{prev_n}'
-                prev_tx = w.db.get_transaction(prev_h)
+                prev_tx = w.db.get_tx_summary(prev_h)
                 if prev_tx:
-                    o = prev_tx.outputs()[prev_n]
+                    o = prev_tx.outputs[prev_n]
                     if w.is_mine(o.address):
                         inputs.append((outpoint, o.address))
             return func(self, txid, tx_type, inputs, tx.outputs())
@@ -2459,6 +2543,7 @@ class PSManager(Logger):
             self.logger.info('Cleaned Keyparis Cache')
 
     def _cleanup_all_keypairs_cache(self):
+        self._keypairs_targets.clear()
         if not self._keypairs_cache:
             return
         for cache_type in KP_ALL_TYPES:
@@ -2468,12 +2553,17 @@ class PSManager(Logger):
                 self._keypairs_cache[cache_type].pop(addr)
             self._keypairs_cache.pop(cache_type)
 
-    def get_keypairs(self):
+    def get_keypairs(self, addrs=None):
         keypairs = {}
         for cache_type in KP_ALL_TYPES:
-            if cache_type not in self._keypairs_cache:
+            cache = self._keypairs_cache.get(cache_type)
+            if not cache:
                 continue
-            for x_pubkey, sec in self._keypairs_cache[cache_type].values():
+            if addrs is None:
+                cached = cache.values()
+            else:
+                cached = [cache[addr] for addr in addrs if addr in cache]
+            for x_pubkey, sec in cached:
                 keypairs[x_pubkey] = sec
         return keypairs
 
@@ -2487,12 +2577,16 @@ class PSManager(Logger):
         if self._keypairs_cache:
             if mine_txins_cnt is None:
                 self.add_tx_inputs_info(tx)
-            keypairs = self.get_keypairs()
+            addrs = set([txin.get('address') for txin in tx.inputs()])
+            keypairs = self.get_keypairs(addrs)
             signed_txins_cnt = tx.sign(keypairs)
             keypairs.clear()
             if mine_txins_cnt is None:
                 mine_txins_cnt = len(tx.inputs())
+            self._keypairs_stats['hits'] += signed_txins_cnt
             if signed_txins_cnt < mine_txins_cnt:
+                self._keypairs_stats['misses'] += (mine_txins_cnt -
+                                                   signed_txins_cnt)
                 self.logger.debug(f'mine txins cnt: {mine_txins_cnt},'
                                   f' signed txins cnt: {signed_txins_cnt}')
                 raise SignWithKeypairsFailed('Tx signing failed')
@@ -3382,7 +3476,7 @@ class PSManager(Logger):
         w = self.wallet
         if wfl.tx_order:
             for txid in wfl.tx_order[::-1]:  # use reversed tx_order
-                if w.db.get_transaction(txid):
+                if w.db.has_transaction(txid):
                     w.remove_transaction(txid)
                 else:
                     self._cleanup_pay_collateral_wfl_tx_data(txid)
@@ -3710,7 +3804,7 @@ class PSManager(Logger):
         w = self.wallet
         if wfl.tx_order:
             for txid in wfl.tx_order[::-1]:  # use reversed tx_order
-                if w.db.get_transaction(txid):
+                if w.db.has_transaction(txid):
                     w.remove_transaction(txid)
                 else:
                     self._cleanup_new_collateral_wfl_tx_data(txid)
@@ -4075,7 +4169,7 @@ class PSManager(Logger):
         w = self.wallet
         if wfl.tx_order:
             for txid in wfl.tx_order[::-1]:  # use reversed tx_order
-                if w.db.get_transaction(txid):
+                if w.db.has_transaction(txid):
                     w.remove_transaction(txid)
                 else:
                     self._cleanup_new_denoms_wfl_tx_data(txid)
@@ -4592,10 +4686,10 @@ class PSManager(Logger):
                 icnt += 1
                 prev_h = i['prevout_hash']
                 prev_n = i['prevout_n']
-                prev_tx = w.db.get_transaction(prev_h)
+                prev_tx = w.db.get_tx_summary(prev_h)
                 tx_type = w.db.get_ps_tx(prev_h)[0]
                 if prev_tx:
-                    o = prev_tx.outputs()[prev_n]
+                    o = prev_tx.outputs[prev_n]
                     if w.is_mine(o.address):  # mine
                         inputs.append((o, prev_h, prev_n, True, tx_type))
                         mine_icnt += 1
@@ -5619,6 +5713,7 @@ class PSManager(Logger):
                     self.trigger_callback('ps-state-changes', w, None, None)
                     self.logger.info(f'Clearing PrivateSend wallet data')
                     w.db.clear_ps_data()
+                    w.reset_balance_ledger()
                     self.state = PSStates.Ready
                     self.logger.info(f'All PrivateSend wallet data cleared')
             return msg
@@ -5705,53 +5800,82 @@ class PSManager(Logger):
         if found:
             self.postpone_notification('ps-data-changes', w)
 
-    def _get_simplified_history(self):
+    def _get_tx_history_sort_key(self, txid):
         w = self.wallet
-        history = []
-        for txid in w.db.list_transactions():
-            tx = w.db.get_transaction(txid)
-            tx_type, completed = w.db.get_ps_tx(txid)
-            islock = w.db.get_islock(txid)
-            if islock:
-                tx_mined_status = w.get_tx_height(txid)
-                islock_sort = txid if not tx_mined_status.conf else ''
-            else:
-                islock_sort = ''
-            history.append((txid, tx, tx_type, islock, islock_sort))
-        history.sort(key=lambda x: (w.get_txpos(x[0], x[3]), x[4]))
-        return history
+        islock = w.db.get_islock(txid)
+        if islock:
+            tx_mined_status = w.get_tx_height(txid)
+            islock_sort = txid if not tx_mined_status.conf else ''
+        else:
+            islock_sort = ''
+        return (w.get_txpos(txid, islock), islock_sort)
+
+    def _get_spending_txids(self, txid):
+        w = self.wallet
+        return set([w.db.get_spent_outpoint(txid, n)
+                    for n in w.db.get_spent_outpoints(txid)])
+
+    def _get_untracked_candidates(self, txids):
+        '''Return not PS txids not checked by previous scans
+        and not PS txids spending outputs of them'''
+        w = self.wallet
+        scanned = w.db.get_ps_scanned_txs()
+        candidates = set()
+        for txid in txids:
+            if txid in scanned:
+                continue
+            candidates.add(txid)
+            candidates |= self._get_spending_txids(txid)
+        return set([txid for txid in candidates
+                    if not w.db.get_ps_tx(txid)[0]])
 
     @profiler
     def _find_untracked_ps_txs(self, log):
         if log:
             self.logger.info(f'Finding untracked PrivateSend transactions')
-        history = self._get_simplified_history()
-        all_detected_txs = set()
+        w = self.wallet
+        txids = w.db.list_transactions()
+        sort_key = self._get_tx_history_sort_key
+        candidates = self._get_untracked_candidates(txids)
+        # process txs in history order, when tx is detected its children
+        # are queued again, as they can be detected by parent ps data
+        queue = [(sort_key(txid), txid) for txid in candidates]
+        heapq.heapify(queue)
+        queued = set(candidates)
+        not_detected = set()
         found = 0
-        while True:
-            detected_txs = set()
-            not_detected_parents = set()
-            for txid, tx, tx_type, islock, islock_sort in history:
-                if tx_type or txid in all_detected_txs:  # already found
-                    continue
-                tx_type = self._check_ps_tx_type(txid, tx, find_untracked=True)
-                if tx_type:
-                    self._add_ps_data(txid, tx, tx_type)
-                    type_name = SPEC_TX_NAMES[tx_type]
-                    if log:
-                        self.logger.info(f'Found {type_name} {txid}')
-                    found += 1
-                    detected_txs.add(txid)
-                else:
-                    parents = set([i['prevout_hash'] for i in tx.inputs()])
-                    not_detected_parents |= parents
-            all_detected_txs |= detected_txs
-            if not detected_txs & not_detected_parents:
-                break
+        while queue:
+            tx_sort_key, txid = heapq.heappop(queue)
+            queued.discard(txid)
+            tx_type, completed = w.db.get_ps_tx(txid)
+            if tx_type:  # already found
+                continue
+            tx = w.db.get_transaction(txid)
+            if not tx:
+                continue
+            tx_type = self._check_ps_tx_type(txid, tx, find_untracked=True)
+            if tx_type:
+                self._add_ps_data(txid, tx, tx_type)
+                type_name = SPEC_TX_NAMES[tx_type]
+                if log:
+                    self.logger.info(f'Found {type_name} {txid}')
+                found += 1
+                not_detected.discard(txid)
+                for child_txid in self._get_spending_txids(txid):
+                    if child_txid in queued:
+                        continue
+                    if w.db.get_ps_tx(child_txid)[0]:
+                        continue
+                    heapq.heappush(queue, (sort_key(child_txid), child_txid))
+                    queued.add(child_txid)
+            else:
+                not_detected.add(txid)
         # last iteration to detect PS Other Coins not found before other ps txs
-        for txid, tx, tx_type, islock, islock_sort in history:
-            if tx_type or txid in all_detected_txs:  # already found
+        for txid in sorted(not_detected, key=sort_key):
+            tx_type, completed = w.db.get_ps_tx(txid)
+            if tx_type:  # already found
                 continue
+            tx = w.db.get_transaction(txid)
             tx_type = self._check_ps_tx_type(txid, tx, find_untracked=True,
                                              last_iteration=True)
             if tx_type:
@@ -5760,6 +5884,7 @@ class PSManager(Logger):
                 if log:
                     self.logger.info(f'Found {type_name} {txid}')
                 found += 1
+        w.db.add_ps_scanned_txs(txids)
         if not found and log:
             self.logger.info(f'No untracked PrivateSend'
                              f' transactions found')
@@ -5772,12 +5897,12 @@ class PSManager(Logger):
             return
 
         prev_txid = c['prevout_hash']
-        prev_tx = w.db.get_transaction(prev_txid)
+        prev_tx = w.db.get_tx_summary(prev_txid)
         if not prev_tx:
             return
 
-        inputs = prev_tx.inputs()
-        outputs = prev_tx.outputs()
+        inputs = prev_tx.inputs
+        outputs = prev_tx.outputs
         inputs_cnt = len(inputs)
         outputs_cnt = len(outputs)
         if inputs_cnt != outputs_cnt:
@@ -5799,10 +5924,9 @@ class PSManager(Logger):
             return True
 
         dval_inputs_cnt = 0
-        for prev_txin in prev_tx.inputs():
+        for prev_txin_txid, prev_txin_n in inputs:
             is_denominate_input = False
             try:
-                prev_txin_txid = prev_txin['prevout_hash']
                 prev_txin_tx = w.get_input_tx(prev_txin_txid)
                 if not prev_txin_tx:
                     return
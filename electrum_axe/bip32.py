@@ -3,11 +3,12 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import hashlib
-from typing import List, Tuple, NamedTuple, Union, Iterable
+from typing import List, Tuple, NamedTuple, Union, Iterable, Sequence
 
 from .util import bfh, bh2u, BitcoinException
 from . import constants
 from . import ecc
+from . import ecc_fast
 from .crypto import hash_160, hmac_oneshot
 from .bitcoin import rev_hex, int_to_hex, EncodeBase58Check, DecodeBase58Check
 from .logging import get_logger
@@ -96,6 +97,43 @@ def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes)
     return child_pubkey, child_chaincode
 
 
+def CKD_pub_batch(parent_pubkey: bytes, parent_chaincode: bytes,
+                  child_indexes: Sequence[int]) -> List[bytes]:
+    """Child public keys derivation for several non-hardened indexes
+    of the same parent. The parent pubkey is parsed only once and
+    libsecp256k1 tweak-add is used if available.
+    Returns child pubkeys only, in order of child_indexes.
+    """
+    tweaks = []
+    for child_index in child_indexes:
+        if child_index < 0: raise ValueError('the bip32 index needs to be non-negative')
+        if child_index & BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+        I = hmac_oneshot(parent_chaincode,
+                         parent_pubkey + child_index.to_bytes(4, 'big'),
+                         hashlib.sha512)
+        tweaks.append(I[0:32])
+    if ecc_fast.is_using_fast_ecc():
+        res = ecc_fast.pubkey_tweak_add_batch(parent_pubkey, tweaks)
+    else:
+        res = []
+        parent = ecc.ECPubkey(parent_pubkey)
+        for tweak in tweaks:
+            try:
+                pubkey = ecc.ECPrivkey(tweak) + parent
+            except ecc.InvalidECPointException:
+                res.append(None)
+                continue
+            if pubkey.is_at_infinity():
+                res.append(None)
+                continue
+            res.append(pubkey.get_public_key_bytes(compressed=True))
+    for i, child_pubkey in enumerate(res):
+        if child_pubkey is None:  # let CKD_pub skip the invalid index
+            res[i] = CKD_pub(parent_pubkey, parent_chaincode,
+                             child_indexes[i])[0]
+    return res
+
+
 def xprv_header(xtype: str, *, net=None) -> bytes:
     if net is None:
         net = constants.net
@@ -20,9 +20,11 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import mmap
 import os
 import threading
-from typing import Optional, Dict, Mapping, Sequence
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Mapping, Sequence, Tuple, List
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -41,6 +43,7 @@ MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 POW_TARGET_SPACING = int(2.5 * 60)  # Axe: 2.5 minutes
 POW_DGW3_HEIGHT = 68589
 DGW_PAST_BLOCKS = 24
+HEADERS_CACHE_SIZE = 2 * 2016  # decoded headers kept per chain
 
 
 class MissingHeader(Exception):
@@ -86,6 +89,116 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(PoWHash(bfh(header)))
 
 
+def hash_raw_headers(data: bytes) -> List[str]:
+    """Hashes of the consecutive raw headers in data. Being a module level
+    function of bytes, it can be run in a process pool."""
+    return [hash_encode(PoWHash(data[i:i+HEADER_SIZE]))
+            for i in range(0, len(data) // HEADER_SIZE * HEADER_SIZE, HEADER_SIZE)]
+
+
+class HeaderStore:
+    """Read side of a headers file: a persistent read-only mmap of the
+    file and a bounded LRU of decoded headers and their hashes, keyed
+    by height. Appending to the file is fine; the owning Blockchain must
+    call invalidate() before it overwrites, truncates or moves it."""
+
+    def __init__(self, max_size: int = HEADERS_CACHE_SIZE):
+        self.max_size = max_size
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._cache = OrderedDict()  # type: Dict[int, Tuple[dict, Optional[str]]]
+
+    def read_raw(self, path: str, offset: int) -> bytes:
+        # the file only grows between invalidations, so a read past
+        # the mapped length means headers were appended since mapping
+        if self._mmap is None or offset + HEADER_SIZE > len(self._mmap):
+            self._close_mmap()
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:offset+HEADER_SIZE]
+
+    def _close_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def get(self, height: int) -> Optional[Tuple[dict, Optional[str]]]:
+        item = self._cache.get(height)
+        if item is not None:
+            self._cache.move_to_end(height)
+        return item
+
+    def put(self, height: int, header: dict, header_hash: str = None) -> None:
+        self._cache[height] = (header, header_hash)
+        self._cache.move_to_end(height)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, from_height: int = None) -> None:
+        """Close the mmap and drop cached headers at or above from_height
+        (all of them if from_height is None)."""
+        self._close_mmap()
+        if from_height is None:
+            self._cache.clear()
+        else:
+            for height in [h for h in self._cache if h >= from_height]:
+                del self._cache[height]
+
+
+class DGWv3Window:
+    """Rolling window of (timestamp, target) of the last DGW_PAST_BLOCKS
+    headers, oldest first. Fed header by header, it gives the Dark Gravity
+    Wave v3 target of the next height without re-reading or re-decoding
+    the previous headers."""
+
+    def __init__(self):
+        self._items = deque(maxlen=DGW_PAST_BLOCKS)
+
+    def push(self, header: Optional[dict]) -> None:
+        """Append the next header; a missing header resets the window."""
+        if header is None:
+            self._items.clear()
+            return
+        target = Blockchain.bits_to_target(header['bits'])
+        self._items.append((header['timestamp'], target))
+
+    def is_full(self) -> bool:
+        return len(self._items) == DGW_PAST_BLOCKS
+
+    def next_target(self) -> int:
+        if not self.is_full():
+            raise MissingHeader()
+        # the average is floored at every step, so it has to be folded
+        # over the window from the newest to the oldest block each time
+        last_time, past_target_avg = self._items[-1]
+        count_blocks = 1
+        for reading_time, reading_target in reversed(self._items):
+            past_target_avg = \
+                (past_target_avg * count_blocks + reading_target) // \
+                    (count_blocks + 1)
+            count_blocks += 1
+
+        new_target = past_target_avg
+        actual_timespan = last_time - reading_time
+        target_timespan = DGW_PAST_BLOCKS * POW_TARGET_SPACING
+
+        if actual_timespan < target_timespan // 3:
+            actual_timespan = target_timespan // 3
+        if actual_timespan > target_timespan * 3:
+            actual_timespan = target_timespan * 3
+
+        new_target *= actual_timespan
+        new_target //= target_timespan
+
+        if new_target > MAX_TARGET:
+            return MAX_TARGET
+
+        # not any target can be represented in 32 bits:
+        new_target = Blockchain.bits_to_target(Blockchain.target_to_bits(new_target))
+        return new_target
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -104,6 +217,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
@@ -141,9 +255,11 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
+            b.close()
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
+            b.close()
             delete_chain(filename, "cannot connect chain to parent")
             return
         chain_id = b.get_id()
@@ -182,6 +298,7 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._store = HeaderStore()
         self.update_size()
 
     def with_lock(func):
@@ -285,8 +402,9 @@ class Blockchain(Logger):
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
-        _hash = hash_header(header)
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      header_hash: str=None) -> None:
+        _hash = header_hash if header_hash is not None else hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
@@ -303,11 +421,16 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, index: int, data: bytes) -> None:
+    def verify_chunk(self, index: int, data: bytes,
+                     header_hashes: Optional[Sequence[str]]=None) -> None:
+        """header_hashes, if given, are the precomputed hashes of the
+        headers in data (see hash_raw_headers)."""
         num = len(data) // HEADER_SIZE
+        if header_hashes is not None and len(header_hashes) != num:
+            raise Exception(f'expected {num} header hashes, got {len(header_hashes)}')
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
-        chunk_headers = {'empty': True}
+        window = self.get_dgw_window(start_height)
         for i in range(num):
             height = start_height + i
             try:
@@ -315,17 +438,15 @@ class Blockchain(Logger):
             except MissingHeader:
                 expected_header_hash = None
             raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            height = index * 2016 + i
             header = deserialize_header(raw_header, height)
-            target = self.get_target(height, chunk_headers)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-
-            chunk_headers[height] = header
-            if i == 0:
-                chunk_headers['min_height'] = height
-                chunk_headers['empty'] = False
-            chunk_headers['max_height'] = height
-            prev_hash = hash_header(header)
+            target = self.get_target(height, window)
+            header_hash = header_hashes[i] if header_hashes is not None else hash_header(header)
+            self.verify_header(header, prev_hash, target, expected_header_hash, header_hash)
+            # bits below the DGW v3 window are never decoded (regtest
+            # headers, for one, have bits that are no valid DGW target)
+            if height >= POW_DGW3_HEIGHT - DGW_PAST_BLOCKS:
+                window.push(header)
+            prev_hash = header_hash
 
     @with_lock
     def path(self):
@@ -413,7 +534,9 @@ class Blockchain(Logger):
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
-        # parent's new name
+        # parent's new name; cached heights and mappings are stale now
+        self.close()
+        parent.close()
         os.replace(child_old_name, parent.path())
         self.update_size()
         parent.update_size()
@@ -435,10 +558,20 @@ class Blockchain(Logger):
         else:
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
+    @with_lock
+    def close(self) -> None:
+        """Release the headers file mapping and forget decoded headers."""
+        self._store.invalidate()
+
     @with_lock
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        # appending keeps both the mapping and the decoded headers; when
+        # existing headers get overwritten or truncated away, drop the
+        # mapping and every decoded header from the first affected height
+        if offset < self._size * HEADER_SIZE:
+            self._store.invalidate(self.forkpoint + offset // HEADER_SIZE)
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -467,17 +600,36 @@ class Blockchain(Logger):
             return self.parent.read_header(height)
         if height > self.height():
             return
+        cached = self._store.get(height)
+        if cached is not None:
+            return dict(cached[0])
         delta = height - self.forkpoint
         name = self.path()
         self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        h = self._store.read_raw(name, delta * HEADER_SIZE)
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
         if h == bytes([0])*HEADER_SIZE:
             return None
-        return deserialize_header(h, height)
+        header = deserialize_header(h, height)
+        self._store.put(height, header)
+        return dict(header)
+
+    @with_lock
+    def _read_header_hash(self, height: int) -> Optional[str]:
+        if height < 0:
+            return None
+        if height < self.forkpoint:
+            return self.parent._read_header_hash(height)
+        cached = self._store.get(height)
+        if cached is not None and cached[1] is not None:
+            return cached[1]
+        header = self.read_header(height)
+        if header is None:
+            return None
+        header_hash = hash_header(header)
+        self._store.put(height, header, header_hash)
+        return header_hash
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -499,67 +651,28 @@ class Blockchain(Logger):
             h, t, extra_headers = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            header_hash = self._read_header_hash(height)
+            if header_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
-
-    def get_target(self, height: int, chunk_headers: Optional[dict]=None) -> int:
-        if chunk_headers is None:
-            chunk_headers = {'empty': True}
+            return header_hash
 
+    def get_target(self, height: int, window: Optional[DGWv3Window]=None) -> int:
         if height >= POW_DGW3_HEIGHT:
-            return self.get_target_dgw_v3(height, chunk_headers)
+            if window is None:
+                return self.get_target_dgw_v3(height)
+            return window.next_target()
         else:
             return MAX_TARGET
 
-    def get_target_dgw_v3(self, height: int, chunk_headers: Optional[dict]) -> int:
-        if chunk_headers['empty']:
-            chunk_empty = True
-        else:
-            chunk_empty = False
-            min_height = chunk_headers['min_height']
-            max_height = chunk_headers['max_height']
-
-        count_blocks = 1
-        while count_blocks <= DGW_PAST_BLOCKS:
-            reading_h = height - count_blocks
-            reading_header = self.read_header(reading_h)
-            if not reading_header and not chunk_empty \
-                and min_height <= reading_h <= max_height:
-                    reading_header = chunk_headers[reading_h]
-            if not reading_header:
-                raise MissingHeader()
-            reading_time = reading_header.get('timestamp')
-            reading_target = self.bits_to_target(reading_header.get('bits'))
-
-            if count_blocks == 1:
-                past_target_avg = reading_target
-                last_time = reading_time
-            past_target_avg = \
-                (past_target_avg * count_blocks + reading_target) // \
-                    (count_blocks + 1)
+    def get_dgw_window(self, height: int) -> DGWv3Window:
+        """Returns the DGW window of the headers preceding height."""
+        window = DGWv3Window()
+        for h in range(max(height, POW_DGW3_HEIGHT) - DGW_PAST_BLOCKS, height):
+            window.push(self.read_header(h))
+        return window
 
-            count_blocks +=1
-
-        new_target = past_target_avg
-        actual_timespan = last_time - reading_time
-        target_timespan = DGW_PAST_BLOCKS * POW_TARGET_SPACING
-
-        if actual_timespan < target_timespan // 3:
-            actual_timespan = target_timespan // 3
-        if actual_timespan > target_timespan * 3:
-            actual_timespan = target_timespan * 3
-
-        new_target *= actual_timespan
-        new_target //= target_timespan
-
-        if new_target > MAX_TARGET:
-            return MAX_TARGET
-
-        # not any target can be represented in 32 bits:
-        new_target = self.bits_to_target(self.target_to_bits(new_target))
-        return new_target
+    def get_target_dgw_v3(self, height: int) -> int:
+        return self.get_dgw_window(height).next_target()
 
     @classmethod
     def bits_to_target(cls, bits: int) -> int:
@@ -640,11 +753,12 @@ class Blockchain(Logger):
             return False
         return True
 
-    def connect_chunk(self, idx: int, hexdata: str) -> bool:
+    def connect_chunk(self, idx: int, hexdata: str,
+                      header_hashes: Optional[Sequence[str]]=None) -> bool:
         assert idx >= 0, idx
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            self.verify_chunk(idx, data, header_hashes)
             self.save_chunk(idx, data)
             return True
         except BaseException as e:
@@ -760,7 +760,7 @@ class Commands:
         """
         if not is_hash256_str(txid):
             raise Exception(f"{repr(txid)} is not a txid")
-        if not self.wallet.db.get_transaction(txid):
+        if not self.wallet.db.has_transaction(txid):
             raise Exception("Transaction not in wallet.")
         res = {
             "confirmations": self.wallet.get_tx_height(txid).conf,
@@ -36,9 +36,9 @@ class Contacts(dict, Logger):
     def __init__(self, storage):
         Logger.__init__(self)
         self.storage = storage
-        d = self.storage.get('contacts', {})
+        d = self.storage.get_view('contacts', {})
         try:
-            self.update(d)
+            self.update((k, tuple(v)) for k, v in d.items())
         except:
             return
         # backward compatibility
@@ -39,7 +39,7 @@ from .network import Network
 from .util import (json_decode, DaemonThread, to_string,
                    create_and_start_event_loop, profiler, standardize_path)
 from .wallet import Wallet, Abstract_Wallet
-from .storage import WalletStorage
+from .storage import WalletStorage, get_journal_path
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
@@ -282,6 +282,9 @@ class Daemon(DaemonThread):
         self.stop_wallet(path)
         if os.path.exists(path):
             os.unlink(path)
+            journal_path = get_journal_path(path)
+            if os.path.exists(journal_path):
+                os.unlink(journal_path)
             return True
         return False
 
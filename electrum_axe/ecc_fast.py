@@ -5,6 +5,7 @@ import os
 import sys
 import traceback
 import ctypes
+from typing import List, Optional, Sequence
 from ctypes.util import find_library
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer, CFUNCTYPE, POINTER
@@ -84,6 +85,9 @@ def load_library():
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        secp256k1.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_char_p, c_char_p]
+        secp256k1.secp256k1_ec_pubkey_tweak_add.restype = c_int
+
         secp256k1.ctx = secp256k1.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
         r = secp256k1.secp256k1_context_randomize(secp256k1.ctx, os.urandom(32))
         if r:
@@ -216,6 +220,32 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def pubkey_tweak_add_batch(pubkey: bytes, tweaks: Sequence[bytes]) -> List[Optional[bytes]]:
+    '''Add tweak*G to the same pubkey for each of tweaks.
+    The pubkey is parsed only once. Returns compressed pubkeys,
+    None for the tweaks which give an invalid result.'''
+    parent = create_string_buffer(64)
+    r = _libsecp256k1.secp256k1_ec_pubkey_parse(
+        _libsecp256k1.ctx, parent, pubkey, len(pubkey))
+    if not r:
+        raise ValueError('could not parse pubkey')
+    res = []
+    for tweak in tweaks:
+        child = create_string_buffer(parent.raw, 64)
+        r = _libsecp256k1.secp256k1_ec_pubkey_tweak_add(
+            _libsecp256k1.ctx, child, tweak)
+        if not r:
+            res.append(None)
+            continue
+        child_serialized = create_string_buffer(33)
+        child_size = c_size_t(33)
+        _libsecp256k1.secp256k1_ec_pubkey_serialize(
+            _libsecp256k1.ctx, child_serialized, byref(child_size), child,
+            SECP256K1_EC_COMPRESSED)
+        res.append(child_serialized.raw[:33])
+    return res
+
+
 try:
     _libsecp256k1 = load_library()
 except:
@@ -662,6 +662,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                self.wallet.storage.compact()
                 shutil.copy2(path, new_path)
                 self.show_message(_("A copy of your wallet file was created in")+" '%s'" % str(new_path), title=_("Wallet backup created"))
             except BaseException as reason:
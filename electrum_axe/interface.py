@@ -30,7 +30,7 @@ import traceback
 import asyncio
 import socket
 from typing import Tuple, Union, List, TYPE_CHECKING, Optional
-from collections import defaultdict
+from collections import defaultdict, deque
 from ipaddress import IPv4Network, IPv6Network, ip_address
 import itertools
 import logging
@@ -60,6 +60,7 @@ if TYPE_CHECKING:
 ca_path = certifi.where()
 
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
+CATCHUP_CHUNKS_AHEAD = 4  # chunks fetched and hashed ahead of verification
 
 
 class NetworkTimeout:
@@ -124,6 +125,28 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_requests(self, method: str, params_list: List[List],
+                                  *, timeout=None) -> List:
+        """Send requests of the same method as one JSON-RPC batch.
+        Returns results in order of params_list, items which server
+        answered with error are CodeMessageError instances."""
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch {method} x{len(params_list)} (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return list(batch.results)
+
+        try:
+            results = await asyncio.wait_for(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out: {method}'
+                                  f' x{len(params_list)} (id: {msg_id})') from e
+        self.maybe_log(f"--> batch {method} x{len(results)} (id: {msg_id})")
+        return results
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -140,6 +163,36 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: List[List],
+                              queue: asyncio.Queue) -> List:
+        """Batched version of subscribe. Results not found in the cache
+        are requested in one batch. Returns results in order of params_list,
+        failed subscriptions are returned as CodeMessageError instances."""
+        keys = [self.get_hashable_key_for_rpc_call(method, params)
+                for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        to_request = [i for i, key in enumerate(keys) if key not in self.cache]
+        errors = {}
+        if to_request:
+            results = await self.send_batch_requests(
+                method, [params_list[i] for i in to_request])
+            for i, result in zip(to_request, results):
+                if isinstance(result, Exception):
+                    errors[i] = result
+                else:
+                    self.cache[keys[i]] = result
+        res = []
+        for i, (params, key) in enumerate(zip(params_list, keys)):
+            if i in errors:
+                self.subscriptions[key].remove(queue)
+                res.append(errors[i])
+            else:
+                result = self.cache[key]
+                await queue.put(params + [result])
+                res.append(result)
+        return res
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -436,6 +489,53 @@ class Interface(Logger):
             return conn, 0
         return conn, res['count']
 
+    async def _fetch_and_hash_chunk(self, index: int, tip: int):
+        size = max(0, min(2016, tip - index * 2016 + 1))
+        try:
+            self._requested_chunks.add(index)
+            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+        finally:
+            try: self._requested_chunks.remove(index)
+            except KeyError: pass
+        data = bfh(res['hex'])
+        loop = asyncio.get_event_loop()
+        executor = self.network.get_chunk_hash_executor()
+        header_hashes = await loop.run_in_executor(executor, blockchain.hash_raw_headers, data)
+        return res, header_hashes
+
+    async def request_chunks(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Pipelined catch-up from the chunk containing height up to tip.
+        Up to CATCHUP_CHUNKS_AHEAD chunks are downloaded and X11-hashed
+        (in a process pool if enabled) ahead, while the chunks are verified and
+        saved strictly in order. Returns whether the first chunk could be
+        connected and the number of headers connected from the start of
+        the first chunk; stops at the first chunk that does not connect."""
+        index = height // 2016
+        last_index = tip // 2016
+        ahead = self.network.config.get('catchup_chunks_ahead', CATCHUP_CHUNKS_AHEAD)
+        pending = deque()
+        num_headers = 0
+        self.logger.info(f"requesting chunks from height {height} to {tip}")
+        try:
+            next_index = index
+            while pending or next_index <= last_index:
+                while next_index <= last_index and len(pending) < max(1, ahead):
+                    fut = asyncio.ensure_future(self._fetch_and_hash_chunk(next_index, tip))
+                    pending.append((next_index, fut))
+                    next_index += 1
+                chunk_index, fut = pending.popleft()
+                res, header_hashes = await fut
+                if not self.blockchain.connect_chunk(chunk_index, res['hex'], header_hashes):
+                    return num_headers > 0, num_headers
+                num_headers += res['count']
+                self.network.trigger_callback('network_updated')
+                if res['count'] < 2016:
+                    break
+        finally:
+            for _, fut in pending:
+                fut.cancel()
+        return True, num_headers
+
     def is_main_server(self) -> bool:
         return self.network.default_server == self.server
 
@@ -523,7 +623,10 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if next_height // 2016 > height // 2016:
+                    could_connect, num_headers = await self.request_chunks(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
@@ -28,13 +28,15 @@ import json
 import copy
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager
 from typing import Dict, Optional
 
 from . import util, bitcoin
 from .util import profiler, WalletFileException, multisig_type, TxMinedInfo
 from .keystore import bip44_derivation
-from .transaction import Transaction
+from .transaction import Transaction, TxSummary, read_tx_summary
 from .logging import Logger
 
 # seed_version is now used for the version of the wallet file
@@ -44,26 +46,115 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+TX_CACHE_SIZE = 1000        # number of parsed Transaction objects kept
+
+# PS data dicts with addresses, indexed by address in JsonDB
+PS_UNSPENT_ADDR_DICTS = ('ps_collaterals', 'ps_denoms', 'ps_others',
+                         'ps_reserved')
+PS_SPENT_ADDR_DICTS = ('ps_spent_collaterals', 'ps_spent_denoms',
+                       'ps_spent_others')
+
+
+class ReadOnlyDict(Mapping):
+    '''Read-only view of dict from JsonDB.data, nested values are
+    returned as views too. Views are not snapshots: they follow later db
+    changes, so do not keep them across calls to modifiers.'''
+
+    __slots__ = ('_d',)
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, key):
+        return read_only_view(self._d[key])
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __repr__(self):
+        return f'ReadOnlyDict({self._d!r})'
+
+    def __copy__(self):
+        return copy.copy(self._d)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._d, memo)
+
+
+class ReadOnlyList(Sequence):
+    '''Read-only view of list from JsonDB.data, see ReadOnlyDict'''
+
+    __slots__ = ('_d',)
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, idx):
+        return read_only_view(self._d[idx])
+
+    def __len__(self):
+        return len(self._d)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, ReadOnlyList)):
+            return len(self) == len(other) and all(a == b for a, b
+                                                   in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f'ReadOnlyList({self._d!r})'
+
+    def __copy__(self):
+        return copy.copy(self._d)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._d, memo)
+
+
+def read_only_view(v):
+    if isinstance(v, dict):
+        return ReadOnlyDict(v)
+    elif isinstance(v, list):
+        return ReadOnlyList(v)
+    elif isinstance(v, set):
+        return frozenset(v)
+    return v
+
 
 class JsonDBJsonEncoder(util.MyEncoder):
     def default(self, obj):
         if isinstance(obj, Transaction):
             return str(obj)
+        if isinstance(obj, (ReadOnlyDict, ReadOnlyList)):
+            return obj._d
         return super().default(obj)
 
 
 class JsonDB(Logger):
 
-    def __init__(self, raw, *, manual_upgrades):
+    def __init__(self, raw, *, manual_upgrades, changes=None):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = {}
         self._modified = False
+        # paths into self.data changed since the last pop_changes()
+        self._changed_paths = set()
+        # paths of lists -> length before items appended since last pop
+        self._appended_paths = {}
+        self._changes_count = 0
+        self._full_write_needed = False
+        # raw hex transactions are parsed on first access,
+        # keeping last used Transaction objects in LRU cache
+        self._tx_cache = OrderedDict()  # type: OrderedDict[str, Transaction]
+        self._tx_index = {}  # type: Dict[str, TxSummary]
         self.manual_upgrades = manual_upgrades
         self.upgrade_done = False
         self._called_after_upgrade_tasks = False
         if raw:  # loading existing db
-            self.load_data(raw)
+            self.load_data(raw, changes=changes)
         else:  # creating new db
             self.put('seed_version', FINAL_SEED_VERSION)
             self._after_upgrade_tasks()
@@ -73,6 +164,9 @@ class JsonDB(Logger):
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                # caller changed something we can not track
+                self._full_write_needed = True
 
     def modified(self):
         return self._modified
@@ -81,7 +175,12 @@ class JsonDB(Logger):
         def wrapper(self, *args, **kwargs):
             with self.lock:
                 self._modified = True
-                return func(self, *args, **kwargs)
+                changes_count = self._changes_count
+                res = func(self, *args, **kwargs)
+                if self._changes_count == changes_count:
+                    # modifier did not tell what it changed
+                    self._full_write_needed = True
+                return res
         return wrapper
 
     def locked(func):
@@ -95,12 +194,102 @@ class JsonDB(Logger):
         v = self.data.get(key)
         if v is None:
             v = default
-        else:
+        elif not isinstance(v, (str, int, float)):
             v = copy.deepcopy(v)
         return v
 
+    @locked
+    def get_view(self, key, default=None):
+        '''Like get() but return read-only view instead of a deep copy'''
+        v = self.data.get(key)
+        if v is None:
+            return default
+        return read_only_view(v)
+
+    @contextmanager
+    def checkout(self, key, default):
+        '''Context manager giving stored value (or default stored under key
+        if missing) for in place changes, in place of get/put pair'''
+        with self.lock:
+            self._modified = True
+            self._changed(key)
+            v = self.data.get(key)
+            if v is None:
+                v = self.data[key] = default
+            yield v
+
+    def _changed(self, *path):
+        self._changed_paths.add(path)
+        self._changes_count += 1
+
+    def _appended(self, *path, start):
+        '''Mark list at path as extended from start index, saved as
+        'extend' op with only appended items'''
+        self._appended_paths.setdefault(path, start)
+        self._changes_count += 1
+
+    @locked
+    def pop_changes(self):
+        '''Return changes made since the last call as json encoded list
+        of ['put', path, value], ['del', path] and
+        ['extend', path, start, items] operations, or None if
+        they can only be saved by a full dump'''
+        paths = self._changed_paths
+        appended_paths = self._appended_paths
+        full_write_needed = self._full_write_needed
+        self._changed_paths = set()
+        self._appended_paths = {}
+        self._full_write_needed = False
+        if full_write_needed:
+            return None
+        ops = []
+        for path in paths:
+            d = self.data
+            for k in path[:-1]:
+                d = d.get(k) if isinstance(d, dict) else None
+            if isinstance(d, dict) and path[-1] in d:
+                ops.append(['put', list(path), d[path[-1]]])
+            else:
+                ops.append(['del', list(path)])
+        for path, start in appended_paths.items():
+            if any(path[:i] in paths for i in range(1, len(path) + 1)):
+                continue  # whole list is saved by put/del
+            d = self.data
+            for k in path:
+                d = d.get(k) if isinstance(d, dict) else None
+            if not isinstance(d, list):
+                return None
+            ops.append(['extend', list(path), start, d[start:]])
+        return json.dumps(ops, cls=JsonDBJsonEncoder)
+
+    def _apply_changes(self, ops):
+        for op in ops:
+            action, path = op[0], op[1]
+            d = self.data
+            if action == 'put':
+                for k in path[:-1]:
+                    d = d.setdefault(k, {})
+                d[path[-1]] = op[2]
+            elif action == 'del':
+                for k in path[:-1]:
+                    d = d.get(k) if isinstance(d, dict) else None
+                if isinstance(d, dict):
+                    d.pop(path[-1], None)
+            elif action == 'extend':
+                start, items = op[2], op[3]
+                for k in path[:-1]:
+                    d = d.setdefault(k, {})
+                lst = d.setdefault(path[-1], [])
+                if len(lst) < start:
+                    raise WalletFileException(f'journal extend op at {start}'
+                                              f' for list of {len(lst)}')
+                lst[start:] = items
+            else:
+                raise WalletFileException(f'unknown journal op: {action}')
+
     @modifier
     def put(self, key, value):
+        self._changed(key)
         try:
             json.dumps(key, cls=JsonDBJsonEncoder)
             json.dumps(value, cls=JsonDBJsonEncoder)
@@ -123,7 +312,7 @@ class JsonDB(Logger):
     def dump(self):
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
 
-    def load_data(self, s):
+    def load_data(self, s, *, changes=None):
         try:
             self.data = json.loads(s)
         except:
@@ -143,6 +332,8 @@ class JsonDB(Logger):
                 self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        if changes:
+            self._apply_changes(changes)
 
         if not self.manual_upgrades and self.requires_split():
             raise WalletFileException("This wallet has multiple accounts and must be split")
@@ -217,6 +408,7 @@ class JsonDB(Logger):
         self._convert_version_18()
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
         self.upgrade_done = True
+        self._full_write_needed = True
 
         self._after_upgrade_tasks()
 
@@ -537,6 +729,7 @@ class JsonDB(Logger):
 
     @modifier
     def add_txi_addr(self, tx_hash, addr, ser, v):
+        self._changed('txi', tx_hash)
         if tx_hash not in self.txi:
             self.txi[tx_hash] = {}
         d = self.txi[tx_hash]
@@ -547,6 +740,7 @@ class JsonDB(Logger):
 
     @modifier
     def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        self._changed('txo', tx_hash)
         if tx_hash not in self.txo:
             self.txo[tx_hash] = {}
         d = self.txo[tx_hash]
@@ -565,10 +759,12 @@ class JsonDB(Logger):
 
     @modifier
     def remove_txi(self, tx_hash):
+        self._changed('txi', tx_hash)
         self.txi.pop(tx_hash, None)
 
     @modifier
     def remove_txo(self, tx_hash):
+        self._changed('txo', tx_hash)
         self.txo.pop(tx_hash, None)
 
     @locked
@@ -589,6 +785,7 @@ class JsonDB(Logger):
 
     @modifier
     def remove_spent_outpoint(self, prevout_hash, prevout_n):
+        self._changed('spent_outpoints', prevout_hash)
         prevout_n = str(prevout_n)
         self.spent_outpoints[prevout_hash].pop(prevout_n, None)
         if not self.spent_outpoints[prevout_hash]:
@@ -596,6 +793,7 @@ class JsonDB(Logger):
 
     @modifier
     def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        self._changed('spent_outpoints', prevout_hash)
         prevout_n = str(prevout_n)
         if prevout_hash not in self.spent_outpoints:
             self.spent_outpoints[prevout_hash] = {}
@@ -604,15 +802,56 @@ class JsonDB(Logger):
     @modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx, Transaction)
-        self.transactions[tx_hash] = tx
+        self._changed('transactions', tx_hash)
+        self.transactions[tx_hash] = str(tx)
+        self._tx_index.pop(tx_hash, None)
+        self._cache_tx(tx_hash, tx)
 
     @modifier
     def remove_transaction(self, tx_hash) -> Optional[Transaction]:
-        return self.transactions.pop(tx_hash, None)
+        self._changed('transactions', tx_hash)
+        self._tx_index.pop(tx_hash, None)
+        tx = self._tx_cache.pop(tx_hash, None)
+        raw_tx = self.transactions.pop(tx_hash, None)
+        if self.ps_scanned_txs.pop(tx_hash, None):
+            self._changed('ps_scanned_txs', tx_hash)
+        if tx is None and raw_tx is not None:
+            tx = Transaction(raw_tx)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
-        return self.transactions.get(tx_hash)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is not None:
+            self._tx_cache.move_to_end(tx_hash)
+            return tx
+        raw_tx = self.transactions.get(tx_hash)
+        if raw_tx is None:
+            return None
+        tx = Transaction(raw_tx)
+        self._cache_tx(tx_hash, tx)
+        return tx
+
+    def _cache_tx(self, tx_hash: str, tx: Transaction):
+        self._tx_cache[tx_hash] = tx
+        self._tx_cache.move_to_end(tx_hash)
+        while len(self._tx_cache) > TX_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
+
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        return tx_hash in self.transactions
+
+    @locked
+    def get_tx_summary(self, tx_hash: str) -> Optional[TxSummary]:
+        summary = self._tx_index.get(tx_hash)
+        if summary is not None:
+            return summary
+        raw_tx = self.transactions.get(tx_hash)
+        if raw_tx is None:
+            return None
+        summary = self._tx_index[tx_hash] = read_tx_summary(raw_tx)
+        return summary
 
     @locked
     def list_transactions(self):
@@ -638,27 +877,47 @@ class JsonDB(Logger):
     @modifier
     def set_addr_history(self, addr, hist):
         if self.get_address_index(addr, ps_ks=True):
+            self._changed('ps_ks_addr_hist', addr)
             self.ps_ks_hist[addr] = hist
         else:
+            self._changed('addr_history', addr)
             self.history[addr] = hist
 
     @modifier
     def remove_addr_history(self, addr):
         if self.get_address_index(addr, ps_ks=True):
+            self._changed('ps_ks_addr_hist', addr)
             self.ps_ks_hist.pop(addr, None)
         else:
+            self._changed('addr_history', addr)
             self.history.pop(addr, None)
+        self._changed('addr_statuses', addr)
+        self.addr_statuses.pop(addr, None)
+
+    @locked
+    def get_addr_status(self, addr):
+        return self.addr_statuses.get(addr)
+
+    @modifier
+    def set_addr_status(self, addr, status):
+        self._changed('addr_statuses', addr)
+        if status is None:
+            self.addr_statuses.pop(addr, None)
+        else:
+            self.addr_statuses[addr] = status
 
     @modifier
     def add_islock(self, txid):
         '''Stores new islock as {txid: (height, timestamp)}'''
         timestamp = int(time.time())
+        self._changed('islocks', txid)
         self.islocks[txid] = (0, timestamp)
 
     @modifier
     def process_and_clear_islocks(self, local_height):
         '''Clear islocks confirmed by 24 blocks.
         Set height on islocks with verified txs'''
+        self._changed('islocks')
         clear_txids = []
         for txid, (height, timestamp) in self.islocks.items():
             mined_info = self.get_verified_tx(txid)
@@ -684,10 +943,12 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_tx(self, txid, tx_type, completed):
+        self._changed('ps_txs', txid)
         self.ps_txs[txid] = (int(tx_type), completed)
 
     @modifier
     def pop_ps_tx(self, txid):
+        self._changed('ps_txs', txid)
         self.ps_txs.pop(txid, (0, False))
 
     @locked
@@ -700,10 +961,12 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_tx_removed(self, txid, tx_type, completed):
+        self._changed('ps_txs_removed', txid)
         self.ps_txs_removed[txid] = (tx_type, completed)
 
     @modifier
     def pop_ps_tx_removed(self, txid):
+        self._changed('ps_txs_removed', txid)
         self.ps_txs_removed.pop(txid, (0, False))
 
     @locked
@@ -714,16 +977,29 @@ class JsonDB(Logger):
     def get_ps_txs_removed(self):
         return self.ps_txs_removed
 
+    @modifier
+    def add_ps_scanned_txs(self, txids):
+        for txid in txids:
+            if txid not in self.ps_scanned_txs:
+                self._changed('ps_scanned_txs', txid)
+                self.ps_scanned_txs[txid] = True
+
+    @locked
+    def get_ps_scanned_txs(self):
+        return self.ps_scanned_txs
+
     @locked
     def get_ps_data(self, key, default_val=None):
         return self.ps_data.get(key, default_val)
 
     @modifier
     def set_ps_data(self, key, val):
+        self._changed('ps_data', key)
         self.ps_data[key] = val
 
     @modifier
     def update_ps_data(self, key, data_dict):
+        self._changed('ps_data', key)
         if self.ps_data.get(key) is None:
             self.ps_data[key] = {}
         assert type(self.ps_data[key]) == dict
@@ -731,16 +1007,19 @@ class JsonDB(Logger):
 
     @modifier
     def pop_ps_data(self, key, data_dict_key):
+        self._changed('ps_data', key)
         assert type(self.ps_data[key]) == dict
         return self.ps_data[key].pop(data_dict_key, None)
 
     @modifier
     def add_ps_collateral(self, outpoint, ps_collateral):
-        self.ps_collaterals[outpoint] = ps_collateral
+        self._changed('ps_collaterals', outpoint)
+        self._set_ps_item('ps_collaterals', outpoint, ps_collateral)
 
     @modifier
     def pop_ps_collateral(self, outpoint):
-        return self.ps_collaterals.pop(outpoint, None)
+        self._changed('ps_collaterals', outpoint)
+        return self._pop_ps_item('ps_collaterals', outpoint)
 
     @locked
     def get_ps_collateral(self, outpoint=None):
@@ -762,10 +1041,12 @@ class JsonDB(Logger):
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_spending_collateral(self, outpoint, uuid):
+        self._changed('ps_spending_collaterals', outpoint)
         self.ps_spending_collaterals[outpoint] = uuid
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_spending_collateral(self, outpoint):
+        self._changed('ps_spending_collaterals', outpoint)
         return self.ps_spending_collaterals.pop(outpoint, None)
 
     @locked
@@ -778,13 +1059,15 @@ class JsonDB(Logger):
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_reserved(self, addr, data):
+        self._changed('ps_reserved', addr)
         if addr in self.ps_reserved:
             raise WalletFileException(f'Address {addr} already in ps_reserved')
-        self.ps_reserved[addr] = data
+        self._set_ps_item('ps_reserved', addr, data)
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_reserved(self, addr):
-        return self.ps_reserved.pop(addr, None)
+        self._changed('ps_reserved', addr)
+        return self._pop_ps_item('ps_reserved', addr)
 
     @locked
     def get_ps_reserved(self, addr=None):
@@ -796,29 +1079,31 @@ class JsonDB(Logger):
     @locked
     def select_ps_reserved(self, for_change=False, data=None):
         imp_addrs = getattr(self, 'imported_addresses', None)
-        imp_addrs = list(imp_addrs.keys()) if imp_addrs else []
-        if for_change:
-            w_addrs = imp_addrs if imp_addrs else self.change_addresses
-            sub_addrs = w_addrs + self.ps_ks_change_addrs
-        else:
-            w_addrs = imp_addrs if imp_addrs else self.receiving_addresses
-            sub_addrs = w_addrs + self.ps_ks_receiving_addrs
         res = []
-        for addr, addr_data in self.ps_reserved.items():
-            if addr not in sub_addrs:
-                continue
-            if addr_data != data:
-                continue
-            res.append(addr)
+        for addr in self._ps_reserved_by_data.get(data, {}):
+            if imp_addrs:
+                if addr in imp_addrs:
+                    res.append(addr)
+                    continue
+            else:
+                addr_index = self._addr_to_addr_index.get(addr)
+                if addr_index and addr_index[0] == for_change:
+                    res.append(addr)
+                    continue
+            addr_index = self._ps_ks_addr_to_addr_index.get(addr)
+            if addr_index and addr_index[0] == for_change:
+                res.append(addr)
         return res
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_denom(self, outpoint, denom):
-        self.ps_denoms[outpoint] = denom
+        self._changed('ps_denoms', outpoint)
+        self._set_ps_item('ps_denoms', outpoint, denom)
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_denom(self, outpoint):
-        return self.ps_denoms.pop(outpoint, None)
+        self._changed('ps_denoms', outpoint)
+        return self._pop_ps_item('ps_denoms', outpoint)
 
     @locked
     def get_ps_denom(self, outpoint):
@@ -832,15 +1117,21 @@ class JsonDB(Logger):
             min_rounds = 0
         if max_rounds is None:
             max_rounds = 1e9
-        return {k: v for k, v in self.ps_denoms.items()
-                if max_rounds >= v[2] >= min_rounds}
+        res = {}
+        for rounds, outpoints in self._ps_denoms_by_rounds.items():
+            if max_rounds >= rounds >= min_rounds:
+                for outpoint in outpoints:
+                    res[outpoint] = self.ps_denoms[outpoint]
+        return res
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_spending_denom(self, outpoint, uuid):
+        self._changed('ps_spending_denoms', outpoint)
         self.ps_spending_denoms[outpoint] = uuid
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_spending_denom(self, outpoint):
+        self._changed('ps_spending_denoms', outpoint)
         return self.ps_spending_denoms.pop(outpoint, None)
 
     @locked
@@ -853,11 +1144,13 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_spent_denom(self, outpoint, spent):
-        self.ps_spent_denoms[outpoint] = spent
+        self._changed('ps_spent_denoms', outpoint)
+        self._set_ps_item('ps_spent_denoms', outpoint, spent)
 
     @modifier
     def pop_ps_spent_denom(self, outpoint):
-        return self.ps_spent_denoms.pop(outpoint, None)
+        self._changed('ps_spent_denoms', outpoint)
+        return self._pop_ps_item('ps_spent_denoms', outpoint)
 
     @locked
     def get_ps_spent_denom(self, outpoint):
@@ -869,11 +1162,13 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_other(self, outpoint, unknown):
-        self.ps_others[outpoint] = unknown
+        self._changed('ps_others', outpoint)
+        self._set_ps_item('ps_others', outpoint, unknown)
 
     @modifier
     def pop_ps_other(self, outpoint):
-        return self.ps_others.pop(outpoint, None)
+        self._changed('ps_others', outpoint)
+        return self._pop_ps_item('ps_others', outpoint)
 
     @locked
     def get_ps_other(self, outpoint):
@@ -885,11 +1180,13 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_spent_other(self, outpoint, spent):
-        self.ps_spent_others[outpoint] = spent
+        self._changed('ps_spent_others', outpoint)
+        self._set_ps_item('ps_spent_others', outpoint, spent)
 
     @modifier
     def pop_ps_spent_other(self, outpoint):
-        return self.ps_spent_others.pop(outpoint, None)
+        self._changed('ps_spent_others', outpoint)
+        return self._pop_ps_item('ps_spent_others', outpoint)
 
     @locked
     def get_ps_spent_other(self, outpoint):
@@ -901,11 +1198,13 @@ class JsonDB(Logger):
 
     @modifier
     def add_ps_spent_collateral(self, outpoint, spent_collateral):
-        self.ps_spent_collaterals[outpoint] = spent_collateral
+        self._changed('ps_spent_collaterals', outpoint)
+        self._set_ps_item('ps_spent_collaterals', outpoint, spent_collateral)
 
     @modifier
     def pop_ps_spent_collateral(self, outpoint):
-        return self.ps_spent_collaterals.pop(outpoint, None)
+        self._changed('ps_spent_collaterals', outpoint)
+        return self._pop_ps_item('ps_spent_collaterals', outpoint)
 
     @locked
     def get_ps_spent_collateral(self, outpoint):
@@ -923,51 +1222,81 @@ class JsonDB(Logger):
         Limited by min_rounds (<0 for ps[_spent]_collaterals, ps_spent_denoms,
         ps_reserved, 0 for created denominations, 1 for 1 mix, and so forth).
         '''
-        ps_addr_list = []
-        denoms = self.get_ps_denoms(min_rounds=min_rounds).values()
-        if denoms:
-            ps_addr_list.extend(map(lambda x: x[0], denoms))
-
         if min_rounds is not None and min_rounds >= 0:
-            return set(ps_addr_list)
-
-        spent_denoms = self.get_ps_spent_denoms().values()
-        if spent_denoms:
-            ps_addr_list.extend(map(lambda x: x[0], spent_denoms))
-
-        collaterals = self.get_ps_collaterals().values()
-        if collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], collaterals))
-
-        spent_collaterals = self.get_ps_spent_collaterals().values()
-        if spent_collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], spent_collaterals))
-
-        others = self.get_ps_others().values()
-        if others:
-            ps_addr_list.extend(map(lambda x: x[0], others))
-
-        spent_others = self.get_ps_spent_others().values()
-        if spent_others:
-            ps_addr_list.extend(map(lambda x: x[0], spent_others))
-
-        ps_addr_list.extend(self.ps_reserved.keys())
-        return set(ps_addr_list)
+            denoms = self.get_ps_denoms(min_rounds=min_rounds).values()
+            return set(map(lambda x: x[0], denoms))
+        return set(self._ps_addrs.keys())
 
     @locked
     def get_unspent_ps_addresses(self):
-        ps_addr_list = []
-        collaterals = self.get_ps_collaterals().values()
-        if collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], collaterals))
-        denoms = self.get_ps_denoms().values()
-        if denoms:
-            ps_addr_list.extend(map(lambda x: x[0], denoms))
-        others = self.get_ps_others().values()
-        if others:
-            ps_addr_list.extend(map(lambda x: x[0], others))
-        ps_addr_list.extend(self.ps_reserved.keys())
-        return set(ps_addr_list)
+        return set(self._ps_unspent_addrs.keys())
+
+    @locked
+    def get_ps_addr_categories(self, addr):
+        '''Return names of PS data dicts referencing addr'''
+        return set(self._ps_addrs.get(addr, {}).keys())
+
+    def _index_ps_item(self, name, key, value):
+        if name == 'ps_reserved':
+            addr = key
+            self._ps_reserved_by_data[value][addr] = None
+        else:
+            addr = value[0]
+            if name == 'ps_denoms':
+                self._ps_denoms_by_rounds[value[2]][key] = None
+        self._ps_addrs[addr][name] += 1
+        if name in PS_UNSPENT_ADDR_DICTS:
+            self._ps_unspent_addrs[addr] += 1
+
+    def _unindex_ps_item(self, name, key, value):
+        if name == 'ps_reserved':
+            addr = key
+            by_data = self._ps_reserved_by_data.get(value)
+            if by_data is not None:
+                by_data.pop(addr, None)
+                if not by_data:
+                    del self._ps_reserved_by_data[value]
+        else:
+            addr = value[0]
+            if name == 'ps_denoms':
+                by_rounds = self._ps_denoms_by_rounds.get(value[2])
+                if by_rounds is not None:
+                    by_rounds.pop(key, None)
+                    if not by_rounds:
+                        del self._ps_denoms_by_rounds[value[2]]
+        addr_names = self._ps_addrs.get(addr)
+        if addr_names:
+            addr_names[name] -= 1
+            if addr_names[name] <= 0:
+                del addr_names[name]
+            if not addr_names:
+                del self._ps_addrs[addr]
+        if name in PS_UNSPENT_ADDR_DICTS and addr in self._ps_unspent_addrs:
+            self._ps_unspent_addrs[addr] -= 1
+            if self._ps_unspent_addrs[addr] <= 0:
+                del self._ps_unspent_addrs[addr]
+
+    def _set_ps_item(self, name, key, value):
+        d = getattr(self, name)
+        if key in d:
+            self._unindex_ps_item(name, key, d[key])
+        d[key] = value
+        self._index_ps_item(name, key, value)
+
+    def _pop_ps_item(self, name, key):
+        value = getattr(self, name).pop(key, None)
+        if value is not None:
+            self._unindex_ps_item(name, key, value)
+        return value
+
+    def _load_ps_indexes(self):
+        self._ps_addrs = defaultdict(Counter)  # addr -> dict name -> refs
+        self._ps_unspent_addrs = Counter()  # addr -> refs in unspent dicts
+        self._ps_denoms_by_rounds = defaultdict(dict)  # rounds -> outpoints
+        self._ps_reserved_by_data = defaultdict(dict)  # data -> addrs
+        for name in PS_UNSPENT_ADDR_DICTS + PS_SPENT_ADDR_DICTS:
+            for key, value in getattr(self, name).items():
+                self._index_ps_item(name, key, value)
 
     @locked
     def list_verified_tx(self):
@@ -986,10 +1315,12 @@ class JsonDB(Logger):
 
     @modifier
     def add_verified_tx(self, txid, info):
+        self._changed('verified_tx3', txid)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
 
     @modifier
     def remove_verified_tx(self, txid):
+        self._changed('verified_tx3', txid)
         self.verified_tx.pop(txid, None)
 
     def is_in_verified_tx(self, txid):
@@ -997,6 +1328,8 @@ class JsonDB(Logger):
 
     @modifier
     def update_tx_fees(self, d):
+        for txid in d:
+            self._changed('tx_fees', txid)
         return self.tx_fees.update(d)
 
     @locked
@@ -1005,6 +1338,7 @@ class JsonDB(Logger):
 
     @modifier
     def remove_tx_fee(self, txid):
+        self._changed('tx_fees', txid)
         self.tx_fees.pop(txid, None)
 
     @locked
@@ -1050,10 +1384,14 @@ class JsonDB(Logger):
     @modifier
     def add_change_address(self, addr, ps_ks=False):
         if ps_ks:
+            self._appended('ps_ks_addrs', 'change',
+                           start=len(self.ps_ks_change_addrs))
             self._ps_ks_addr_to_addr_index[addr] = \
                 (True, len(self.ps_ks_change_addrs))
             self.ps_ks_change_addrs.append(addr)
         else:
+            self._appended('addresses', 'change',
+                           start=len(self.change_addresses))
             self._addr_to_addr_index[addr] = \
                 (True, len(self.change_addresses))
             self.change_addresses.append(addr)
@@ -1061,10 +1399,14 @@ class JsonDB(Logger):
     @modifier
     def add_receiving_address(self, addr, ps_ks=False):
         if ps_ks:
+            self._appended('ps_ks_addrs', 'receiving',
+                           start=len(self.ps_ks_receiving_addrs))
             self._ps_ks_addr_to_addr_index[addr] = \
                 (False, len(self.ps_ks_receiving_addrs))
             self.ps_ks_receiving_addrs.append(addr)
         else:
+            self._appended('addresses', 'receiving',
+                           start=len(self.receiving_addresses))
             self._addr_to_addr_index[addr] = \
                 (False, len(self.receiving_addresses))
             self.receiving_addresses.append(addr)
@@ -1078,10 +1420,12 @@ class JsonDB(Logger):
 
     @modifier
     def add_imported_address(self, addr, d):
+        self._changed('addresses', addr)
         self.imported_addresses[addr] = d
 
     @modifier
     def remove_imported_address(self, addr):
+        self._changed('addresses', addr)
         self.imported_addresses.pop(addr)
 
     @locked
@@ -1131,14 +1475,16 @@ class JsonDB(Logger):
         # references in self.data
         self.txi = self.get_data_ref('txi')  # txid -> address -> list of (prev_outpoint, value)
         self.txo = self.get_data_ref('txo')  # txid -> address -> list of (output_index, value, is_coinbase)
-        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, Transaction]
+        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, str]
         self.spent_outpoints = self.get_data_ref('spent_outpoints')
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
         self.ps_ks_hist = self.get_data_ref('ps_ks_addr_hist')  # address -> list of (txid, height)
+        self.addr_statuses = self.get_data_ref('addr_statuses')  # address -> status hash of history
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
         self.islocks = self.get_data_ref('islocks')  # txid -> (height, timestamp)
         self.ps_txs = self.get_data_ref('ps_txs')  # txid -> (tx_type, completed)
         self.ps_txs_removed = self.get_data_ref('ps_txs_removed')  # txid -> (tx_type, completed)
+        self.ps_scanned_txs = self.get_data_ref('ps_scanned_txs')  # txid -> True, checked by untracked txs scan
         self.ps_data = self.get_data_ref('ps_data')
         self.ps_reserved = self.get_data_ref('ps_reserved')  # addr -> data
         self.ps_collaterals = self.get_data_ref('ps_collaterals')  # outpoint -> (addr, val)
@@ -1150,9 +1496,9 @@ class JsonDB(Logger):
         self.ps_spent_others = self.get_data_ref('ps_spent_others')  # outpoint -> (addr, val)
         self.ps_spent_collaterals = self.get_data_ref('ps_spent_collaterals')  # outpoint -> (addr, val)
         self.tx_fees = self.get_data_ref('tx_fees')
-        # convert raw hex transactions to Transaction objects
-        for tx_hash, raw_tx in self.transactions.items():
-            self.transactions[tx_hash] = Transaction(raw_tx)
+        self._load_ps_indexes()
+        self._tx_cache.clear()
+        self._tx_index.clear()
         # convert list to set
         for t in self.txi, self.txo:
             for d in t.values():
@@ -1173,24 +1519,39 @@ class JsonDB(Logger):
 
     @modifier
     def clear_history(self):
+        for name in ['txi', 'txo', 'spent_outpoints', 'transactions',
+                     'addr_history', 'ps_ks_addr_hist', 'addr_statuses',
+                     'verified_tx3', 'tx_fees']:
+            self._changed(name)
         self.txi.clear()
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
+        self._tx_index.clear()
         self.history.clear()
         self.ps_ks_hist.clear()
+        self.addr_statuses.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
         self.clear_ps_data()
 
     @modifier
     def clear_ps_data(self):
+        for name in ['ps_data', 'ps_txs', 'ps_txs_removed', 'ps_scanned_txs',
+                     'ps_reserved',
+                     'ps_collaterals', 'ps_spending_collaterals',
+                     'ps_spent_collaterals', 'ps_denoms',
+                     'ps_spending_denoms', 'ps_spent_denoms', 'ps_others',
+                     'ps_spent_others']:
+            self._changed(name)
         self.ps_data['pay_collateral_wfl'] = {}
         self.ps_data['new_collateral_wfl'] = {}
         self.ps_data['new_denoms_wfl'] = {}
         self.ps_data['denominate_workflows'] = {}
         self.ps_txs.clear()
         self.ps_txs_removed.clear()
+        self.ps_scanned_txs.clear()
         self.ps_reserved.clear()
         self.ps_collaterals.clear()
         self.ps_spending_collaterals.clear()
@@ -1200,3 +1561,4 @@ class JsonDB(Logger):
         self.ps_spent_denoms.clear()
         self.ps_others.clear()
         self.ps_spent_others.clear()
+        self._load_ps_indexes()
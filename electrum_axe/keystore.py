@@ -26,7 +26,9 @@
 
 from unicodedata import normalize
 import hashlib
-from typing import Tuple
+import threading
+from collections import OrderedDict
+from typing import Tuple, List
 
 from . import bitcoin, ecc, constants, bip32
 from .bitcoin import (deserialize_privkey, serialize_privkey,
@@ -143,6 +145,10 @@ class Software_KeyStore(KeyStore):
     def get_private_key(self, *args, **kwargs) -> Tuple[bytes, bool]:
         raise NotImplementedError()  # implemented by subclasses
 
+    def get_private_keys(self, sequences, password) -> List[Tuple[bytes, bool]]:
+        return [self.get_private_key(sequence, password)
+                for sequence in sequences]
+
 
 class Imported_KeyStore(Software_KeyStore):
     # keystore for imported private keys
@@ -262,24 +268,57 @@ class Deterministic_KeyStore(Software_KeyStore):
 
 class Xpub:
 
+    PUBKEYS_CACHE_SIZE = 4096
+
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        self._branch_nodes = {}  # branch -> (pubkey, chaincode)
+        self._branch_nodes_xpub = None
+        self._pubkeys_cache = OrderedDict()  # (branch, n) -> pubkey hex
+        self._pubkeys_cache_lock = threading.Lock()
 
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change % 2 else self.xpub_receive
-        if xpub is None:
+    def _get_branch_node(self, branch):
+        if self._branch_nodes_xpub != self.xpub:
+            self._branch_nodes.clear()
+            self._pubkeys_cache.clear()
+            self._branch_nodes_xpub = self.xpub
+        node = self._branch_nodes.get(branch)
+        if node is None:
             rootnode = BIP32Node.from_xkey(self.xpub)
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change % 2:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+            subnode = rootnode.subkey_at_public_derivation((branch,))
+            node = (subnode.eckey.get_public_key_bytes(compressed=True),
+                    subnode.chaincode)
+            self._branch_nodes[branch] = node
+        return node
+
+    def _derive_branch_pubkeys(self, branch, ns):
+        res = {}
+        with self._pubkeys_cache_lock:
+            pubkey, chaincode = self._get_branch_node(branch)
+            cache = self._pubkeys_cache
+            for n in ns:
+                k = (branch, n)
+                if k in cache:
+                    cache.move_to_end(k)
+                    res[n] = cache[k]
+            missing = [n for n in ns if n not in res]
+            if missing:
+                derived = bip32.CKD_pub_batch(pubkey, chaincode, missing)
+                for n, child_pubkey in zip(missing, derived):
+                    res[n] = cache[(branch, n)] = bh2u(child_pubkey)
+                while len(cache) > self.PUBKEYS_CACHE_SIZE:
+                    cache.popitem(last=False)
+        return [res[n] for n in ns]
+
+    def derive_pubkey(self, for_change, n):
+        return self._derive_branch_pubkeys(int(for_change), [n])[0]
+
+    def derive_pubkeys(self, for_change, ns):
+        '''Derive pubkeys of branch for_change for sequence of indexes ns'''
+        return self._derive_branch_pubkeys(int(for_change), list(ns))
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -388,6 +427,22 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         pk = node.eckey.get_secret_bytes()
         return pk, True
 
+    def get_private_keys(self, sequences, password):
+        # decode xprv and derive branch nodes once for all sequences
+        xprv = self.get_master_private_key(password)
+        rootnode = BIP32Node.from_xkey(xprv)
+        branches = {}
+        res = []
+        for sequence in sequences:
+            branch = tuple(sequence[:-1])
+            node = branches.get(branch)
+            if node is None:
+                node = rootnode.subkey_at_private_derivation(branch)
+                branches[branch] = node
+            node = node.subkey_at_private_derivation(sequence[-1:])
+            res.append((node.eckey.get_secret_bytes(), True))
+        return res
+
 
 class PS_BIP32_KeyStore(BIP32_KeyStore):
     """PrivateSend keystore with additional derivations for addresses/change"""
@@ -411,6 +466,10 @@ class PS_BIP32_KeyStore(BIP32_KeyStore):
         derivation = self.addr_deriv_offset*2 + int(for_change)
         return super().derive_pubkey(derivation, n)
 
+    def derive_pubkeys(self, for_change, ns):
+        derivation = self.addr_deriv_offset*2 + int(for_change)
+        return super().derive_pubkeys(derivation, ns)
+
     def get_xpubkey(self, c, i):
         derivation = self.addr_deriv_offset*2 + int(c)
         return super().get_xpubkey(derivation, i)
@@ -420,6 +479,13 @@ class PS_BIP32_KeyStore(BIP32_KeyStore):
         _sequence = [derivation, *sequence[1:]]
         return super().get_private_key(_sequence, password)
 
+    def get_private_keys(self, sequences, password):
+        _sequences = []
+        for sequence in sequences:
+            derivation = self.addr_deriv_offset*2 + int(sequence[0] % 2)
+            _sequences.append([derivation, *sequence[1:]])
+        return super().get_private_keys(_sequences, password)
+
 
 class Old_KeyStore(Deterministic_KeyStore):
 
@@ -32,7 +32,9 @@ import json
 import sys
 import ipaddress
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
+import concurrent.futures
+import multiprocessing
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, Union
 import traceback
 
 import dns
@@ -322,6 +324,13 @@ class Network(Logger):
         # protx info responses data
         self.protx_info_resp = []
 
+        # opt-in process pool X11-hashing header chunks during catch-up,
+        # chunks are hashed in the default thread pool otherwise
+        self._chunk_hash_executor = None  # type: Optional[concurrent.futures.Executor]
+        self._chunk_hash_executor_lock = threading.Lock()
+        self._chunk_hash_workers = min(self.config.get('catchup_hash_workers', 0),
+                                       os.cpu_count() or 1)
+
         # create AxeNet
         self.axe_net = AxeNet(self, config)
         # create MNList instance
@@ -910,6 +919,24 @@ class Network(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    @best_effort_reliable
+    async def get_merkles_for_transactions(self, txs: List[Tuple[str, int]], *,
+                                           timeout=None) -> List[Union[dict, Exception]]:
+        """Batched get_merkle_for_transaction for (tx_hash, tx_height) items.
+        Items the server returned an error for are UntrustedServerReturnedError
+        instances."""
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        res = await self.interface.session.send_batch_requests(
+            'blockchain.transaction.get_merkle', [list(tx) for tx in txs],
+            timeout=timeout)
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in res]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
@@ -1184,6 +1211,34 @@ class Network(Logger):
             raise Exception(f"{repr(sh)} is not a scripthash")
         return await self.interface.session.send_request('blockchain.scripthash.get_history', [sh])
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_history_for_scripthashes(self, shs: List[str]) -> List[List[dict]]:
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        res = await self.interface.session.send_batch_requests(
+            'blockchain.scripthash.get_history', [[sh] for sh in shs])
+        for r in res:
+            if isinstance(r, Exception):
+                raise r
+        return res
+
+    @best_effort_reliable
+    async def get_transactions(self, tx_hashes: List[str], *,
+                               timeout=None) -> List[Union[str, Exception]]:
+        """Batched get_transaction. Items the server returned an error for
+        are UntrustedServerReturnedError instances."""
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        res = await self.interface.session.send_batch_requests(
+            'blockchain.transaction.get', [[h] for h in tx_hashes],
+            timeout=timeout)
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in res]
+
     @best_effort_reliable
     @catch_server_exceptions
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
@@ -1383,6 +1438,25 @@ class Network(Logger):
             fut.result(timeout=2)
         except (asyncio.TimeoutError, asyncio.CancelledError): pass
         self.axe_net.stop()
+        with self._chunk_hash_executor_lock:
+            if self._chunk_hash_executor:
+                self._chunk_hash_executor.shutdown(wait=False)
+                self._chunk_hash_executor = None
+
+    def get_chunk_hash_executor(self) -> Optional[concurrent.futures.Executor]:
+        """Process pool for hashing downloaded header chunks, or None
+        (default thread pool) if disabled or not available."""
+        with self._chunk_hash_executor_lock:
+            if self._chunk_hash_executor is None and self._chunk_hash_workers > 1:
+                try:
+                    # spawn: do not fork process running Qt and asyncio threads
+                    mp_context = multiprocessing.get_context('spawn')
+                    self._chunk_hash_executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self._chunk_hash_workers, mp_context=mp_context)
+                except (NotImplementedError, OSError, ValueError) as e:
+                    self.logger.info(f'process pool not available, hashing chunks in threads: {repr(e)}')
+                    self._chunk_hash_workers = 0
+            return self._chunk_hash_executor
 
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
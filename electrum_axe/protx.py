@@ -187,7 +187,7 @@ class ProTxManager(Logger):
     @with_manager_lock
     def load(self):
         '''Load masternodes from wallet storage.'''
-        stored_mns = self.wallet.storage.get('protx_mns', {})
+        stored_mns = self.wallet.storage.get_view('protx_mns', {})
         self.mns = {k: ProTxMN.from_dict(d) for k, d in stored_mns.items()}
 
     def save(self, with_lock=True):
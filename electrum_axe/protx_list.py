@@ -30,13 +30,15 @@ import json
 import os
 import random
 import threading
+from bisect import bisect_left
 from collections import namedtuple, defaultdict
-from struct import pack
+from struct import pack, unpack_from, calcsize
 
 from . import constants
 from .constants import CHUNK_SIZE
 from .crypto import sha256d
 from .axe_msg import AxeSMLEntry, AxeQFCommitMsg
+from .axe_tx import to_compact_size
 from .logging import Logger
 from .simple_config import SimpleConfig
 from .transaction import Transaction, BCDataStream, SerializationError
@@ -48,10 +50,25 @@ MN_LIST_INSTANCE = None
 DEFAULT_MN_LIST = {'protx_height': 0, 'llmq_height': 0,
                    'protx_mns': {}, 'sml_hashes': {},  # SML entries and hashes
                    'quorums': {}, 'llmq_hashes': {}}   # qfcommits and hashes
-RECENT_LIST_FNAME = 'recent_protx_list.gz'
+RECENT_LIST_FNAME = 'recent_protx_list.gz'  # legacy json format
+RECENT_LIST_BIN_FNAME = 'recent_protx_list.bin'
+RECENT_LIST_MAGIC = b'AXEMNL\x01'
+RECENT_LIST_COMPACT_RATIO = 0.5  # checkpoint when diffs exceed snapshot
 PROTX_INFO_FNAME = 'protx_info.gz'
 
 
+class MNListDiffError(Exception):
+    '''MNListDiff check failed, not necessarily by fault of the peer'''
+
+
+class MNListDiffBadProof(MNListDiffError):
+    '''MNListDiff CbTx does not match requested block (peer fault)'''
+
+
+class MNListDiffRootMismatch(MNListDiffError):
+    '''SML/LLMQ merkle root calculated on local list differs from CbTx'''
+
+
 class PartialMerkleTree(namedtuple('PartialMerkleTree', 'total hashes flags')):
     '''Class representing CPartialMerkleTree of axed'''
     @classmethod
@@ -76,6 +93,244 @@ class PartialMerkleTree(namedtuple('PartialMerkleTree', 'total hashes flags')):
         return PartialMerkleTree(total, hashes, flags)
 
 
+class SMLMerkleTree:
+    '''Merkle tree of SML entries hashes sorted by reversed proRegTxHash.
+
+    All tree levels are kept, so on update only nodes over changed leaves
+    and over leaves shifted by insertions/deletions are rehashed.'''
+
+    def __init__(self, sml_hashes=None):
+        self.keys = []      # sorted reversed proRegTxHash bytes
+        self.levels = [[]]  # levels[0] is leaves (SML entries hashes)
+        if sml_hashes:
+            items = sorted((bfh(k)[::-1], v) for k, v in sml_hashes.items())
+            self.keys = [k for k, v in items]
+            self.levels[0] = [v for k, v in items]
+            self._rehash(set(), 0)
+
+    def copy(self):
+        res = SMLMerkleTree()
+        res.keys = self.keys.copy()
+        res.levels = [level.copy() for level in self.levels]
+        return res
+
+    def update(self, deleted=None, changed=None):
+        '''Apply deleted proRegTxHashes list and changed
+        proRegTxHash -> SML entry hash dict'''
+        keys = self.keys
+        leaves = self.levels[0]
+        dirty = set()
+        suffix = len(leaves)  # first leaf position shifted by changes
+        for protx_hash in (deleted or []):
+            k = bfh(protx_hash)[::-1]
+            i = bisect_left(keys, k)
+            if i < len(keys) and keys[i] == k:
+                del keys[i]
+                del leaves[i]
+                suffix = min(suffix, i)
+        for protx_hash, sml_hash in (changed or {}).items():
+            k = bfh(protx_hash)[::-1]
+            i = bisect_left(keys, k)
+            if i < len(keys) and keys[i] == k:
+                if leaves[i] != sml_hash:
+                    leaves[i] = sml_hash
+                    dirty.add(i)
+            else:
+                keys.insert(i, k)
+                leaves.insert(i, sml_hash)
+                suffix = min(suffix, i)
+        self._rehash(dirty, suffix)
+
+    def _rehash(self, dirty, suffix):
+        k = 0
+        while len(self.levels[k]) > 1:
+            prev = self.levels[k]
+            prev_len = len(prev)
+            n = (prev_len + 1) // 2
+            dirty = {i // 2 for i in dirty}
+            suffix = suffix // 2
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            level = self.levels[k + 1]
+            if len(level) < n:
+                suffix = min(suffix, len(level))
+                level.extend([None] * (n - len(level)))
+            else:
+                del level[n:]
+            for i in dirty.union(range(suffix, n)):
+                if i >= n:
+                    continue
+                left = prev[i*2]
+                right = prev[i*2+1] if i*2+1 < prev_len else left
+                level[i] = sha256d(left + right)
+            k += 1
+        del self.levels[k + 1:]
+
+    def root(self):
+        top = self.levels[-1]
+        root = top[0] if top else b'\x00'*32
+        return hfu(root[::-1])
+
+
+class MNListDiffRecord(namedtuple('MNListDiffRecord',
+                                  'deleted_mns mns deleted_quorums quorums')):
+    '''Keys of recent list entries changed by one processed diff'''
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+
+class RecentListFile(Logger):
+    '''Binary snapshot of recent masternode list and quorums.
+
+    File starts with RECENT_LIST_MAGIC followed by records of
+    (uint8 type, uint32 size, payload, 4 bytes checksum). First record is
+    a snapshot, next records are appended diffs. Entries are stored
+    network serialized, followed by their cached hash. When appended diffs
+    outgrow the snapshot, file is rewritten with a new snapshot.'''
+
+    SNAPSHOT = 0
+    DIFF = 1
+
+    LOGGING_SHORTCUT = 'M'
+
+    def __init__(self, path):
+        Logger.__init__(self)
+        self.path = path
+        self.snapshot_size = 0  # 0 if no valid snapshot written
+        self.size = 0  # size of valid file data
+
+    @staticmethod
+    def _checksum(payload):
+        return sha256d(payload)[:4]
+
+    @classmethod
+    def _pack_record(cls, rtype, payload):
+        return (pack('<BI', rtype, len(payload)) + payload +
+                cls._checksum(payload))
+
+    @staticmethod
+    def _pack_payload(rl, diff):
+        protx_mns = rl['protx_mns']
+        sml_hashes = rl['sml_hashes']
+        quorums = rl['quorums']
+        llmq_hashes = rl['llmq_hashes']
+        res = bytearray(pack('<ii', rl['protx_height'], rl['llmq_height']))
+        res += to_compact_size(len(diff.deleted_mns))
+        for k in diff.deleted_mns:
+            res += bfh(k)[::-1]
+        res += to_compact_size(len(diff.mns))
+        for k in diff.mns:
+            res += protx_mns[k].serialize() + sml_hashes[k]
+        res += to_compact_size(len(diff.deleted_quorums))
+        for k in diff.deleted_quorums:
+            quorum_hash, llmq_type = k.split(':')
+            res += bfh(quorum_hash)[::-1] + pack('B', int(llmq_type))
+        res += to_compact_size(len(diff.quorums))
+        for k in diff.quorums:
+            res += quorums[k].serialize() + llmq_hashes[k]
+        return bytes(res)
+
+    @staticmethod
+    def _apply_payload(rl, payload):
+        vds = BCDataStream()
+        vds.clear_and_set_bytes(payload)
+        protx_mns = rl['protx_mns']
+        sml_hashes = rl['sml_hashes']
+        quorums = rl['quorums']
+        llmq_hashes = rl['llmq_hashes']
+        rl['protx_height'] = vds.read_int32()
+        rl['llmq_height'] = vds.read_int32()
+        for i in range(vds.read_compact_size()):
+            k = bh2u(vds.read_bytes(32)[::-1])
+            protx_mns.pop(k, None)
+            sml_hashes.pop(k, None)
+        for i in range(vds.read_compact_size()):
+            sml_entry = AxeSMLEntry.read_vds(vds)
+            k = bh2u(sml_entry.proRegTxHash[::-1])
+            protx_mns[k] = sml_entry
+            sml_hashes[k] = vds.read_bytes(32)
+        for i in range(vds.read_compact_size()):
+            quorum_hash = vds.read_bytes(32)
+            k = f'{bh2u(quorum_hash[::-1])}:{vds.read_uchar()}'
+            quorums.pop(k, None)
+            llmq_hashes.pop(k, None)
+        for i in range(vds.read_compact_size()):
+            qfcommit = AxeQFCommitMsg.read_vds(vds)
+            k = f'{bh2u(qfcommit.quorumHash[::-1])}:{qfcommit.llmqType}'
+            quorums[k] = qfcommit
+            llmq_hashes[k] = vds.read_bytes(32)
+        if vds.can_read_more():
+            raise SerializationError('extra junk at the end of record')
+
+    def read(self):
+        '''Return recent list dict or None if no valid snapshot found'''
+        self.snapshot_size = self.size = 0
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(RECENT_LIST_MAGIC):
+            self.logger.info(f'wrong recent list file magic: {self.path}')
+            return None
+        header_size = calcsize('<BI')
+        offset = len(RECENT_LIST_MAGIC)
+        snapshot_size = 0
+        rl = None
+        while offset + header_size <= len(data):
+            rtype, size = unpack_from('<BI', data, offset)
+            start = offset + header_size
+            end = start + size
+            payload = data[start:end]
+            if (end + 4 > len(data)
+                    or data[end:end+4] != self._checksum(payload)):
+                self.logger.info(f'skip partially written record'
+                                 f' at {offset} in {self.path}')
+                break
+            if rtype == self.SNAPSHOT and rl is None:
+                rl = {'protx_mns': {}, 'sml_hashes': {},
+                      'quorums': {}, 'llmq_hashes': {}}
+            elif rtype != self.DIFF or rl is None:
+                self.logger.info(f'unknown record type {rtype}'
+                                 f' at {offset} in {self.path}')
+                break
+            self._apply_payload(rl, payload)
+            offset = end + 4
+            if rtype == self.SNAPSHOT:
+                snapshot_size = offset
+        # set sizes only if file is fully parsed, to not append diffs
+        # to the file with broken records
+        if rl is not None:
+            self.snapshot_size = snapshot_size
+            self.size = offset
+        return rl
+
+    def write_snapshot(self, rl):
+        diff = MNListDiffRecord([], list(rl['protx_mns'].keys()),
+                                [], list(rl['quorums'].keys()))
+        data = (RECENT_LIST_MAGIC +
+                self._pack_record(self.SNAPSHOT, self._pack_payload(rl, diff)))
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        self.snapshot_size = self.size = len(data)
+
+    def append_diff(self, rl, diff):
+        if not self.snapshot_size:
+            return self.write_snapshot(rl)
+        record = self._pack_record(self.DIFF, self._pack_payload(rl, diff))
+        diffs_size = self.size - self.snapshot_size + len(record)
+        if diffs_size > self.snapshot_size * RECENT_LIST_COMPACT_RATIO:
+            return self.write_snapshot(rl)
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.size)  # drop partially written tail
+            f.seek(self.size)
+            f.write(record)
+        self.size += len(record)
+
+
 class MNList(Logger):
     '''Class representing data frmom MNLISTDIFF msg'''
 
@@ -117,7 +372,9 @@ class MNList(Logger):
         self.llmq_height = recent_list.get('llmq_height', 1)
         self.protx_mns = protx_mns = recent_list.get('protx_mns', {})
         self.sml_hashes = recent_list.get('sml_hashes', {})
+        self.sml_tree = SMLMerkleTree(self.sml_hashes)
         self.quorums = recent_list.get('quorums', {})
+        self.quorums_index = self.build_quorums_index(self.quorums)
         self.llmq_hashes = recent_list.get('llmq_hashes', {})
 
         if protx_mns:
@@ -132,7 +389,6 @@ class MNList(Logger):
         self.info_hash = ''
 
         # Sent Requests
-        self.sent_getmnlistd = asyncio.Queue(1)
         self.sent_protx_diff = asyncio.Queue(1)
 
         # Wait for wallet updated before request LLMQ/ProTx diffs
@@ -218,7 +474,27 @@ class MNList(Logger):
     def _read_recent_list(self):
         if not self.config.path:
             return DEFAULT_MN_LIST
+        bin_path = os.path.join(self.config.path, RECENT_LIST_BIN_FNAME)
+        self.recent_list_file = RecentListFile(bin_path)
+        try:
+            rl = self.recent_list_file.read()
+            if rl is not None:
+                return rl
+        except Exception as e:
+            self.logger.info(f'_read_recent_list: {str(e)}')
+        rl = self._read_legacy_recent_list()
+        if rl is not DEFAULT_MN_LIST:
+            try:
+                self.recent_list_file.write_snapshot(rl)
+                os.unlink(os.path.join(self.config.path, RECENT_LIST_FNAME))
+            except Exception as e:
+                self.logger.info(f'_read_recent_list: {str(e)}')
+        return rl
+
+    def _read_legacy_recent_list(self):
         path = os.path.join(self.config.path, RECENT_LIST_FNAME)
+        if not os.path.exists(path):
+            return DEFAULT_MN_LIST
         try:
             with gzip.open(path, 'rb') as f:
                 data = f.read()
@@ -238,29 +514,15 @@ class MNList(Logger):
             return DEFAULT_MN_LIST
 
     @with_recent_list_lock
-    def _save_recent_list(self):
+    def _save_recent_list(self, diff=None):
+        '''Append diff record or write full snapshot if diff is None'''
         if not self.config.path:
             return
-        path = os.path.join(self.config.path, RECENT_LIST_FNAME)
         try:
-            rl = self.recent_list
-            rlc = self.recent_list.copy()
-            rlc['protx_mns'] = {}
-            rlc['sml_hashes'] = {}
-            rlc['quorums'] = {}
-            rlc['llmq_hashes'] = {}
-            # Save values as hex strings
-            for k, v in rl['protx_mns'].items():
-                rlc['protx_mns'][k] = v.serialize(as_hex=True)
-            for k, v in rl['sml_hashes'].items():
-                rlc['sml_hashes'][k] = bh2u(v[::-1])
-            for k, v in rl['quorums'].items():
-                rlc['quorums'][k] = v.serialize(as_hex=True)
-            for k, v in rl['llmq_hashes'].items():
-                rlc['llmq_hashes'][k] = bh2u(v[::-1])
-            s = json.dumps(rlc, indent=4)
-            with gzip.open(path, 'wb') as f:
-                f.write(s.encode('utf-8'))
+            if diff is None:
+                self.recent_list_file.write_snapshot(self.recent_list)
+            else:
+                self.recent_list_file.append_diff(self.recent_list, diff)
         except Exception as e:
             self.logger.info(f'_save_recent_list: {str(e)}')
 
@@ -293,18 +555,22 @@ class MNList(Logger):
         except Exception as e:
             self.logger.info(f'_save_protx_info: {str(e)}')
 
-    def reset(self):
+    def reset(self, request_diffs=True):
         self.recent_list['protx_height'] = self.protx_height = 1
         self.recent_list['llmq_height'] = self.llmq_height = 1
         self.recent_list['protx_mns'] = self.protx_mns = {}
         self.recent_list['sml_hashes'] = self.sml_hashes = {}
+        self.sml_tree = SMLMerkleTree()
         self.recent_list['quorums'] = self.quorums = {}
+        self.quorums_index = {}
         self.recent_list['llmq_hashes'] = self.llmq_hashes = {}
         self._save_recent_list()
         self._save_protx_info(force=True)
         self.protx_state = MNList.DIP3_UNKNOWN
         self.diff_deleted_mns = []
         self.diff_hashes = []
+        if not request_diffs:
+            return
         if self.axe_net_enabled:
             coro = self.axe_net.getmnlistd()
         else:
@@ -411,7 +677,6 @@ class MNList(Logger):
         # axe_net
         self.axe_net.register_callback(self.on_axe_net_updated,
                                         ['axe-net-updated'])
-        self.axe_net.register_callback(self.on_mnlistdiff, ['mnlistdiff'])
         # MNList
         self.register_callback(self.on_network_error, ['network-error'])
 
@@ -424,7 +689,6 @@ class MNList(Logger):
         self.network.unregister_callback(self.on_wallet_updated)
         # axe_net
         self.axe_net.unregister_callback(self.on_axe_net_updated)
-        self.axe_net.unregister_callback(self.on_mnlistdiff)
         # MNList
         self.unregister_callback(self.on_network_error)
 
@@ -439,18 +703,37 @@ class MNList(Logger):
         if protx_hash:
             return self.protx_mns.get(protx_hash)
 
+    @staticmethod
+    def build_quorums_index(quorums):
+        '''Group quorums by llmqType with packed sort hash prefixes'''
+        index = defaultdict(list)
+        for q in quorums.values():
+            prefix = pack('B', q.llmqType) + q.quorumHash
+            index[q.llmqType].append((prefix, q))
+        return dict(index)
+
     def calc_responsible_quorum(self, llmqType, request_id):
+        return self.calc_responsible_quorums(llmqType, [request_id])[0]
+
+    def calc_responsible_quorums(self, llmqType, request_ids):
+        '''Return responsible quorum for each of request_ids,
+        None if no quorums of llmqType known'''
+        quorums = self.quorums_index.get(llmqType)
+        if not quorums:
+            return [None] * len(request_ids)
         res = []
-        for q in self.quorums.values():
-            if q.llmqType != llmqType:
-                continue
-            prehash = pack('B', q.llmqType) + q.quorumHash + request_id
-            sorthash = sha256d(prehash)
-            res.append((sorthash, q))
-        res = sorted(res, key=lambda x: x[0])
-        return res[0][1] if res else None
-
-    def calc_merkle_root(self, hashes):
+        for request_id in request_ids:
+            min_hash = None
+            for prefix, q in quorums:
+                sorthash = sha256d(prefix + request_id)
+                if min_hash is None or sorthash < min_hash:
+                    min_hash = sorthash
+                    min_q = q
+            res.append(min_q)
+        return res
+
+    @staticmethod
+    def calc_merkle_root(hashes):
         hashes_len = len(hashes)
         if hashes_len == 0:
             hashes = [b'\x00'*32]
@@ -468,12 +751,9 @@ class MNList(Logger):
             hashes_len = len(hashes)
         return hfu(hashes[0][::-1])
 
-    def check_sml_merkle_root(self, sml_hashes_dict, cbtx_extra):
+    def check_sml_merkle_root(self, sml_tree, cbtx_extra):
         '''Check SML merkle root on cbTx.merkleRootMNList'''
-        sml_hashes = [v for k, v in
-                      sorted(sml_hashes_dict.items(),
-                             key=lambda x: bfh(x[0])[::-1])]
-        mr_calculated = self.calc_merkle_root(sml_hashes)
+        mr_calculated = sml_tree.root()
         mr_cbtx = hfu(cbtx_extra.merkleRootMNList[::-1])
         if mr_calculated != mr_cbtx:
             self.logger.info('check_sml_merkle_root: SML merkle root'
@@ -528,42 +808,29 @@ class MNList(Logger):
             return False
         return True
 
-    async def on_mnlistdiff(self, event, value):
-        '''Process and check MNListDiff payload'''
-        base_height, height = value['params']
-        try:
-            q_base_height, q_height = self.sent_getmnlistd.get_nowait()
-            if q_base_height != base_height or q_height != height:
-                self.logger.info('on_mnlistdiff: queue params differs')
-                return
-        except asyncio.QueueEmpty:
-            self.logger.info('ignore unsolicited mnlistdiff repsonse')
-            return
-
+    async def apply_mnlistdiff(self, base_height, height, diff):
+        '''Process and check MNListDiff payload, return False
+        if diff is not applicable, raise MNListDiffError if check is failed'''
         if base_height not in [self.llmq_height, self.protx_height]:
-            return
-
-        error = value['error']
-        if error:
-            self.logger.info(f'on_mnlistdiff: {error}')
-            self.notify('network-error')
-            return
-        diff = value['result']
+            return False
 
         def process_mnlistdiff():
             cbtx = diff.cbTx
             if cbtx.tx_type:
                 if cbtx.tx_type != 5:
-                    self.logger.info(f'on_mnlistdiff: unsupported CbTx'
-                                     f' version={cbtx.version},'
-                                     f' tx_type={cbtx.tx_type}')
-                    return False
+                    raise MNListDiffError(f'unsupported CbTx'
+                                          f' version={cbtx.version},'
+                                          f' tx_type={cbtx.tx_type}')
                 cbtx_extra = cbtx.extra_payload
                 if cbtx_extra.version > 2:
-                    self.logger.info(f'on_mnlistdiff: unsupported CbTx'
-                                     f' cbtx_extra.version='
-                                     f'{cbtx_extra.version}')
-                    return False
+                    raise MNListDiffError(f'unsupported CbTx'
+                                          f' cbtx_extra.version='
+                                          f'{cbtx_extra.version}')
+                if cbtx_extra.height != height:
+                    raise MNListDiffBadProof(f'CbTx height'
+                                             f' {cbtx_extra.height} differs'
+                                             f' from requested height'
+                                             f' {height}')
             else:  # classical coinbase tx (disabled dip3)
                 if self.load_mns:
                     self.protx_height = height
@@ -573,7 +840,7 @@ class MNList(Logger):
                 self.diff_hashes = []
                 self.llmq_height = height
                 self.recent_list['llmq_height'] = height
-                return True
+                return MNListDiffRecord.empty()
 
             if self.load_mns and base_height == self.protx_height:
                 protx_new = self.protx_mns.copy()
@@ -585,45 +852,56 @@ class MNList(Logger):
                     if del_hash in sml_hashes_new:
                         del sml_hashes_new[del_hash]
 
+                changed_hashes = {}
                 for sml_entry in diff.mnList:
                     protx_hash = bh2u(sml_entry.proRegTxHash[::-1])
                     sml_hash = sha256d(sml_entry.serialize())
                     protx_new[protx_hash] = sml_entry
                     sml_hashes_new[protx_hash] = sml_hash
+                    changed_hashes[protx_hash] = sml_hash
+                sml_tree_new = self.sml_tree.copy()
+                sml_tree_new.update(deleted_mns, changed_hashes)
 
             if base_height == self.llmq_height and height <= self.llmq_tip:
                 quorums_new = self.quorums.copy()
                 llmq_hashes_new = self.llmq_hashes.copy()
+                deleted_quorums = []
                 for dq in diff.deletedQuorums:
                     del_key = f'{bh2u(dq.quorumHash[::-1])}:{dq.llmqType}'
+                    deleted_quorums.append(del_key)
                     if del_key in quorums_new:
                         del quorums_new[del_key]
                     if del_key in llmq_hashes_new:
                         del llmq_hashes_new[del_key]
 
+                new_quorums = []
                 for nq in diff.newQuorums:
                     new_key = f'{bh2u(nq.quorumHash[::-1])}:{nq.llmqType}'
+                    new_quorums.append(new_key)
                     qfcommit_hash = sha256d(nq.serialize())
                     quorums_new[new_key] = nq
                     llmq_hashes_new[new_key] = qfcommit_hash
 
+            if not self.network.blockchain().read_header(height):
+                raise MNListDiffError(f'no header at {height} to check CbTx')
+            if not self.check_cbtx_merkle_root(cbtx,
+                                               hashes=diff.merkleHashes):
+                raise MNListDiffBadProof('CbTx merkle proof check failed')
+
             if self.load_mns and base_height == self.protx_height:
-                if not self.check_sml_merkle_root(sml_hashes_new,
+                if not self.check_sml_merkle_root(sml_tree_new,
                                                   cbtx_extra):
-                    return False
+                    raise MNListDiffRootMismatch('SML merkle root mismatch')
 
             if (base_height == self.llmq_height
                     and height <= self.llmq_tip
                     and cbtx_extra.version > 1):
                 if not self.check_llmq_merkle_root(llmq_hashes_new,
                                                    cbtx_extra):
-                    return False
-
-            if not self.check_cbtx_merkle_root(cbtx,
-                                               hashes=diff.merkleHashes):
-                return False
+                    raise MNListDiffRootMismatch('LLMQ merkle root mismatch')
 
             cbtx_height = cbtx_extra.height
+            diff_record = MNListDiffRecord.empty()
             if self.load_mns and base_height == self.protx_height:
                 self.protx_height = cbtx_height
                 self.recent_list['protx_height'] = cbtx_height
@@ -631,12 +909,15 @@ class MNList(Logger):
                 self.recent_list['protx_mns'] = protx_new
                 self.sml_hashes = sml_hashes_new
                 self.recent_list['sml_hashes'] = sml_hashes_new
+                self.sml_tree = sml_tree_new
                 self.protx_state = MNList.DIP3_ENABLED
 
                 self.diff_deleted_mns = deleted_mns
                 dh = list(map(lambda x: bh2u(x.proRegTxHash[::-1]),
                           diff.mnList))
                 self.diff_hashes = dh
+                diff_record.deleted_mns.extend(deleted_mns)
+                diff_record.mns.extend(dh)
             else:
                 self.diff_deleted_mns = []
                 self.diff_hashes = []
@@ -646,27 +927,23 @@ class MNList(Logger):
                 self.recent_list['llmq_height'] = cbtx_height
                 self.quorums = quorums_new
                 self.recent_list['quorums'] = quorums_new
+                self.quorums_index = self.build_quorums_index(quorums_new)
                 self.llmq_hashes = llmq_hashes_new
                 self.recent_list['llmq_hashes'] = llmq_hashes_new
-
-            return True
-
-        if await self.axe_net.loop.run_in_executor(None, process_mnlistdiff):
-            if self.diff_deleted_mns:
-                for h in self.diff_deleted_mns:
-                    self.protx_info.pop(h, None)
-
-            if self.diff_hashes:
-                for h in list(self.protx_info.keys()):
-                    if h in self.diff_hashes:
-                        self.protx_info.pop(h, None)
-
-            if self.llmq_loading:
-                await self.axe_net.getmnlistd()
-            elif self.protx_loading:
-                await self.axe_net.getmnlistd(get_mns=True)
-            self._save_recent_list()
-            self.notify('mn-list-diff-updated')
+                diff_record.deleted_quorums.extend(deleted_quorums)
+                diff_record.quorums.extend(new_quorums)
+
+            return diff_record
+
+        diff_record = await self.axe_net.loop.run_in_executor(
+            None, process_mnlistdiff)
+        self._save_recent_list(diff_record)
+        for h in diff_record.deleted_mns:
+            self.protx_info.pop(h, None)
+        for h in diff_record.mns:
+            self.protx_info.pop(h, None)
+        self.notify('mn-list-diff-updated')
+        return True
 
     async def on_protx_diff(self, key, value):
         '''Process and check protx.diff data'''
@@ -700,20 +977,20 @@ class MNList(Logger):
                     self.logger.info(f'on_protx_diff: unsupported CbTx'
                                      f' version={cbtx.version},'
                                      f' tx_type={cbtx.tx_type}')
-                    return False
+                    return
                 cbtx_extra = cbtx.extra_payload
                 if cbtx_extra.version > 2:
                     self.logger.info(f'on_protx_diff: unsupported CbTx'
                                      f' cbtx_extra.version='
                                      f'{cbtx_extra.version}')
-                    return False
+                    return
             else:  # classical coinbase tx (disabled dip3)
                 self.protx_height = height
                 self.recent_list['protx_height'] = height
                 self.protx_state = MNList.DIP3_DISABLED
                 self.diff_deleted_mns = []
                 self.diff_hashes = []
-                return True
+                return MNListDiffRecord.empty()
 
             protx_new = self.protx_mns.copy()
             sml_hashes_new = self.sml_hashes.copy()
@@ -724,49 +1001,55 @@ class MNList(Logger):
                 if del_hash in sml_hashes_new:
                     del sml_hashes_new[del_hash]
 
+            changed_hashes = {}
             for mn in diff.get('mnList', []):
                 protx_hash = mn.get('proRegTxHash', '')
                 sml_entry = AxeSMLEntry.from_dict(mn)
                 sml_hash = sha256d(sml_entry.serialize())
                 protx_new[protx_hash] = sml_entry
                 sml_hashes_new[protx_hash] = sml_hash
+                changed_hashes[protx_hash] = sml_hash
+            sml_tree_new = self.sml_tree.copy()
+            sml_tree_new.update(deleted_mns, changed_hashes)
 
-            if not self.check_sml_merkle_root(sml_hashes_new,
+            if not self.check_sml_merkle_root(sml_tree_new,
                                               cbtx_extra):
-                return False
+                return
 
             merkle_tree = diff.get('cbTxMerkleTree')
             if not self.check_cbtx_merkle_root(cbtx,
                                                merkle_tree=merkle_tree):
-                return False
+                return
 
             cbtx_height = cbtx_extra.height
             self.protx_mns = protx_new
             self.recent_list['protx_mns'] = protx_new
             self.sml_hashes = sml_hashes_new
             self.recent_list['sml_hashes'] = sml_hashes_new
+            self.sml_tree = sml_tree_new
             self.protx_height = cbtx_height
             self.recent_list['protx_height'] = cbtx_height
             self.protx_state = MNList.DIP3_ENABLED
             self.diff_deleted_mns = deleted_mns
             self.diff_hashes = list(map(lambda x: x['proRegTxHash'],
                                         diff.get('mnList', [])))
-            return True
-
-        if await self.axe_net.loop.run_in_executor(None, process_protx_diff):
-            if self.diff_deleted_mns:
-                for h in self.diff_deleted_mns:
-                    self.protx_info.pop(h, None)
-
-            if self.diff_hashes:
-                for h in list(self.protx_info.keys()):
-                    if h in self.diff_hashes:
-                        self.protx_info.pop(h, None)
+            return MNListDiffRecord(list(deleted_mns),
+                                    list(self.diff_hashes), [], [])
 
-            if self.protx_loading:
-                await self.network.request_protx_diff()
-            self._save_recent_list()
-            self.notify('mn-list-diff-updated')
+        diff_record = await self.axe_net.loop.run_in_executor(
+            None, process_protx_diff)
+        if diff_record is None:
+            return
+        # save before next await, while recent list matches the record
+        self._save_recent_list(diff_record)
+        for h in diff_record.deleted_mns:
+            self.protx_info.pop(h, None)
+        for h in diff_record.mns:
+            self.protx_info.pop(h, None)
+        # notify before next await to not mix with next diff hashes
+        self.notify('mn-list-diff-updated')
+        if self.protx_loading:
+            await self.network.request_protx_diff()
 
     async def on_protx_info(self, key, value):
         self.info_hash = ''
@@ -23,11 +23,13 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
 import threading
 import stat
 import hashlib
 import base64
 import zlib
+from typing import List, Tuple
 
 from . import ecc
 from .util import profiler, InvalidPassword, WalletFileException, bfh, standardize_path
@@ -45,15 +47,93 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# journal is compacted into the wallet file when it grows over this
+# fraction of the wallet file size
+JOURNAL_COMPACT_RATIO = 0.5
+
+
+def get_journal_path(path):
+    return path + '.journal'
+
+
+class WalletJournal(Logger):
+    '''Append-only log of JsonDB changes stored next to the wallet file.
+
+    First line is a json header with sha256 of the wallet file the journal
+    was started on, each next line is a record written by one
+    WalletStorage.write() call. Journal with a header not matching the
+    wallet file is left from an older file state and is ignored.
+    '''
+
+    def __init__(self, path):
+        Logger.__init__(self)
+        self.path = get_journal_path(path)
+        self.base_hash = None
+        self.size = 0  # size of valid journal data, 0 if no journal
+
+    @staticmethod
+    def hash_base(raw: str) -> str:
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def read(self, base_hash) -> List[Tuple[int, str]]:
+        '''Return list of (end offset, record) for complete records'''
+        self.base_hash = base_hash
+        self.size = 0
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = data.find(b'\n')
+        try:
+            header = json.loads(data[:pos].decode('utf-8')) if pos > 0 else {}
+        except ValueError:
+            header = {}
+        if not isinstance(header, dict) or header.get('base') != base_hash:
+            self.logger.info(f'ignoring stale journal {self.path}')
+            return []
+        self.size = offset = pos + 1
+        records = []
+        while True:
+            end = data.find(b'\n', offset)
+            if end < 0:
+                break
+            records.append((end + 1, data[offset:end].decode('utf-8')))
+            offset = end + 1
+        return records
+
+    def append(self, record: str):
+        record = bytes(record + '\n', 'utf-8')
+        if not self.size:
+            header = json.dumps({'base': self.base_hash}) + '\n'
+            record = bytes(header, 'utf-8') + record
+            mode = 'wb'
+        else:
+            mode = 'ab'
+        with open(self.path, mode) as f:
+            if self.size:
+                f.truncate(self.size)  # drop partially written tail
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(record)
+
+    def reset(self, base_hash):
+        '''Called after all changes are saved to the wallet file'''
+        self.base_hash = base_hash
+        self.size = 0
+        if os.path.exists(self.path):
+            os.unlink(self.path)
 
 
 class WalletStorage(Logger):
 
-    def __init__(self, path, *, manual_upgrades=False):
+    def __init__(self, path, *, manual_upgrades=False, use_journal=True):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.path = standardize_path(path)
         self._file_exists = self.path and os.path.exists(self.path)
+        self.journal = WalletJournal(self.path) if use_journal else None
+        self._base_size = 0
 
         DB_Class = JsonDB
         self.logger.info(f"wallet path {self.path}")
@@ -62,9 +142,12 @@ class WalletStorage(Logger):
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
+            self._base_size = len(self.raw)
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
-                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
+                changes = self._read_journal(json.loads)
+                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades,
+                                   changes=changes)
                 if self.db.upgrade_done:
                     try:
                         self.backup_old_version()
@@ -88,11 +171,34 @@ class WalletStorage(Logger):
     def get(self, key, default=None):
         return self.db.get(key, default)
 
+    def get_view(self, key, default=None):
+        return self.db.get_view(key, default)
+
+    def checkout(self, key, default):
+        return self.db.checkout(key, default)
+
     @profiler
     def write(self):
         with self.lock:
             self._write()
 
+    def _read_journal(self, decode_record) -> list:
+        if not self.journal:
+            return []
+        changes = []
+        records = self.journal.read(WalletJournal.hash_base(self.raw))
+        for end, record in records:
+            try:
+                changes.extend(decode_record(record))
+            except Exception as e:
+                # partially written record from interrupted write
+                self.logger.warning(f'journal record is damaged: {repr(e)}')
+                break
+            self.journal.size = end
+        if changes:
+            self.logger.info(f'read {len(changes)} changes from journal')
+        return changes
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
@@ -100,6 +206,36 @@ class WalletStorage(Logger):
         if not self.db.modified():
             return
         self.db.commit()
+        changes = self.db.pop_changes()
+        try:
+            if not self._write_journal(changes):
+                self._write_full()
+        except BaseException:
+            # changes are lost from db tracking, do full write next time
+            self.db.set_modified(True)
+            raise
+        self.db.set_modified(False)
+
+    def _write_journal(self, changes) -> bool:
+        if (not self.journal or changes is None or not self.file_exists()
+                or self.journal.base_hash is None):
+            return False
+        record = self.encrypt_before_writing(changes)
+        journal_size = self.journal.size + len(record)
+        if journal_size > self._base_size * JOURNAL_COMPACT_RATIO:
+            return False
+        self.journal.append(record)
+        self.logger.info(f'saved {len(record)} bytes to journal')
+        return True
+
+    def compact(self):
+        '''Save all data to the wallet file and remove the journal'''
+        with self.lock:
+            if self.journal and self.journal.size:
+                self.db.set_modified(True)
+            self._write()
+
+    def _write_full(self):
         s = self.encrypt_before_writing(self.db.dump())
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -113,8 +249,10 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._base_size = len(s)
+        if self.journal:
+            self.journal.reset(WalletJournal.hash_base(s))
         self.logger.info(f"saved {self.path}")
-        self.db.set_modified(False)
 
     def file_exists(self):
         return self._file_exists
@@ -188,7 +326,12 @@ class WalletStorage(Logger):
             s = None
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
-        self.db = JsonDB(s, manual_upgrades=True)
+
+        def decode_record(record):
+            c = ec_key.decrypt_message(record, enc_magic)
+            return json.loads(zlib.decompress(c).decode('utf8'))
+        changes = self._read_journal(decode_record)
+        self.db = JsonDB(s, manual_upgrades=True, changes=changes)
         self.load_plugins()
 
     def encrypt_before_writing(self, plaintext: str) -> str:
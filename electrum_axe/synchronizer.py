@@ -42,6 +42,10 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+SYNC_BATCH_SIZE = 100  # requests in one JSON-RPC batch
+SYNC_MAX_INFLIGHT_BATCHES = 4  # batches awaiting server response
+
+
 class SynchronizerFailure(Exception): pass
 
 
@@ -60,6 +64,11 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     """
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
+        config = network.config
+        self.batch_size = max(1, config.get('sync_batch_size',
+                                            SYNC_BATCH_SIZE))
+        self.max_inflight_batches = max(1, config.get('sync_max_inflight_batches',
+                                                      SYNC_MAX_INFLIGHT_BATCHES))
         NetworkJobOnDefaultServer.__init__(self, network)
         self._reset_request_counters()
 
@@ -70,8 +79,11 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self._processed_some_notifications = False  # so that we don't miss them
         self._reset_request_counters()
         # Queues
-        self.add_queue = asyncio.Queue()
+        self.add_queue = asyncio.Queue(maxsize=(self.batch_size *
+                                                self.max_inflight_batches))
         self.status_queue = asyncio.Queue()
+        # backpressure on batched requests
+        self.inflight_batches = asyncio.Semaphore(self.max_inflight_batches)
 
     async def _start_tasks(self):
         try:
@@ -111,23 +123,42 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
+    async def get_batch(self, queue: asyncio.Queue) -> List:
+        """Wait for queue item and take up to batch_size of available items,
+        then wait for free slot of in-flight batches.
+        Caller must release inflight_batches after the batch is answered."""
+        items = [await queue.get()]
+        while len(items) < self.batch_size and not queue.empty():
+            items.append(queue.get_nowait())
+        await self.inflight_batches.acquire()
+        return items
+
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
+        async def subscribe_to_addresses(addrs):
             try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+                hashes = []
+                for addr in addrs:
+                    h = address_to_scripthash(addr)
+                    self.scripthash_to_address[h] = addr
+                    hashes.append(h)
+                self._requests_sent += len(addrs)
+                results = await self.session.subscribe_batch(
+                    'blockchain.scripthash.subscribe',
+                    [[h] for h in hashes], self.status_queue)
+            finally:
+                self.inflight_batches.release()
+            for addr, result in zip(addrs, results):
+                if isinstance(result, Exception):
+                    if (isinstance(result, RPCError)
+                            and result.message == 'history too large'):  # no unique error code
+                        raise GracefulDisconnect(result, log_level=logging.ERROR) from result
+                    raise result
+                self._requests_answered += 1
+                self.requested_addrs.remove(addr)
 
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            addrs = await self.get_batch(self.add_queue)
+            await self.group.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
@@ -159,6 +190,7 @@ class Synchronizer(SynchronizerBase):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = set()
+        self.history_queue = asyncio.Queue()
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
@@ -169,37 +201,52 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_tx)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.get_addr_status(addr) == status:
             return
         if (addr, status) in self.requested_histories:
             return
         # request address history
         self.requested_histories.add((addr, status))
-        h = address_to_scripthash(addr)
-        self._requests_sent += 1
-        result = await self.network.get_history_for_scripthash(h)
-        self._requests_answered += 1
-        self.logger.info(f"receiving history {addr} {len(result)}")
-        hashes = set(map(lambda item: item['tx_hash'], result))
-        hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
-        # tx_fees
-        tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
-        tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
-        # Check that txids are unique
-        if len(hashes) != len(result):
-            self.logger.info(f"error: server history has non-unique txids: {addr}")
-        # Check that the status corresponds to what was announced
-        elif history_status(hist) != status:
-            self.logger.info(f"error: status mismatch: {addr}")
-        else:
-            # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
-            # Request transactions we don't have
-            await self._request_missing_txs(hist)
+        await self.history_queue.put((addr, status))
+
+    async def request_histories(self):
+        while True:
+            items = await self.get_batch(self.history_queue)
+            await self.group.spawn(self._get_histories, items)
+
+    async def _get_histories(self, items):
+        try:
+            hashes = [address_to_scripthash(addr) for addr, status in items]
+            self._requests_sent += len(items)
+            results = await self.network.get_history_for_scripthashes(hashes)
+        finally:
+            self.inflight_batches.release()
+        self._requests_answered += len(items)
+        received_hist = []
+        for (addr, status), result in zip(items, results):
+            self.logger.info(f"receiving history {addr} {len(result)}")
+            hashes = set(map(lambda item: item['tx_hash'], result))
+            hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
+            # tx_fees
+            tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
+            tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
+            # Check that txids are unique
+            if len(hashes) != len(result):
+                self.logger.info(f"error: server history has non-unique txids: {addr}")
+            # Check that the status corresponds to what was announced
+            elif history_status(hist) != status:
+                self.logger.info(f"error: status mismatch: {addr}")
+            else:
+                # Store received history
+                self.wallet.receive_history_callback(addr, hist, tx_fees,
+                                                     status=status)
+                received_hist.extend(hist)
+        # Request transactions we don't have
+        await self._request_missing_txs(received_hist)
 
-        # Remove request; this allows up_to_date to be True
-        self.requested_histories.discard((addr, status))
+        # Remove requests; this allows up_to_date to be True
+        for addr_status in items:
+            self.requested_histories.discard(addr_status)
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -207,29 +254,36 @@ class Synchronizer(SynchronizerBase):
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
-            if self.wallet.db.get_transaction(tx_hash):
+            if self.wallet.db.has_transaction(tx_hash):
                 continue
             transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
 
         if not transaction_hashes: return
         async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
+            for i in range(0, len(transaction_hashes), self.batch_size):
+                await self.inflight_batches.acquire()
+                await group.spawn(self._get_transactions(transaction_hashes[i:i+self.batch_size],
+                                                         allow_server_not_finding_tx=allow_server_not_finding_tx))
 
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
+    async def _get_transactions(self, tx_hashes, *, allow_server_not_finding_tx=False):
+        self._requests_sent += len(tx_hashes)
         try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
+            results = await self.network.get_transactions(tx_hashes)
         finally:
-            self._requests_answered += 1
+            self.inflight_batches.release()
+            self._requests_answered += len(tx_hashes)
+        for tx_hash, result in zip(tx_hashes, results):
+            if isinstance(result, UntrustedServerReturnedError):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    continue
+                else:
+                    raise result
+            self._receive_transaction(tx_hash, result)
+
+    def _receive_transaction(self, tx_hash, result):
         tx = Transaction(result)
         try:
             tx.deserialize()  # see if raises
@@ -248,13 +302,16 @@ class Synchronizer(SynchronizerBase):
 
     async def main(self):
         self.wallet.set_up_to_date(False)
+        await self.group.spawn(self.request_histories())
         # request missing txns, if any
+        missing_hist = []
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
             # Old electrum servers returned ['*'] when all history for the address
             # was pruned. This no longer happens but may remain in old wallets.
             if history == ['*']: continue
-            await self._request_missing_txs(history, allow_server_not_finding_tx=True)
+            missing_hist.extend(history)
+        await self._request_missing_txs(missing_hist, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
         if not self.wallet.psman.subscribe_spent:
             unsubscribed_addrs = self.wallet.psman.unsubscribed_addrs
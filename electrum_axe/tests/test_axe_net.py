@@ -0,0 +1,482 @@
+import asyncio
+import ipaddress
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from bls_py import bls
+
+from electrum_axe import constants
+from electrum_axe.axe_net import (AxeNet, MNLISTD_MAX_TRIES,
+                                   MNLISTD_PEER_INFLIGHT, MNLISTD_RESET_PEERS,
+                                   FOUND_PEERS_MAX_AGE,
+                                   FOUND_PEER_RETRY_DELAY)
+from electrum_axe.constants import CHUNK_SIZE
+from electrum_axe.protx_list import (MNList, MNListDiffBadProof,
+                                     MNListDiffRootMismatch)
+from electrum_axe.simple_config import SimpleConfig
+from electrum_axe.util import bh2u
+
+from . import TestCaseForTestnet
+
+
+class QuorumMock:
+
+    def __init__(self, privk):
+        self.privk = privk
+        self.quorumPublicKey = privk.get_public_key().serialize()
+
+
+class IslockMock:
+
+    def __init__(self, quorum, valid=True):
+        self.txid = os.urandom(32)
+        self.request_id = os.urandom(32)
+        msg_hash = self.msg_hash(quorum, self.request_id)
+        if not valid:
+            msg_hash = os.urandom(32)
+        self.sig = quorum.privk.sign_prehashed(msg_hash).serialize()
+
+    def calc_request_id(self):
+        return self.request_id
+
+    def msg_hash(self, quorum, request_id):
+        return bytes(a ^ b for a, b in zip(self.txid, request_id))
+
+
+class MNListMock:
+
+    def __init__(self, quorums):
+        self.quorums = quorums
+
+    def calc_responsible_quorums(self, llmqType, request_ids):
+        return [self.quorums.get(r) for r in request_ids]
+
+
+class MNListDiffsMock:
+    '''Applies mnlistdiffs (base_height, height, valid) checking order'''
+
+    LLMQ_OFFSET = MNList.LLMQ_OFFSET
+    calc_max_height = staticmethod(MNList.calc_max_height)
+
+    def __init__(self, network, height=1):
+        self.network = network
+        self.llmq_height = self.protx_height = height
+        self.applied = []
+        self.notified = []
+        self.broken = False  # mismatch roots of diffs from broken_height
+        self.broken_height = height
+        self.reset_keeps_broken = False
+        self.resets = 0
+
+    @property
+    def llmq_loading(self):
+        return self.network.get_local_height() - self.LLMQ_OFFSET \
+            > self.llmq_height
+
+    @property
+    def protx_loading(self):
+        return self.network.get_local_height() > self.protx_height
+
+    async def apply_mnlistdiff(self, base_height, height, diff):
+        assert base_height in [self.llmq_height, self.protx_height]
+        assert diff[:2] == (base_height, height)
+        if not diff[2]:
+            raise MNListDiffBadProof('CbTx merkle proof check failed')
+        if self.broken and base_height == self.broken_height:
+            raise MNListDiffRootMismatch('SML merkle root mismatch')
+        llmq_tip = self.network.get_local_height() - self.LLMQ_OFFSET
+        if base_height == self.llmq_height and height <= llmq_tip:
+            self.llmq_height = height
+        self.protx_height = height
+        self.applied.append((base_height, height))
+        return True
+
+    def reset(self, request_diffs=True):
+        assert not request_diffs
+        self.llmq_height = self.protx_height = 1
+        if self.reset_keeps_broken:
+            self.broken_height = 1
+        else:
+            self.broken = False
+        self.resets += 1
+
+    def notify(self, key):
+        self.notified.append(key)
+
+
+class VersionMock:
+    user_agent = b'/fake/'
+    services = 5
+
+
+class MNListDPeerMock:
+
+    version = VersionMock()
+    ping_time = None
+
+    def __init__(self, peer, latency=0.05, valid=True, timeout=False):
+        self.peer = peer
+        self.latency = latency
+        self.valid = valid
+        self.timeout = timeout
+        self.mnlistd_inflight = 0
+        self.mnlistd_latency = None
+        self.mnlistd_failures = 0
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+        self.ban_msg = None
+        self.ban_till = None
+        self.closed = False
+
+    async def getmnlistd(self, base_height, height):
+        self.requests += 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.active -= 1
+        if self.timeout:
+            raise asyncio.TimeoutError()
+        return (base_height, height, self.valid)
+
+    def ban(self, ban_msg, ban_seconds=None):
+        self.ban_msg = ban_msg
+        self.ban_till = time.time() + ban_seconds
+
+    def close(self):
+        self.closed = True
+
+
+class NetworkMock:
+
+    def __init__(self, config, quorums, local_height=0):
+        self.asyncio_loop = None
+        self._loop_thread = None
+        self.config = config
+        self.local_height = local_height
+        self.mn_list = MNListMock(quorums)
+
+    def get_local_height(self):
+        return self.local_height
+
+
+class AxeNetTestCase(TestCaseForTestnet):
+
+    def setUp(self):
+        super(AxeNetTestCase, self).setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.privk1 = bls.PrivateKey.from_seed(b'\x01' * 32)
+        self.privk2 = bls.PrivateKey.from_seed(b'\x02' * 32)
+
+    def tearDown(self):
+        super(AxeNetTestCase, self).tearDown()
+        shutil.rmtree(self.electrum_path)
+
+    def test_bls_speed(self):
+        assert AxeNet.test_bls_speed()
+        assert AxeNet.test_bls_batch_speed(n=3)
+
+    def test_verify_bls_batch(self):
+        pubk = self.privk1.get_public_key()
+        msg_sigs = []
+        for i in range(4):
+            msg_hash = os.urandom(32)
+            sig = self.privk1.sign_prehashed(msg_hash).serialize()
+            msg_sigs.append((msg_hash, sig))
+        assert AxeNet.verify_bls_batch(pubk, msg_sigs) == [True] * 4
+        assert AxeNet.verify_bls_batch(pubk, msg_sigs[:1]) == [True]
+        assert AxeNet.verify_bls_batch(pubk, []) == []
+
+        # signature of other key, falls back to individual checks
+        msg_hash = os.urandom(32)
+        sig = self.privk2.sign_prehashed(msg_hash).serialize()
+        res = AxeNet.verify_bls_batch(pubk, msg_sigs + [(msg_hash, sig)])
+        assert res == [True] * 4 + [False]
+
+        # invalid signatures can not cancel each other in aggregate
+        sig1 = bls.Signature.from_bytes(msg_sigs[0][1])
+        sig2 = bls.Signature.from_bytes(msg_sigs[1][1])
+        delta = bls.Signature.from_bytes(sig).value
+        bad1 = bls.Signature.from_g2(sig1.value + delta).serialize()
+        neg_delta = delta.to_affine().negate().to_jacobian()
+        bad2 = bls.Signature.from_g2(sig2.value + neg_delta).serialize()
+        res = AxeNet.verify_bls_batch(pubk, [(msg_sigs[0][0], bad1),
+                                             (msg_sigs[1][0], bad2)])
+        assert res == [False, False]
+
+        # unparsable signature and duplicate message hash
+        res = AxeNet.verify_bls_batch(pubk, [msg_sigs[0],
+                                             (msg_sigs[1][0], b'\x00' * 96),
+                                             (msg_sigs[0][0], sig),
+                                             msg_sigs[2]])
+        assert res == [True, False, False, True]
+
+    def test_verify_pending_islocks(self):
+        quorum1 = QuorumMock(self.privk1)
+        quorum2 = QuorumMock(self.privk2)
+        islocks = [IslockMock(quorum1), IslockMock(quorum1),
+                   IslockMock(quorum2), IslockMock(quorum1, valid=False),
+                   IslockMock(quorum2)]
+        quorums = {islocks[i].request_id: q
+                   for i, q in enumerate([quorum1, quorum1, quorum2,
+                                          quorum1])}
+        network = NetworkMock(self.config, quorums)
+        axe_net = AxeNet(network, self.config)
+        txids = [bh2u(islock.txid[::-1]) for islock in islocks]
+
+        with mock.patch.object(asyncio, 'run_coroutine_threadsafe') as run, \
+                mock.patch.object(axe_net, 'trigger_callback') as trigger:
+            axe_net.extend_recent_islocks(islocks[:2])
+            axe_net.extend_recent_islocks(islocks[2:])
+            assert run.call_count == 1  # verification scheduled once
+            run.call_args[0][0].close()
+            assert len(axe_net.recent_islocks) == 4  # no quorum for last
+            trigger.assert_not_called()
+
+            axe_net.verify_pending_islocks()
+            assert not axe_net.recent_islocks
+            assert set(axe_net.verified_islocks) == set(txids[:3])
+            triggered = [c[0][1] for c in trigger.call_args_list]
+            assert triggered == txids[:3]
+            assert len(axe_net.quorum_pubkeys) == 2
+
+            assert axe_net.verify_on_recent_islocks(txids[0])
+            assert not axe_net.verify_on_recent_islocks(txids[3])
+            assert not axe_net.verify_on_recent_islocks(txids[4])
+
+            # verified islocks are not queued for verification again
+            axe_net.extend_recent_islocks(islocks[:1])
+            assert not axe_net.recent_islocks
+            assert run.call_count == 1
+
+            # verify synchronously if pending islock is not yet processed
+            islock = IslockMock(quorum2)
+            quorums[islock.request_id] = quorum2
+            txid = bh2u(islock.txid[::-1])
+            axe_net.extend_recent_islocks([islock])
+            assert run.call_count == 2
+            run.call_args[0][0].close()
+            assert axe_net.verify_on_recent_islocks(txid)
+            assert txid in axe_net.verified_islocks
+            assert not axe_net.recent_islocks
+
+    def test_get_quorum_pubkey(self):
+        network = NetworkMock(self.config, {})
+        axe_net = AxeNet(network, self.config)
+        pubk_bytes = self.privk1.get_public_key().serialize()
+        pubk = axe_net.get_quorum_pubkey(pubk_bytes)
+        assert pubk.serialize() == pubk_bytes
+        assert axe_net.get_quorum_pubkey(pubk_bytes) is pubk
+        with mock.patch('electrum_axe.axe_net.QUORUM_PUBKEYS_CACHE_SIZE', 1):
+            pubk_bytes2 = self.privk2.get_public_key().serialize()
+            axe_net.get_quorum_pubkey(pubk_bytes2)
+            assert list(axe_net.quorum_pubkeys) == [pubk_bytes2]
+
+    def _make_axe_net(self, peers, local_height, mn_list_height=1):
+        network = NetworkMock(self.config, {}, local_height)
+        network.mn_list = MNListDiffsMock(network, mn_list_height)
+        axe_net = AxeNet(network, self.config)
+        axe_net.use_static_peers = False
+        axe_net.peers = {p.peer: p for p in peers}
+        return axe_net
+
+    def test_calc_mnlistd_heights(self):
+        activation_height = constants.net.DIP3_ACTIVATION_HEIGHT
+        tip = activation_height + 5 * CHUNK_SIZE + 100
+        axe_net = self._make_axe_net([], tip)
+        llmq_heights = axe_net.calc_mnlistd_heights()
+        mns_heights = axe_net.calc_mnlistd_heights(get_mns=True)
+        assert llmq_heights[:2] == [1, activation_height + 1]
+        assert llmq_heights[-1] == tip - MNList.LLMQ_OFFSET
+        assert mns_heights == llmq_heights + [tip]
+        for base_height, height in zip(llmq_heights[1:], llmq_heights[2:]):
+            assert 0 < height - base_height <= CHUNK_SIZE
+
+        mn_list = axe_net.network.mn_list
+        mn_list.llmq_height = mn_list.protx_height = tip - 8
+        assert axe_net.calc_mnlistd_heights() == [tip - 8]
+        assert axe_net.calc_mnlistd_heights(get_mns=True) == [tip - 8, tip]
+
+    def _run_getmnlistd(self, axe_net):
+        loop = asyncio.new_event_loop()
+        axe_net.loop = loop
+        try:
+            start = time.time()
+            loop.run_until_complete(axe_net.getmnlistd())
+            return time.time() - start
+        finally:
+            loop.close()
+
+    def test_getmnlistd_parallel(self):
+        peers = [MNListDPeerMock(f'127.0.0.{i}:19937') for i in range(3)]
+        tip = constants.net.DIP3_ACTIVATION_HEIGHT + 40 * CHUNK_SIZE
+        axe_net = self._make_axe_net(peers, tip)
+        ranges_cnt = len(axe_net.calc_mnlistd_heights(get_mns=True)) - 1
+        elapsed = self._run_getmnlistd(axe_net)
+        serial_time = ranges_cnt * peers[0].latency
+        print(f'mnlistdiffs: {ranges_cnt} in {elapsed:.2f}s,'
+              f' serial {serial_time:.2f}s')
+        mn_list = axe_net.network.mn_list
+        assert mn_list.protx_height == tip
+        assert mn_list.llmq_height == tip - MNList.LLMQ_OFFSET
+        assert len(mn_list.applied) == ranges_cnt
+        for prev, cur in zip(mn_list.applied, mn_list.applied[1:]):
+            assert prev[1] == cur[0]
+        assert sum(p.requests for p in peers) == ranges_cnt
+        # requests are pipelined to each peer up to the peer limit
+        assert all(p.peak_active == MNLISTD_PEER_INFLIGHT for p in peers)
+        assert not axe_net.mnlistd_loading
+
+    def test_getmnlistd_peers_demoted(self):
+        slow = MNListDPeerMock('127.0.0.1:19937', timeout=True)
+        bad = MNListDPeerMock('127.0.0.2:19937', latency=0.01, valid=False)
+        good = MNListDPeerMock('127.0.0.3:19937')
+        tip = constants.net.DIP3_ACTIVATION_HEIGHT + 20 * CHUNK_SIZE
+        axe_net = self._make_axe_net([slow, bad, good], tip)
+        with mock.patch('electrum_axe.axe_net.MNLISTD_MAX_INFLIGHT', 4), \
+                mock.patch('electrum_axe.axe_net.MNLISTD_MAX_FAILURES', 2):
+            self._run_getmnlistd(axe_net)
+        mn_list = axe_net.network.mn_list
+        assert mn_list.protx_height == tip
+        assert not mn_list.notified
+        assert list(axe_net.peers) == [good.peer]
+        assert good.mnlistd_failures == 0
+        assert bad.mnlistd_failures >= 2
+        assert bad.closed and bad.peer in axe_net.banlist
+        assert slow.mnlistd_failures == 2
+        assert slow.closed and slow.peer not in axe_net.banlist
+
+    def test_getmnlistd_all_invalid(self):
+        bad = MNListDPeerMock('127.0.0.1:19937', latency=0.01, valid=False)
+        axe_net = self._make_axe_net([bad], 1000)
+        with mock.patch('electrum_axe.axe_net.MNLISTD_MAX_FAILURES', 10):
+            self._run_getmnlistd(axe_net)
+        mn_list = axe_net.network.mn_list
+        assert mn_list.notified == ['network-error']
+        assert not mn_list.applied
+        assert bad.requests == MNLISTD_MAX_TRIES
+        assert not axe_net.mnlistd_loading
+
+    def test_getmnlistd_root_mismatch(self):
+        tip = constants.net.DIP3_ACTIVATION_HEIGHT + 10 * CHUNK_SIZE
+        broken_height = tip - 5 * CHUNK_SIZE
+
+        # same mismatch from several peers resets broken local MNList
+        peers = [MNListDPeerMock(f'127.0.0.{i}:19937', latency=0.01)
+                 for i in range(4)]
+        axe_net = self._make_axe_net(peers, tip, broken_height)
+        mn_list = axe_net.network.mn_list
+        mn_list.broken = True
+        self._run_getmnlistd(axe_net)
+        assert not mn_list.notified
+        assert mn_list.resets == 1
+        assert mn_list.protx_height == tip
+        assert mn_list.applied[0][0] == 1
+        assert list(axe_net.peers) == [p.peer for p in peers]
+        assert not any(p.closed or p.mnlistd_failures for p in peers)
+        assert not axe_net.banlist
+
+        # list is reset only once, peers are not banned on mismatch
+        axe_net = self._make_axe_net(peers, tip, broken_height)
+        mn_list = axe_net.network.mn_list
+        mn_list.broken = mn_list.reset_keeps_broken = True
+        self._run_getmnlistd(axe_net)
+        assert mn_list.notified == ['network-error']
+        assert mn_list.resets == 1
+        assert not mn_list.applied
+        assert not any(p.closed or p.mnlistd_failures for p in peers)
+        assert not axe_net.banlist
+
+        # too few peers to blame local MNList
+        peers = peers[:MNLISTD_RESET_PEERS-1]
+        axe_net = self._make_axe_net(peers, tip, broken_height)
+        mn_list = axe_net.network.mn_list
+        mn_list.broken = True
+        self._run_getmnlistd(axe_net)
+        assert mn_list.notified == ['network-error']
+        assert mn_list.resets == 0
+        assert not mn_list.applied
+        assert not axe_net.banlist
+
+    def test_found_peers(self):
+        network = NetworkMock(self.config, {})
+        axe_net = AxeNet(network, self.config)
+        assert axe_net.found_peers == {}
+        now = time.time()
+        peers = [f'127.0.0.{i}:19937' for i in range(1, 51)]
+        axe_net.add_found_peers([(p, now - 3600, 1) for p in peers])
+        axe_net.add_found_peers([(peers[0], now + 3600, 0)])
+        assert len(axe_net.found_peers) == 50
+        assert axe_net.found_peers[peers[0]]['seen'] <= time.time()
+        assert axe_net.found_peers[peers[0]]['services'] == 1
+
+        # known good peer is preferred, failed peer waits for retry
+        good = MNListDPeerMock(peers[10])
+        good.ping_time = 50
+        axe_net._update_found_peer(peers[10], connected=True, axe_peer=good)
+        axe_net._update_found_peer(peers[20], connected=False)
+        assert axe_net.get_best_found_peer(set()) == peers[10]
+        assert axe_net.found_peers[peers[10]]['services'] == 5
+        assert axe_net.found_peers[peers[10]]['ping'] == 50
+        assert axe_net.get_best_found_peer({peers[10]}) != peers[20]
+        axe_net.found_peers[peers[20]]['ok'] = 10
+        axe_net.found_peers[peers[20]]['tries'] = 11
+        assert axe_net.get_best_found_peer({peers[10]}) != peers[20]
+        axe_net.found_peers[peers[20]]['last_try'] -= FOUND_PEER_RETRY_DELAY
+        assert axe_net.get_best_found_peer({peers[10]}) == peers[20]
+        axe_net.banlist[peers[10]] = {}
+        assert axe_net.get_best_found_peer(set()) == peers[20]
+        del axe_net.banlist[peers[10]]
+
+        # address book is restored on restart
+        axe_net._save_found_peers()
+        axe_net2 = AxeNet(network, self.config)
+        assert axe_net2.found_peers == axe_net.found_peers
+        assert axe_net2.get_best_found_peer(set()) == peers[10]
+
+        # eviction by age and by score, tried peers are limited separately
+        old_seen = now - FOUND_PEERS_MAX_AGE - 1
+        axe_net.found_peers[peers[30]]['seen'] = old_seen
+        with mock.patch('electrum_axe.axe_net.MAX_FOUND_PEERS', 10):
+            axe_net.add_found_peers([('127.0.1.1:19937', now, 1)])
+        assert len(axe_net.found_peers) == 12
+        assert peers[30] not in axe_net.found_peers
+        assert peers[10] in axe_net.found_peers
+        assert peers[20] in axe_net.found_peers
+        assert '127.0.1.1:19937' in axe_net.found_peers
+
+        # fresh relayed addrs do not outrank or evict tried peers
+        axe_net.found_peers[peers[10]]['seen'] = now - 5 * 24 * 3600
+        relayed = [(f'127.0.2.{i}:19937', now, 1) for i in range(1, 101)]
+        with mock.patch('electrum_axe.axe_net.MAX_FOUND_PEERS', 50):
+            axe_net.add_found_peers(relayed)
+        assert len(axe_net.found_peers) == 52
+        assert peers[10] in axe_net.found_peers
+        assert peers[20] in axe_net.found_peers
+        assert axe_net.get_best_found_peer({peers[20]}) == peers[10]
+        best_new = axe_net.get_best_found_peer({peers[10], peers[20]})
+        assert axe_net.found_peers[best_new]['ok'] == 0
+        with mock.patch('electrum_axe.axe_net.MAX_TRIED_FOUND_PEERS', 1):
+            axe_net.add_found_peers(relayed[:1])
+        assert peers[10] not in axe_net.found_peers  # lower scored tried
+        assert axe_net.get_best_found_peer(set()) == peers[20]
+
+    def test_is_valid_relayed_addr(self):
+        network = NetworkMock(self.config, {})
+        axe_net = AxeNet(network, self.config)
+        port = axe_net.default_port
+        ip = ipaddress.ip_address
+        assert axe_net.is_valid_relayed_addr(ip('8.8.8.8'), port, 5)
+        assert axe_net.is_valid_relayed_addr(ip('::ffff:8.8.8.8'), port, 1)
+        assert axe_net.is_valid_relayed_addr(ip('2a00:1450::1'), port, 1)
+        assert not axe_net.is_valid_relayed_addr(ip('8.8.8.8'), 8333, 1)
+        assert not axe_net.is_valid_relayed_addr(ip('8.8.8.8'), port, 0)
+        for addr in ['127.0.0.1', '10.0.0.1', '192.168.1.1', '0.0.0.0',
+                     '::ffff:10.0.0.1', '::1', '2001:db8::1', 'fe80::1']:
+            assert not axe_net.is_valid_relayed_addr(ip(addr), port, 1)
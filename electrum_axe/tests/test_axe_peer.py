@@ -0,0 +1,321 @@
+import asyncio
+import ipaddress
+import os
+import random
+import threading
+import time
+from struct import pack
+from unittest import mock
+
+from electrum_axe.axe_msg import (AxeVersionMsg, AxePingMsg, AxeCmd,
+                                   AxeMNListDiffMsg, AxeISLockMsg,
+                                   AxeAddrMsg, AxeNetIPAddr)
+from electrum_axe.axe_net import AxeNet
+from electrum_axe.axe_peer import (AxePeer, AxeMsgFramer, MSG_QUEUE_SIZE,
+                                   EMPTY_PAYLOAD_CHECKSUM)
+from electrum_axe.crypto import sha256d
+from electrum_axe.interface import GracefulDisconnect
+from electrum_axe.util import SilentTaskGroup, bfh
+
+from . import SequentialTestCase
+from .test_transaction import signed_blob
+
+
+START_STR = b'\xCE\xE2\xCA\xFF'
+
+
+def make_frame(cmd, payload=b''):
+    cmd = cmd.encode('ascii') + b'\x00' * (12 - len(cmd))
+    checksum = sha256d(payload)[:4] if payload else EMPTY_PAYLOAD_CHECKSUM
+    return START_STR + cmd + pack('<I', len(payload)) + checksum + payload
+
+
+def make_islock_payload():
+    return b'\x01' + os.urandom(36) + os.urandom(32) + os.urandom(96)
+
+
+def make_mnlistdiff_payload():
+    return (os.urandom(64) + pack('<I', 1) + b'\x00\x00' +
+            bfh(signed_blob) + b'\x00\x00')
+
+
+def make_version_payload():
+    ip = ipaddress.ip_address('127.0.0.1')
+    return AxeVersionMsg(70216, 0, int(time.time()), 1, ip, 19937,
+                         0, ip, 19937, random.getrandbits(64), '/fake/',
+                         0, 0, None, None).serialize()
+
+
+class ConfigMock:
+    path = '/tmp'
+
+
+class NetworkMock:
+    config = ConfigMock()
+
+    def get_local_height(self):
+        return 0
+
+    def get_network_timeout_seconds(self):
+        return 30
+
+
+class AxeNetMock:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.default_port = 19937
+        self.start_str = START_STR
+        self.network = NetworkMock()
+        self.main_taskgroup = SilentTaskGroup()
+        self.debug = False
+        self.read_bytes = 0
+        self.read_time = 0
+        self.write_bytes = 0
+        self.write_time = 0
+        self.islocks = []
+
+    def append_to_recent_islocks(self, islock):
+        self.islocks.append(islock)
+
+    async def connection_down(self, axe_peer):
+        pass
+
+
+class FakeAxePeer:
+    '''Local P2P peer doing version handshake, then sending msgs data'''
+
+    def __init__(self, data):
+        self.data = data
+        self.server = None
+        self.sent = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.on_connect,
+                                                 '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def on_connect(self, reader, writer):
+        async def read_all():
+            while await reader.read(4096):
+                pass
+        asyncio.ensure_future(read_all())
+        writer.write(make_frame('version', make_version_payload()) +
+                     make_frame('verack'))
+        await writer.drain()
+        for i in range(0, len(self.data), 2**16):
+            writer.write(self.data[i:i+2**16])
+            await writer.drain()
+        self.sent.set()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class AxePeerTestCase(SequentialTestCase):
+
+    def test_framer(self):
+        frames = [('islock', make_islock_payload()),
+                  ('verack', b''),
+                  ('ping', AxePingMsg(1).serialize())]
+        data = b''.join(make_frame(cmd, payload) for cmd, payload in frames)
+        data = b'junk' + START_STR[:2] + data
+        for chunk_size in (1, 3, 7, 50, len(data)):
+            framer = AxeMsgFramer(START_STR)
+            res = []
+            for i in range(0, len(data), chunk_size):
+                framer.feed(data[i:i+chunk_size])
+                frame = framer.next_frame()
+                while frame:
+                    res.append(frame)
+                    frame = framer.next_frame()
+            self.assertEqual(frames, [(cmd, payload)
+                                      for cmd, payload, checksum in res])
+            self.assertEqual(b'', bytes(framer.buf))
+
+        framer = AxeMsgFramer(START_STR)
+        framer.feed(START_STR + b'islock'.ljust(12, b'\x00') +
+                    pack('<I', 2**32-1) + b'\x00' * 4)
+        with self.assertRaises(GracefulDisconnect):
+            framer.next_frame()
+
+    def test_axe_cmd_lazy_decoding(self):
+        payload = make_islock_payload()
+        with mock.patch.object(AxeISLockMsg, 'read_vds',
+                               wraps=AxeISLockMsg.read_vds) as read_vds:
+            res = AxeCmd('islock', payload)
+            self.assertIs(payload, res.raw_payload)
+            self.assertEqual(0, read_vds.call_count)
+            self.assertIsInstance(res.payload, AxeISLockMsg)
+            self.assertIs(res.payload, res.payload)
+            self.assertEqual(1, read_vds.call_count)
+        res = AxeCmd('islock', payload + b'junk')
+        with self.assertRaises(Exception):
+            res.payload
+        res = AxeCmd('verack')
+        self.assertIsNone(res.payload)
+
+    def test_heavy_msgs_decoded_off_loop(self):
+        # qfcommit has no handler, its junk payload must not be decoded
+        data = (make_frame('mnlistdiff', make_mnlistdiff_payload()) +
+                make_frame('qfcommit', b'junk') +
+                make_frame('islock', make_islock_payload()))
+        decode_threads = []
+        read_vds = AxeMNListDiffMsg.read_vds
+
+        def read_vds_in_thread(vds, alone_data=False):
+            decode_threads.append(threading.current_thread())
+            return read_vds(vds, alone_data=alone_data)
+
+        diffs = []
+
+        async def on_mnlistdiff(res):
+            diffs.append(res.payload)
+
+        async def check(axe_net, axe_peer, fake_peer):
+            start = time.time()
+            while not axe_net.islocks or not diffs:
+                await asyncio.sleep(0.01)
+                self.assertLess(time.time() - start, 10)
+            diff = diffs[0]
+            self.assertIsInstance(diff, AxeMNListDiffMsg)
+            self.assertEqual(bfh(signed_blob), bfh(str(diff.cbTx)))
+
+        with mock.patch.object(AxeMNListDiffMsg, 'read_vds',
+                               side_effect=read_vds_in_thread), \
+                mock.patch.object(AxePeer, 'on_mnlistdiff',
+                                  side_effect=on_mnlistdiff):
+            self._run_peer(data, check)
+        self.assertEqual(1, len(decode_threads))
+        self.assertIsNot(threading.main_thread(), decode_threads[0])
+
+    def test_getmnlistd_pipelined(self):
+        loop = asyncio.new_event_loop()
+        axe_peer = AxePeer.__new__(AxePeer)
+        axe_peer.loop = loop
+        axe_peer.axe_net = mock.Mock()
+        axe_peer.mnlistd_requests = {}
+        axe_peer.logger = mock.Mock()
+        sent = []
+
+        async def get_hash(height):
+            return height.to_bytes(32, 'little')
+
+        async def send_msg(cmd, payload=b''):
+            sent.append((cmd, payload))
+
+        axe_peer.axe_net.get_hash = get_hash
+        axe_peer.send_msg = send_msg
+
+        async def run():
+            reqs = [asyncio.ensure_future(axe_peer.getmnlistd(h, h + 10))
+                    for h in (1, 11, 21)]
+            await asyncio.sleep(0.01)
+            self.assertEqual(3, len(sent))
+            self.assertEqual(3, len(axe_peer.mnlistd_requests))
+            diffs = {}
+            for h in (21, 1, 11, 100):  # out of order and unasked
+                diff = AxeMNListDiffMsg(h.to_bytes(32, 'little'),
+                                        (h + 10).to_bytes(32, 'little'),
+                                        0, [], [], None, [], [], [], [])
+                diffs[h] = diff
+                await axe_peer.on_mnlistdiff(mock.Mock(payload=diff))
+            res = await asyncio.gather(*reqs)
+            self.assertEqual([diffs[1], diffs[11], diffs[21]], res)
+            self.assertEqual({}, axe_peer.mnlistd_requests)
+            with self.assertRaises(asyncio.TimeoutError):
+                await axe_peer.getmnlistd(1, 11, timeout=0.01)
+            self.assertEqual({}, axe_peer.mnlistd_requests)
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        axe_peer.logger.info.assert_called_once_with('unasked mnlistdiff msg')
+
+    def test_on_addr(self):
+        axe_peer = AxePeer.__new__(AxePeer)
+        axe_net = axe_peer.axe_net = mock.Mock(default_port=19937)
+        axe_net.is_valid_relayed_addr = \
+            lambda *args: AxeNet.is_valid_relayed_addr(axe_net, *args)
+        ip4 = ipaddress.ip_address('::ffff:8.8.8.8')
+        ip6 = ipaddress.ip_address('2a00:1450::1')
+        private_ip = ipaddress.ip_address('::ffff:10.0.0.1')
+        payload = AxeAddrMsg([AxeNetIPAddr(1000, 1, ip4, 19937),
+                              AxeNetIPAddr(2000, 5, ip6, 19937),
+                              AxeNetIPAddr(3000, 1, private_ip, 19937),
+                              AxeNetIPAddr(4000, 1, ip4, 19999),
+                              AxeNetIPAddr(5000, 0, ip6, 19937)])
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                axe_peer.on_addr(mock.Mock(payload=payload)))
+        finally:
+            loop.close()
+        axe_peer.axe_net.add_found_peers.assert_called_once_with(
+            [('8.8.8.8:19937', 1000, 1), ('2a00:1450::1:19937', 2000, 5)])
+
+    def _run_peer(self, data, check):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        fake_peer = FakeAxePeer(data)
+
+        async def run():
+            port = await fake_peer.start()
+            axe_net = AxeNetMock(loop)
+            axe_peer = AxePeer(axe_net, f'127.0.0.1:{port}', None)
+            await asyncio.wait_for(axe_peer.ready, 10)
+            try:
+                return await check(axe_net, axe_peer, fake_peer)
+            finally:
+                axe_peer.close()
+                await axe_net.main_taskgroup.cancel_remaining()
+                await fake_peer.stop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_msgs_throughput(self):
+        n = 5000
+        data = b''.join(make_frame('islock', make_islock_payload())
+                        for i in range(n))
+
+        async def check(axe_net, axe_peer, fake_peer):
+            start = time.time()
+            while len(axe_net.islocks) < n:
+                await asyncio.sleep(0.01)
+                self.assertLess(time.time() - start, 30)
+            return n / (time.time() - start)
+
+        msgs_per_sec = self._run_peer(data, check)
+        print(f'axe peer msgs/s: {msgs_per_sec:.0f}')
+
+    def test_msgs_backpressure(self):
+        n = 20000
+        data = b''.join(make_frame('islock', make_islock_payload())
+                        for i in range(n))
+        handler_blocked = asyncio.Event()
+
+        async def check(axe_net, axe_peer, fake_peer):
+            async def on_islock(res):
+                await handler_blocked.wait()
+                axe_net.append_to_recent_islocks(res.payload)
+            axe_peer.msg_handlers['islock'] = on_islock
+            queue = axe_peer.msg_queues['islock']
+            start = time.time()
+            while not queue.full():
+                await asyncio.sleep(0.01)
+                self.assertLess(time.time() - start, 10)
+            await asyncio.sleep(0.5)
+            self.assertEqual(MSG_QUEUE_SIZE, queue.qsize())
+            self.assertLess(axe_peer.read_bytes, len(data) // 2)
+            handler_blocked.set()
+            while len(axe_net.islocks) < n:
+                await asyncio.sleep(0.01)
+                self.assertLess(time.time() - start, 30)
+            self.assertEqual(n, len(axe_net.islocks))
+
+        self._run_peer(data, check)
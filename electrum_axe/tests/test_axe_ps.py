@@ -8,6 +8,7 @@ import tempfile
 import time
 from collections import defaultdict
 from pprint import pprint
+from unittest import mock
 
 from electrum_axe import axe_ps, ecc
 from electrum_axe.bitcoin import TYPE_ADDRESS
@@ -19,7 +20,7 @@ from electrum_axe.axe_ps import (COLLATERAL_VAL, PSPossibleDoubleSpendError,
                                    PSTxWorkflow, PSDenominateWorkflow,
                                    PSMinRoundsCheckFailed, PS_DENOMS_VALS,
                                    filter_log_line, KPStates, KP_ALL_TYPES,
-                                   KP_SPENDABLE, KP_PS_COINS,
+                                   KP_SPENDABLE, KP_PS_SPENDABLE, KP_PS_COINS,
                                    KP_PS_CHANGE, PSStates, calc_tx_size,
                                    calc_tx_fee, FILTERED_TXID, FILTERED_ADDR,
                                    CREATE_COLLATERAL_VALS, MIN_DENOM_VAL)
@@ -285,6 +286,72 @@ class PSWalletTestCase(TestCaseForTestnet):
                               '057673ebae64d05864827b5dd808fb23:0')
         assert ps_collateral == ('yiozDzgTrjyXqie28y7z2YEmjaYUZ7gveQ', 20000)
 
+    def test_find_untracked_ps_txs_scanned(self):
+        w = self.wallet
+        psman = w.psman
+        txids = w.db.list_transactions()
+        assert not w.db.get_ps_scanned_txs()
+
+        coro = psman.find_untracked_ps_txs(log=False)
+        found_txs = asyncio.get_event_loop().run_until_complete(coro)
+        assert found_txs == 86
+        assert set(w.db.get_ps_scanned_txs()) == set(txids)
+
+        # no txs added since last scan, nothing to check
+        check_ps_tx_type = psman._check_ps_tx_type
+        with mock.patch.object(psman, '_check_ps_tx_type',
+                               wraps=check_ps_tx_type) as check:
+            coro = psman.find_untracked_ps_txs(log=False)
+            found_txs = asyncio.get_event_loop().run_until_complete(coro)
+            assert found_txs == 0
+            check.assert_not_called()
+
+        # only not scanned txs and their children are checked
+        removed_txid = txids[-3]
+        tx = w.db.remove_transaction(removed_txid)
+        assert removed_txid not in w.db.get_ps_scanned_txs()
+        w.db.add_transaction(removed_txid, tx)
+        candidates = psman._get_untracked_candidates(txids)
+        assert candidates <= ({removed_txid} |
+                              psman._get_spending_txids(removed_txid))
+
+        # full scan after ps data is cleared
+        w.db.clear_ps_data()
+        assert not w.db.get_ps_scanned_txs()
+        coro = psman.find_untracked_ps_txs(log=False)
+        found_txs = asyncio.get_event_loop().run_until_complete(coro)
+        assert found_txs == 86
+
+    def test_find_untracked_ps_txs_after_db_reload(self):
+        w = self.wallet
+        psman = w.psman
+        # not spent txs sorting first by txid are received after first scan
+        late_txids = [txid for txid in sorted(w.db.list_transactions())
+                      if not psman._get_spending_txids(txid)][:5]
+        late_txs = [(txid, w.db.remove_transaction(txid))
+                    for txid in late_txids]
+        coro = psman.find_untracked_ps_txs(log=False)
+        found_txs = asyncio.get_event_loop().run_until_complete(coro)
+        assert found_txs < 86
+        for txid, tx in late_txs:
+            w.db.add_transaction(txid, tx)
+        assert w.db.list_transactions()[-5:] == late_txids
+
+        # dump writes txs sorted by txid, which changes their order
+        reloaded_path = os.path.join(self.user_dir, 'wallet_ps1_reloaded')
+        with open(reloaded_path, 'w') as wfh:
+            wfh.write(w.db.dump())
+        w2 = Wallet(WalletStorage(reloaded_path))
+        txids = w2.db.list_transactions()
+        assert txids == sorted(txids)
+        psman2 = w2.psman
+        psman2.state = PSStates.Ready
+        psman2.loop = asyncio.get_event_loop()
+        coro = psman2.find_untracked_ps_txs(log=False)
+        found_txs2 = asyncio.get_event_loop().run_until_complete(coro)
+        assert found_txs + found_txs2 == 86
+        assert set(w2.db.get_ps_scanned_txs()) == set(txids)
+
     def test_ps_history_show_all(self):
         psman = self.wallet.psman
         coro = psman.find_untracked_ps_txs(log=False)
@@ -432,6 +499,65 @@ class PSWalletTestCase(TestCaseForTestnet):
             else:
                 assert ps_rounds is None
 
+    def _balance_variants(self, wallet):
+        frozen_coins = set(list(wallet.db.get_ps_denoms())[:3])
+        res = [wallet.get_balance(),
+               wallet.get_balance(include_ps=False),
+               wallet.get_balance(excluded_addresses=wallet.frozen_addresses,
+                                  excluded_coins=frozen_coins),
+               wallet.get_balance(wallet.get_addresses()[:10])]
+        for r in range(-1, 6):
+            res.append(wallet.get_balance(include_ps=False, min_rounds=r))
+        for addr in wallet.get_addresses():
+            res.append(wallet.get_addr_balance(addr))
+        return res
+
+    def _check_balance_ledger(self, wallet):
+        res = self._balance_variants(wallet)
+        wallet.reset_balance_ledger()
+        assert res == self._balance_variants(wallet)
+
+    def test_balance_ledger_deltas(self):
+        wallet = self.wallet
+        psman = wallet.psman
+        self._check_balance_ledger(wallet)
+        coro = psman.find_untracked_ps_txs(log=False)
+        asyncio.get_event_loop().run_until_complete(coro)
+        self._check_balance_ledger(wallet)
+        assert wallet.get_balance(include_ps=False, min_rounds=2) == \
+            (384803848, 0, 0)
+
+        # change rounds of denom
+        outpoint, denom = list(wallet.db.get_ps_denoms(min_rounds=2).items())[0]
+        psman.pop_ps_denom(outpoint)
+        assert wallet.get_balance(include_ps=False, min_rounds=2) == \
+            (384803848 - denom[1], 0, 0)
+        psman.add_ps_denom(outpoint, (denom[0], denom[1], 4))
+        assert wallet.get_balance(include_ps=False, min_rounds=4) == \
+            (denom[1], 0, 0)
+        self._check_balance_ledger(wallet)
+
+        # new unconfirmed tx, then islock on it
+        coins = wallet.get_spendable_coins(domain=None, config=self.config)
+        addr = wallet.get_unused_address()
+        outputs = [TxOutput(TYPE_ADDRESS, addr, 300000)]
+        tx = wallet.make_unsigned_transaction(coins, outputs,
+                                              config=self.config)
+        wallet.sign_transaction(tx, None)
+        txid = tx.txid()
+        wallet.add_unverified_tx(txid, TX_HEIGHT_UNCONFIRMED)
+        wallet.add_transaction(txid, tx)
+        c, u, x = wallet.get_balance()
+        assert u != 0
+        self._check_balance_ledger(wallet)
+        wallet.db.add_islock(txid)
+        wallet._mark_tx_balance_changed(txid)
+        assert wallet.get_balance() == (c + u, 0, 0)
+        self._check_balance_ledger(wallet)
+
+        wallet.remove_transaction(txid)
+        self._check_balance_ledger(wallet)
+
     def test_get_balance(self):
         wallet = self.wallet
         psman = wallet.psman
@@ -998,6 +1124,55 @@ class PSWalletTestCase(TestCaseForTestnet):
         assert w.db.ps_denoms == {}
         assert psman._ps_denoms_amount_cache == 0
 
+    def test_ps_addresses_indexes(self):
+        w = self.wallet
+        psman = w.psman
+        addr1, addr2, addr3, addr4 = w.get_unused_addresses()[:4]
+        outpoint1 = '0'*64 + ':0'
+        outpoint2 = '1'*64 + ':0'
+        outpoint3 = '2'*64 + ':0'
+        psman.add_ps_denom(outpoint1, (addr1, 100001, 0))
+        psman.add_ps_denom(outpoint2, (addr2, 100001, 2))
+        w.db.add_ps_collateral(outpoint3, (addr3, 10000))
+        psman.add_ps_reserved(addr4, 'test')
+
+        assert w.db.get_ps_denoms(min_rounds=1) == \
+            {outpoint2: (addr2, 100001, 2)}
+        assert w.db.get_ps_denoms(max_rounds=1) == \
+            {outpoint1: (addr1, 100001, 0)}
+        assert w.db.get_ps_addresses(min_rounds=1) == {addr2}
+        assert w.db.get_ps_addresses() == {addr1, addr2, addr3, addr4}
+        assert w.db.get_unspent_ps_addresses() == {addr1, addr2, addr3, addr4}
+        assert w.db.get_ps_addr_categories(addr3) == {'ps_collaterals'}
+        assert w.db.select_ps_reserved(data='test') == [addr4]
+
+        # denom rounds changed
+        psman.pop_ps_denom(outpoint1)
+        psman.add_ps_denom(outpoint1, (addr1, 100001, 1))
+        assert w.db.get_ps_addresses(min_rounds=1) == {addr1, addr2}
+
+        # collateral spent, address is still used by ps
+        w.db.pop_ps_collateral(outpoint3)
+        w.db.add_ps_spent_collateral(outpoint3, (addr3, 10000))
+        assert w.db.get_ps_addresses() == {addr1, addr2, addr3, addr4}
+        assert w.db.get_unspent_ps_addresses() == {addr1, addr2, addr4}
+        assert w.db.get_ps_addr_categories(addr3) == {'ps_spent_collaterals'}
+
+        psman.pop_ps_reserved(addr4)
+        assert w.db.select_ps_reserved(data='test') == []
+        assert w.db.get_ps_addresses() == {addr1, addr2, addr3}
+
+        # indexes built on load are the same as updated ones
+        ps_addrs = w.db._ps_addrs
+        ps_denoms_by_rounds = w.db._ps_denoms_by_rounds
+        w.db._load_ps_indexes()
+        assert w.db._ps_addrs == ps_addrs
+        assert w.db._ps_denoms_by_rounds == ps_denoms_by_rounds
+
+        w.db.clear_ps_data()
+        assert w.db.get_ps_addresses() == set()
+        assert w.db.get_ps_denoms(min_rounds=0) == {}
+
     def test_denoms_to_mix_cache(self):
         w = self.wallet
         psman = w.psman
@@ -2978,6 +3153,57 @@ class PSWalletTestCase(TestCaseForTestnet):
         assert psman._keypairs_cache == {}
         psman.state = PSStates.Ready
 
+    def test_refill_keypairs(self):
+        w = self.wallet
+        psman = w.psman
+        psman.config = self.config
+
+        psman.mix_rounds = 2
+        psman.keep_amount = 2
+        psman.state = PSStates.Mixing
+        psman._cache_keypairs(password=None)
+        assert psman._keypairs_targets == {KP_PS_COINS: 259, KP_PS_CHANGE: 12}
+        assert psman.keypairs_stats['derived'] == 137 + 259 + 12
+        assert not psman.need_keypairs_refill()
+
+        # batch derived keys are the same as derived one by one
+        for addr, (x_pubkey, sec) in list(
+                psman._keypairs_cache[KP_PS_COINS].items())[:5]:
+            sequence = w.get_address_index(addr)
+            assert sec == w.keystore.get_private_key(sequence, None)
+
+        ps_coins_cache = psman._keypairs_cache[KP_PS_COINS]
+        ps_spendable_cache = psman._keypairs_cache[KP_PS_SPENDABLE]
+        popped = [(addr, ps_coins_cache.pop(addr))
+                  for addr in list(ps_coins_cache.keys())[:130]]
+        assert psman.need_keypairs_refill()
+
+        # refill is stopped with mixing, cache is not cleaned
+        psman.state = PSStates.StopMixing
+        assert psman._refill_keypairs(password=None) is None
+        psman.state = PSStates.Mixing
+        assert len(ps_coins_cache) == 129
+
+        # keys are derived outside of the cache
+        refilled = psman._refill_keypairs(password=None)
+        assert len(ps_coins_cache) == 129
+        assert set(refilled[KP_PS_COINS]) == set(a for a, kp in popped)
+        assert refilled[KP_PS_CHANGE] == {}
+        assert psman.keypairs_stats['derived'] == 137 + 259 + 12 + 130
+
+        # keypair moved to other cache meanwhile is not added again
+        moved_addr, moved_kp = popped[0]
+        ps_spendable_cache[moved_addr] = moved_kp
+        psman._merge_refilled_keypairs(refilled)
+        assert moved_addr not in ps_coins_cache
+        assert len(ps_coins_cache) == 258
+        assert not psman.need_keypairs_refill()
+        assert psman.keypairs_stats['refills'] == 1
+
+        psman._cleanup_all_keypairs_cache()
+        assert psman._keypairs_targets == {}
+        assert not psman.need_keypairs_refill()
+
     def test_cache_keypairs_on_small_mix_funds(self):
         w = self.wallet
         psman = w.psman
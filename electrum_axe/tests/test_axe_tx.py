@@ -3,6 +3,7 @@ from electrum_axe.axe_tx import AxeTxError, TxOutPoint
 from electrum_axe.transaction import BCDataStream
 from electrum_axe.util import bfh, bh2u
 from electrum_axe.commands import Commands
+from electrum_axe.crypto import sha256d
 
 from . import SequentialTestCase
 
@@ -509,6 +510,17 @@ class TestAxeSpecTxSerialization(SequentialTestCase):
         ser = tx.serialize()
         assert ser == WRONG_SPEC_TX
 
+    def test_axe_tx_serialize_to_network_bytes(self):
+        for raw_tx in [V2_TX, CB_TX, CB_TX_V2, PRO_REG_TX, PRO_UP_SERV_TX,
+                       PRO_UP_REG_TX, PRO_UP_REV_TX, SUB_TX_REGISTER,
+                       SUB_TX_TOPUP, SUB_TX_RESET_KEY, SUB_TX_CLOSE_ACCOUNT,
+                       WRONG_SPEC_TX]:
+            tx = transaction.Transaction(raw_tx)
+            ser = tx.serialize_to_network_bytes()
+            assert isinstance(ser, bytes)
+            assert ser == bfh(raw_tx)
+            assert tx.txid() == bh2u(sha256d(bfh(raw_tx))[::-1])
+
     def test_deserialize_transaction_v2(self):
         cmds = Commands(config=None, wallet=None, network=None)
         deser = cmds.deserialize(V2_TX)
@@ -12,7 +12,8 @@ from electrum_axe.bitcoin import (public_key_to_p2pkh, address_from_private_key,
 from electrum_axe.bip32 import (BIP32Node, convert_bip32_intpath_to_strpath,
                                  xpub_from_xprv, xpub_type, is_xprv, is_bip32_derivation,
                                  is_xpub, convert_bip32_path_to_list_of_uint32,
-                                 normalize_bip32_derivation)
+                                 normalize_bip32_derivation, CKD_pub,
+                                 CKD_pub_batch, BIP32_PRIME)
 from electrum_axe.crypto import sha256d, SUPPORTED_PW_HASH_VERSIONS
 from electrum_axe import ecc, crypto, constants
 from electrum_axe.ecc import number_to_string, string_to_number
@@ -421,6 +422,35 @@ class Test_xprv_xpub(SequentialTestCase):
             result = xpub_from_xprv(xprv_details['xprv'])
             self.assertEqual(result, xprv_details['xpub'])
 
+    @needs_test_with_all_ecc_implementations
+    def test_ckd_pub_batch(self):
+        node = BIP32Node.from_xkey(self.xprv_xpub[0]['xpub'])
+        pubkey = node.eckey.get_public_key_bytes(compressed=True)
+        indexes = [0, 1, 5, 1000000000, 3]
+        batch = CKD_pub_batch(pubkey, node.chaincode, indexes)
+        self.assertEqual([CKD_pub(pubkey, node.chaincode, i)[0]
+                          for i in indexes], batch)
+        with self.assertRaises(Exception):
+            CKD_pub_batch(pubkey, node.chaincode, [0, BIP32_PRIME])
+
+    @needs_test_with_all_ecc_implementations
+    def test_xpub_derive_pubkeys(self):
+        ks = from_master_key(self.xprv_xpub[0]['xpub'])
+        for for_change in (0, 1):
+            pubkeys = ks.derive_pubkeys(for_change, range(10))
+            ks2 = from_master_key(self.xprv_xpub[0]['xpub'])
+            self.assertEqual([ks2.derive_pubkey(for_change, n)
+                              for n in range(10)], pubkeys)
+            self.assertEqual(pubkeys[3], ks.derive_pubkey(for_change, 3))
+            self.assertEqual(pubkeys[2:7],
+                             ks.derive_pubkeys(for_change, range(2, 7)))
+            node = BIP32Node.from_xkey(self.xprv_xpub[0]['xpub'])
+            node = node.subkey_at_public_derivation((for_change, 7))
+            self.assertEqual(node.eckey.get_public_key_hex(), pubkeys[7])
+        ks.PUBKEYS_CACHE_SIZE = 5
+        ks.derive_pubkeys(0, range(100, 120))
+        self.assertEqual(5, len(ks._pubkeys_cache))
+
     @needs_test_with_all_ecc_implementations
     def test_is_xpub(self):
         for xprv_details in self.xprv_xpub:
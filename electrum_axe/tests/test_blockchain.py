@@ -1,6 +1,10 @@
+import json
+import random
 import shutil
+import tarfile
 import tempfile
 import os
+from unittest import mock
 
 from electrum_axe import constants, blockchain
 from electrum_axe.simple_config import SimpleConfig
@@ -343,3 +347,289 @@ class TestBlockchain(SequentialTestCase):
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
 '''
+
+
+class TestBlockchainHeaderStore(SequentialTestCase):
+
+    HEADERS = TestBlockchain.HEADERS
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_testnet()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.data_dir)
+
+    def _append_header(self, chain: Blockchain, header: dict):
+        self.assertTrue(chain.can_connect(header))
+        chain.save_header(header)
+
+    def _make_main_chain(self, names: str) -> Blockchain:
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        for name in names:
+            self._append_header(chain, self.HEADERS[name])
+        return chain
+
+    @staticmethod
+    def _next_header(prev: dict, nonce: int) -> dict:
+        # testnet skips the PoW check, so any header linking to prev connects
+        return {
+            'version': 0x20000000,
+            'prev_block_hash': hash_header(prev),
+            'merkle_root': '11' * 32,
+            'timestamp': prev['timestamp'] + 150,
+            'bits': prev['bits'],
+            'nonce': nonce,
+            'block_height': prev['block_height'] + 1,
+        }
+
+    def test_header_store_after_truncating_write(self):
+        chain_u = self._make_main_chain('ABCDEFOPQ')
+        for i, name in enumerate('ABCDEFOPQ'):
+            self.assertEqual(self.HEADERS[name], chain_u.read_header(i))
+            if i > 0:
+                self.assertEqual(hash_header(self.HEADERS[name]), chain_u.get_hash(i))
+        # returned headers are copies, the cached ones stay intact
+        chain_u.read_header(5)['bits'] = 0
+        self.assertEqual(self.HEADERS['F'], chain_u.read_header(5))
+
+        chain_u.write(b'', 5 * 80)
+        self.assertEqual(4, chain_u.height())
+        self.assertIsNone(chain_u.read_header(5))
+        self.assertRaises(blockchain.MissingHeader, chain_u.get_hash, 6)
+        self.assertEqual(self.HEADERS['E'], chain_u.read_header(4))
+
+        self._append_header(chain_u, self.HEADERS['F'])
+        self._append_header(chain_u, self.HEADERS['O'])
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u.get_hash(6))
+
+    def test_header_store_after_swap_with_parent(self):
+        chain_u = self._make_main_chain('ABCDEFOP')
+        g = self._next_header(self.HEADERS['F'], 1)
+        h = self._next_header(g, 2)
+        i = self._next_header(h, 3)
+        chain_l = chain_u.fork(g)
+        self._append_header(chain_l, h)
+        # fill both stores before the swap
+        for height, name in enumerate('ABCDEFOP'):
+            self.assertEqual(self.HEADERS[name], chain_u.read_header(height))
+            self.assertEqual(hash_header(self.HEADERS[name]), chain_u.get_hash(height))
+        for height, header in ((5, self.HEADERS['F']), (6, g), (7, h)):
+            self.assertEqual(header, chain_l.read_header(height))
+            self.assertEqual(hash_header(header), chain_l.get_hash(height))
+
+        # chainwork on testnet is the height: one more header makes chain_l win
+        self._append_header(chain_l, i)
+        self.assertIsNone(chain_l.parent)
+        self.assertEqual(chain_l, chain_u.parent)
+        self.assertEqual(0, chain_l.forkpoint)
+        self.assertEqual(6, chain_u.forkpoint)
+        self.assertEqual(8, chain_l.height())
+        self.assertEqual(7, chain_u.height())
+
+        for height, header in enumerate([self.HEADERS[n] for n in 'ABCDEF'] + [g, h, i]):
+            self.assertEqual(header, chain_l.read_header(height))
+            self.assertEqual(hash_header(header), chain_l.get_hash(height))
+        for height, name in enumerate('ABCDEFOP'):
+            self.assertEqual(self.HEADERS[name], chain_u.read_header(height))
+            self.assertEqual(hash_header(self.HEADERS[name]), chain_u.get_hash(height))
+        self.assertIsNone(chain_u.read_header(8))
+        self.assertRaises(blockchain.MissingHeader, chain_u.get_hash, 8)
+
+        # both chains keep working after the swap
+        self._append_header(chain_l, self._next_header(i, 4))
+        self.assertEqual(9, chain_l.height())
+        self._append_header(chain_u, self.HEADERS['Q'])
+        self.assertEqual(self.HEADERS['Q'], chain_u.read_header(8))
+        self.assertEqual(hash_header(self.HEADERS['Q']), chain_u.get_hash(8))
+
+
+def dgw_v3_reference(prev_headers) -> int:
+    """Straightforward DGW v3 over the DGW_PAST_BLOCKS headers preceding
+    a height (oldest first), as it was computed before DGWv3Window."""
+    count_blocks = 1
+    while count_blocks <= blockchain.DGW_PAST_BLOCKS:
+        reading_header = prev_headers[-count_blocks]
+        reading_time = reading_header['timestamp']
+        reading_target = Blockchain.bits_to_target(reading_header['bits'])
+        if count_blocks == 1:
+            past_target_avg = reading_target
+            last_time = reading_time
+        past_target_avg = \
+            (past_target_avg * count_blocks + reading_target) // \
+                (count_blocks + 1)
+        count_blocks += 1
+    new_target = past_target_avg
+    actual_timespan = last_time - reading_time
+    target_timespan = blockchain.DGW_PAST_BLOCKS * blockchain.POW_TARGET_SPACING
+    actual_timespan = max(actual_timespan, target_timespan // 3)
+    actual_timespan = min(actual_timespan, target_timespan * 3)
+    new_target = new_target * actual_timespan // target_timespan
+    if new_target > blockchain.MAX_TARGET:
+        return blockchain.MAX_TARGET
+    return Blockchain.bits_to_target(Blockchain.target_to_bits(new_target))
+
+
+def read_mainnet_checkpoints() -> list:
+    if constants.BitcoinMainnet.CHECKPOINTS:
+        return constants.BitcoinMainnet.CHECKPOINTS
+    # checkpoints.json.gz may be shipped as a tar archive of checkpoints.json
+    path = os.path.join(os.path.dirname(constants.__file__), 'checkpoints.json.gz')
+    with tarfile.open(path) as tar:
+        return json.loads(tar.extractfile('checkpoints.json').read().decode('utf-8'))
+
+
+class TestDGWv3(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_testnet()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.data_dir)
+
+    @staticmethod
+    def _make_headers(start_height: int, count: int, prev_hash: str) -> list:
+        rnd = random.Random(start_height)
+        headers = []
+        timestamp = 1550000000
+        for height in range(start_height, start_height + count):
+            # irregular block times hit both timespan clamps
+            timestamp += rnd.choice([1, 30, 150, 150, 600, 3000])
+            header = {
+                'version': 0x20000000,
+                'prev_block_hash': prev_hash,
+                'merkle_root': '%064x' % height,
+                'timestamp': timestamp,
+                'bits': rnd.randint(0x19, 0x1d) << 24 | rnd.randint(0x8000, 0x7fffff),
+                'nonce': height,
+                'block_height': height,
+            }
+            prev_hash = hash_header(header)
+            headers.append(header)
+        return headers
+
+    def test_window_matches_mainnet_checkpoints(self):
+        checkpoints = read_mainnet_checkpoints()
+        self.assertTrue(len(checkpoints) > 0)
+        checked = 0
+        for cp_hash, cp_target, dgw3_headers in checkpoints:
+            headers = {height: deserialize_header(bfh(raw), height)
+                       for height, raw in dgw3_headers}
+            height = max(headers)
+            if height < blockchain.POW_DGW3_HEIGHT:
+                continue
+            window = blockchain.DGWv3Window()
+            for h in range(height - blockchain.DGW_PAST_BLOCKS, height):
+                self.assertFalse(window.is_full())
+                window.push(headers[h])
+            target = window.next_target()
+            self.assertEqual(cp_target, target)
+            self.assertEqual(headers[height]['bits'], Blockchain.target_to_bits(target))
+            self.assertEqual(cp_hash, hash_header(headers[height]))
+            checked += 1
+        self.assertTrue(checked > 0)
+
+    def test_window_matches_reference_fold(self):
+        headers = self._make_headers(100000, 500, '00' * 32)
+        window = blockchain.DGWv3Window()
+        for i, header in enumerate(headers):
+            if i < blockchain.DGW_PAST_BLOCKS:
+                self.assertRaises(blockchain.MissingHeader, window.next_target)
+            else:
+                self.assertEqual(dgw_v3_reference(headers[:i]), window.next_target())
+            window.push(header)
+        targets = [dgw_v3_reference(headers[:i]) for i in range(24, len(headers))]
+        self.assertTrue(len(set(targets)) > 400)
+        window.push(None)
+        self.assertFalse(window.is_full())
+        self.assertRaises(blockchain.MissingHeader, window.next_target)
+
+    def _make_chain_with_headers(self, headers: list) -> Blockchain:
+        # sparse headers file, as after Network._init_headers_file
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        with open(chain.path(), 'wb') as f:
+            for header in headers:
+                f.seek(header['block_height'] * blockchain.HEADER_SIZE)
+                f.write(bfh(blockchain.serialize_header(header)))
+        chain.update_size()
+        blockchain.blockchains[constants.net.GENESIS] = chain
+        return chain
+
+    def test_verify_chunk_seeds_window_from_stored_headers(self):
+        index = blockchain.POW_DGW3_HEIGHT // 2016 + 1
+        start_height = index * 2016
+        past_blocks = blockchain.DGW_PAST_BLOCKS
+        headers = self._make_headers(start_height - past_blocks, past_blocks + 60, '00' * 32)
+        chain = self._make_chain_with_headers(headers[:past_blocks])
+        data = b''.join(bfh(blockchain.serialize_header(h)) for h in headers[past_blocks:])
+
+        targets = {}
+        verify_header = Blockchain.verify_header
+        def record_target(header, prev_hash, target, expected_header_hash=None, header_hash=None):
+            targets[header['block_height']] = target
+            verify_header(header, prev_hash, target, expected_header_hash, header_hash)
+        with mock.patch.object(Blockchain, 'verify_header', side_effect=record_target):
+            chain.verify_chunk(index, data)
+
+        self.assertEqual(60, len(targets))
+        self.assertTrue(len(set(targets.values())) > 50)
+        for i in range(past_blocks, len(headers)):
+            height = headers[i]['block_height']
+            self.assertEqual(dgw_v3_reference(headers[:i]), targets[height])
+        # the first target only depends on stored headers
+        self.assertEqual(chain.get_target(start_height), targets[start_height])
+
+    def test_verify_chunk_below_dgw_height_ignores_bits(self):
+        # regtest-style bits are no valid DGW target, but are never needed
+        headers = self._make_headers(2015, 3, '00' * 32)
+        for header in headers:
+            header['bits'] = 0x207fffff
+        for i in (1, 2):
+            headers[i]['prev_block_hash'] = hash_header(headers[i-1])
+        chain = self._make_chain_with_headers(headers[:1])
+        data = b''.join(bfh(blockchain.serialize_header(h)) for h in headers[1:])
+        chain.verify_chunk(1, data)
+
+    def test_verify_chunk_missing_header_before_chunk(self):
+        index = blockchain.POW_DGW3_HEIGHT // 2016 + 1
+        start_height = index * 2016
+        past_blocks = blockchain.DGW_PAST_BLOCKS
+        headers = self._make_headers(start_height - past_blocks, past_blocks + 10, '00' * 32)
+        # the oldest header of the window is missing from the file
+        chain = self._make_chain_with_headers(headers[1:past_blocks])
+        data = b''.join(bfh(blockchain.serialize_header(h)) for h in headers[past_blocks:])
+        self.assertRaises(blockchain.MissingHeader, chain.verify_chunk, index, data)
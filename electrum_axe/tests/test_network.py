@@ -1,21 +1,30 @@
 import asyncio
+import concurrent.futures
 import tempfile
+import threading
 import unittest
+from typing import Dict
 
 from electrum_axe import constants
 from electrum_axe.simple_config import SimpleConfig
 from electrum_axe import blockchain
 from electrum_axe.interface import Interface
+from electrum_axe.network import Network
 from electrum_axe.crypto import sha256
-from electrum_axe.util import bh2u
+from electrum_axe.util import bh2u, bfh
 
 
 class MockTaskGroup:
     async def spawn(self, x): return
 
+class MockLogger:
+    def info(self, msg): return
+
 class MockNetwork:
     main_taskgroup = MockTaskGroup()
     asyncio_loop = asyncio.get_event_loop()
+    def get_chunk_hash_executor(self): return None
+    def trigger_callback(self, event, *args): return
 
 class MockInterface(Interface):
     def __init__(self, config):
@@ -114,6 +123,104 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class MockChunkSession:
+    def __init__(self, headers):
+        self.headers = headers  # type: Dict[int, dict]
+        self.requests = []
+    async def send_request(self, method, params, timeout=None):
+        assert method == 'blockchain.block.headers', method
+        start, count = params
+        self.requests.append(start // 2016)
+        heights = [h for h in range(start, start + count) if h in self.headers]
+        data = ''.join(blockchain.serialize_header(self.headers[h]) for h in heights)
+        return {'hex': data, 'count': len(heights), 'max': 2016}
+
+
+class TestChunkCatchup(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        blockchain.blockchains = {}
+        self.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network")})
+        self.interface = MockInterface(self.config)
+        self.chain = self.interface.blockchain
+        self.headers = self._make_headers(2015, 4 * 2016 + 100)
+        # sparse headers file holding only the header before the first chunk
+        with open(self.chain.path(), 'wb') as f:
+            f.seek(2015 * blockchain.HEADER_SIZE)
+            f.write(bfh(blockchain.serialize_header(self.headers[2015])))
+        self.chain.update_size()
+        self.tip = max(self.headers)
+
+    @staticmethod
+    def _make_headers(start_height, end_height):
+        headers = {}
+        prev_hash = '00' * 32
+        for height in range(start_height, end_height + 1):
+            header = {'version': 0x20000000, 'prev_block_hash': prev_hash,
+                      'merkle_root': '%064x' % height, 'timestamp': 1550000000 + 150 * height,
+                      'bits': 0x207fffff, 'nonce': height, 'block_height': height}
+            headers[height] = header
+            prev_hash = blockchain.hash_header(header)
+        return headers
+
+    def test_hash_raw_headers(self):
+        data = bfh(''.join(blockchain.serialize_header(self.headers[h]) for h in range(2016, 2026)))
+        self.assertEqual([blockchain.hash_header(self.headers[h]) for h in range(2016, 2026)],
+                         blockchain.hash_raw_headers(data))
+
+    def test_chunk_hash_executor(self):
+        network = Network.__new__(Network)
+        network.logger = MockLogger()
+        network._chunk_hash_executor = None
+        network._chunk_hash_executor_lock = threading.Lock()
+        network._chunk_hash_workers = 0  # process pool is opt-in
+        self.assertIsNone(network.get_chunk_hash_executor())
+        network._chunk_hash_workers = 2
+        executor = network.get_chunk_hash_executor()
+        try:
+            self.assertIsInstance(executor, concurrent.futures.ProcessPoolExecutor)
+            self.assertEqual('spawn', executor._mp_context.get_start_method())
+            data = bfh(''.join(blockchain.serialize_header(self.headers[h]) for h in range(2016, 2026)))
+            self.assertEqual(blockchain.hash_raw_headers(data),
+                             executor.submit(blockchain.hash_raw_headers, data).result(60))
+        finally:
+            executor.shutdown()
+
+    def test_request_chunks(self):
+        self.interface.session = session = MockChunkSession(self.headers)
+        res = asyncio.get_event_loop().run_until_complete(self.interface.request_chunks(2016, self.tip))
+        self.assertEqual((True, self.tip - 2016 + 1), res)
+        self.assertEqual([1, 2, 3, 4], session.requests)
+        self.assertEqual(self.tip, self.chain.height())
+        for h in (2016, 4031, 4032, self.tip):
+            self.assertEqual(blockchain.hash_header(self.headers[h]), self.chain.get_hash(h))
+
+    def test_request_chunks_stops_at_bad_chunk(self):
+        self.headers[3 * 2016 + 5]['nonce'] += 1  # breaks linkage inside the third chunk
+        self.interface.session = MockChunkSession(self.headers)
+        res = asyncio.get_event_loop().run_until_complete(self.interface.request_chunks(2016, self.tip))
+        self.assertEqual((True, 2 * 2016), res)
+        self.assertEqual(3 * 2016 - 1, self.chain.height())
+
+    def test_sync_until_catches_up_with_pipeline(self):
+        self.interface.session = session = MockChunkSession(self.headers)
+        self.interface.tip = self.tip
+        res = asyncio.get_event_loop().run_until_complete(
+            self.interface.sync_until(2016, next_height=self.tip))
+        self.assertEqual(('catchup', self.tip + 1), res)
+        self.assertEqual(self.tip, self.chain.height())
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
@@ -1,7 +1,17 @@
+import os
+import random
+import shutil
+import tempfile
 import unittest
+from ipaddress import ip_address
 
-from electrum_axe.protx_list import MNList
+from electrum_axe.axe_msg import AxeSMLEntry, AxeQFCommitMsg
+from electrum_axe.crypto import sha256d
+from electrum_axe.protx_list import (MNList, SMLMerkleTree, RecentListFile,
+                                     MNListDiffRecord,
+                                     RECENT_LIST_COMPACT_RATIO)
 from electrum_axe.constants import CHUNK_SIZE
+from electrum_axe.util import bfh, bh2u
 
 
 class ProTxListTestCase(unittest.TestCase):
@@ -29,3 +39,189 @@ class ProTxListTestCase(unittest.TestCase):
                 assert 0 < (calc_height - base_height) <= CHUNK_SIZE
                 if (height - base_height) > CHUNK_SIZE:
                     assert (calc_height + 1) % CHUNK_SIZE == 0
+
+    def test_calc_responsible_quorums(self):
+        quorums = {}
+        for i in range(30):
+            llmq_type = [1, 2, 3][i % 3]
+            qfcommit = AxeQFCommitMsg(1, llmq_type, os.urandom(32), 0, b'',
+                                      0, b'', os.urandom(48),
+                                      os.urandom(32), os.urandom(96),
+                                      os.urandom(96))
+            k = f'{bh2u(qfcommit.quorumHash[::-1])}:{llmq_type}'
+            quorums[k] = qfcommit
+        mn_list = MNList.__new__(MNList)
+        mn_list.quorums_index = MNList.build_quorums_index(quorums)
+        request_ids = [os.urandom(32) for i in range(20)]
+        for llmq_type in [1, 2]:
+            expected = []
+            for request_id in request_ids:
+                res = []
+                for q in quorums.values():
+                    if q.llmqType != llmq_type:
+                        continue
+                    prehash = bytes([q.llmqType]) + q.quorumHash + request_id
+                    res.append((sha256d(prehash), q))
+                expected.append(sorted(res, key=lambda x: x[0])[0][1])
+            assert expected == mn_list.calc_responsible_quorums(llmq_type,
+                                                                request_ids)
+            assert (expected[0] ==
+                    mn_list.calc_responsible_quorum(llmq_type, request_ids[0]))
+        assert [None, None] == mn_list.calc_responsible_quorums(
+            4, request_ids[:2])
+        assert mn_list.calc_responsible_quorum(4, request_ids[0]) is None
+
+    def _full_merkle_root(self, sml_hashes):
+        hashes = [v for k, v in sorted(sml_hashes.items(),
+                                       key=lambda x: bfh(x[0])[::-1])]
+        return MNList.calc_merkle_root(hashes)
+
+    def test_sml_merkle_tree(self):
+        rnd = random.Random(42)
+        rand_bytes = lambda: bytes(rnd.getrandbits(8) for i in range(32))
+        assert SMLMerkleTree().root() == self._full_merkle_root({})
+        sml_hashes = {}
+        sml_tree = SMLMerkleTree()
+        for n in range(300):
+            deleted = rnd.sample(list(sml_hashes.keys()),
+                                 min(len(sml_hashes), rnd.randint(0, 3)))
+            if rnd.random() < 0.1:
+                deleted.append(bh2u(rand_bytes()))  # not in tree
+            changed = {}
+            for k in rnd.sample(list(sml_hashes.keys()),
+                                min(len(sml_hashes), rnd.randint(0, 3))):
+                changed[k] = rand_bytes()
+            for i in range(rnd.randint(0, 5)):
+                changed[bh2u(rand_bytes())] = rand_bytes()
+            prev_root = sml_tree.root()
+            sml_tree_new = sml_tree.copy()
+            sml_tree_new.update(deleted, changed)
+            assert sml_tree.root() == prev_root  # copy is not changed
+            sml_tree = sml_tree_new
+            for k in deleted:
+                sml_hashes.pop(k, None)
+            sml_hashes.update(changed)
+            assert sml_tree.root() == self._full_merkle_root(sml_hashes)
+            assert (SMLMerkleTree(sml_hashes).levels == sml_tree.levels)
+        # delete down to one and zero entries
+        sml_tree.update(list(sml_hashes.keys())[1:])
+        sml_hashes = dict(list(sml_hashes.items())[:1])
+        assert sml_tree.root() == self._full_merkle_root(sml_hashes)
+        sml_tree.update(list(sml_hashes.keys()))
+        assert sml_tree.root() == self._full_merkle_root({})
+
+
+class RecentListFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'recent_protx_list.bin')
+        self.rl = {'protx_height': 1000, 'llmq_height': 1008,
+                   'protx_mns': {}, 'sml_hashes': {},
+                   'quorums': {}, 'llmq_hashes': {}}
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def add_mn(self):
+        sml_entry = AxeSMLEntry(os.urandom(32), os.urandom(32),
+                                ip_address('::ffff:127.0.0.1'), 9937,
+                                os.urandom(48), os.urandom(20), 1)
+        k = bh2u(sml_entry.proRegTxHash[::-1])
+        self.rl['protx_mns'][k] = sml_entry
+        self.rl['sml_hashes'][k] = sha256d(sml_entry.serialize())
+        return k
+
+    def add_quorum(self):
+        qfcommit = AxeQFCommitMsg(1, 1, os.urandom(32), 50, os.urandom(7),
+                                  50, os.urandom(7), os.urandom(48),
+                                  os.urandom(32), os.urandom(96),
+                                  os.urandom(96))
+        k = f'{bh2u(qfcommit.quorumHash[::-1])}:{qfcommit.llmqType}'
+        self.rl['quorums'][k] = qfcommit
+        self.rl['llmq_hashes'][k] = sha256d(qfcommit.serialize())
+        return k
+
+    def assert_rl_equal(self, rl):
+        assert rl['protx_height'] == self.rl['protx_height']
+        assert rl['llmq_height'] == self.rl['llmq_height']
+        assert rl['sml_hashes'] == self.rl['sml_hashes']
+        assert rl['llmq_hashes'] == self.rl['llmq_hashes']
+        for k, v in self.rl['protx_mns'].items():
+            assert rl['protx_mns'][k].serialize() == v.serialize()
+        for k, v in self.rl['quorums'].items():
+            assert rl['quorums'][k].serialize() == v.serialize()
+        assert rl['protx_mns'].keys() == self.rl['protx_mns'].keys()
+        assert rl['quorums'].keys() == self.rl['quorums'].keys()
+
+    def test_snapshot_and_diffs(self):
+        for i in range(20):
+            self.add_mn()
+        for i in range(4):
+            self.add_quorum()
+        rl_file = RecentListFile(self.path)
+        assert rl_file.read() is None
+        rl_file.write_snapshot(self.rl)
+        snapshot_size = rl_file.size
+        self.assert_rl_equal(RecentListFile(self.path).read())
+
+        del_mn = list(self.rl['protx_mns'].keys())[0]
+        del self.rl['protx_mns'][del_mn]
+        del self.rl['sml_hashes'][del_mn]
+        del_q = list(self.rl['quorums'].keys())[0]
+        del self.rl['quorums'][del_q]
+        del self.rl['llmq_hashes'][del_q]
+        diff = MNListDiffRecord([del_mn], [self.add_mn()],
+                                [del_q], [self.add_quorum()])
+        self.rl['protx_height'] += 1
+        self.rl['llmq_height'] += 8
+        rl_file.append_diff(self.rl, diff)
+        assert rl_file.snapshot_size == snapshot_size
+        assert rl_file.size > snapshot_size
+        rl_file2 = RecentListFile(self.path)
+        self.assert_rl_equal(rl_file2.read())
+        assert rl_file2.size == rl_file.size
+
+        # partially written diff record is skipped and overwritten
+        size = rl_file.size
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\xff\x00\x00\x00garbage')
+        rl_file2 = RecentListFile(self.path)
+        self.assert_rl_equal(rl_file2.read())
+        assert rl_file2.size == size
+        self.rl['protx_height'] += 1
+        rl_file2.append_diff(self.rl, MNListDiffRecord.empty())
+        self.assert_rl_equal(RecentListFile(self.path).read())
+
+        # diffs outgrowing snapshot are checkpointed
+        for n in range(100):
+            diff = MNListDiffRecord.empty()
+            for i in range(5):
+                diff.mns.append(self.add_mn())
+            prev_snapshot_size = rl_file2.snapshot_size
+            prev_diffs_size = rl_file2.size - prev_snapshot_size
+            rl_file2.append_diff(self.rl, diff)
+            if rl_file2.size == rl_file2.snapshot_size:
+                break
+        assert n > 0
+        assert prev_diffs_size <= prev_snapshot_size * RECENT_LIST_COMPACT_RATIO
+        self.assert_rl_equal(RecentListFile(self.path).read())
+
+    def test_read_broken_record(self):
+        for i in range(4):
+            self.add_mn()
+        rl_file = RecentListFile(self.path)
+        rl_file.write_snapshot(self.rl)
+        # record with valid checksum but unparseable payload
+        with open(self.path, 'ab') as f:
+            f.write(rl_file._pack_record(RecentListFile.DIFF, b'junk'))
+        rl_file2 = RecentListFile(self.path)
+        with self.assertRaises(Exception):
+            rl_file2.read()
+        assert rl_file2.snapshot_size == 0
+        assert rl_file2.size == 0
+        # file is rewritten with snapshot instead of appending bare diff
+        rl_file2.append_diff(self.rl, MNListDiffRecord.empty())
+        self.assert_rl_equal(RecentListFile(self.path).read())
@@ -0,0 +1,299 @@
+import asyncio
+import time
+
+from aiorpcx import RPCSession, RPCError, serve_rs, connect_rs
+
+from electrum_axe.bitcoin import hash160_to_p2pkh, address_to_scripthash
+from electrum_axe.interface import NotificationSession
+from electrum_axe.network import UntrustedServerReturnedError
+from electrum_axe.synchronizer import Synchronizer, history_status
+from electrum_axe.transaction import Transaction
+from electrum_axe.util import SilentTaskGroup
+
+from . import SequentialTestCase
+
+
+TX_RAW = (
+    '010000000180b54f1bd8265147a40d95316e8ce9da1a1f01e1b36d563a8275e0be3807ff'
+    '94000000006a473044022057e5b082ef4aaeae33562766012a2fbc85869b8e625255e211'
+    '1df4f9d39c971302200c07a8f1d96d079710e6451a87ba3007dcacc1c1f322bf879bf19e'
+    '584c1f5216012103aa69e4e3f9fddc3e087491996e9d59eae908e650c12a75054d2249e6'
+    '573ff52afeffffff0140ddf505000000001976a914ab4b96c435fd4ac967b27745fee199'
+    '82a510430888ac41fc0000')
+TX_HASH = Transaction(TX_RAW).txid()
+
+
+class FakeElectrumX:
+    '''Local server answering scripthash subscribe/get_history
+    and transaction.get requests from predefined data'''
+
+    def __init__(self):
+        self.histories = {}  # scripthash -> history
+        self.txs = {}  # txid -> raw tx
+        self.requests = 0
+        self.sessions = []
+        self.server = None
+
+    def session_factory(self, *args, **kwargs):
+        session = FakeElectrumXSession(self, *args, **kwargs)
+        self.sessions.append(session)
+        return session
+
+    @property
+    def messages(self):
+        return sum(s.recv_count for s in self.sessions)
+
+    async def start(self):
+        self.server = await serve_rs(self.session_factory, 'localhost', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class FakeElectrumXSession(RPCSession):
+
+    def __init__(self, fake_server, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fake_server = fake_server
+        self.cost_hard_limit = 0
+
+    async def handle_request(self, request):
+        srv = self.fake_server
+        srv.requests += 1
+        method, args = request.method, request.args
+        if len(args) != 1 or len(args[0]) != 64:
+            raise RPCError(1, f'invalid params {args}')
+        if method == 'blockchain.scripthash.subscribe':
+            return history_status(srv.histories.get(args[0]))
+        elif method == 'blockchain.scripthash.get_history':
+            return [{'tx_hash': tx_hash, 'height': height}
+                    for tx_hash, height in srv.histories.get(args[0], [])]
+        elif method == 'blockchain.transaction.get':
+            if args[0] not in srv.txs:
+                raise RPCError(2, 'No such mempool or blockchain transaction')
+            return srv.txs[args[0]]
+        raise RPCError(-32601, f'unknown method {method}')
+
+
+class ConfigMock(dict):
+    pass
+
+
+class NetworkMock:
+
+    def __init__(self, loop, config):
+        self.asyncio_loop = loop
+        self.config = config
+        self.interface = None
+
+    def register_callback(self, callback, events):
+        pass
+
+    def unregister_callback(self, callback):
+        pass
+
+    def trigger_callback(self, event, *args):
+        pass
+
+    async def get_history_for_scripthashes(self, shs):
+        return await self.interface.session.send_batch_requests(
+            'blockchain.scripthash.get_history', [[sh] for sh in shs])
+
+    async def get_transactions(self, tx_hashes):
+        res = await self.interface.session.send_batch_requests(
+            'blockchain.transaction.get', [[h] for h in tx_hashes])
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, Exception) else r for r in res]
+
+
+class InterfaceMock:
+
+    def __init__(self, session):
+        self.session = session
+        self.group = SilentTaskGroup()
+
+
+class DBMock:
+
+    def __init__(self):
+        self.history = {}
+        self.statuses = {}
+        self.txs = {}
+
+    def get_addr_history(self, addr):
+        return self.history.get(addr, [])
+
+    def get_history(self):
+        return list(self.history.keys())
+
+    def get_transaction(self, tx_hash):
+        return self.txs.get(tx_hash)
+
+    def has_transaction(self, tx_hash):
+        return tx_hash in self.txs
+
+
+class PSManMock:
+    subscribe_spent = True
+    ps_keystore = None
+
+    def get_addresses(self):
+        return []
+
+
+class WalletMock:
+
+    def __init__(self, network, addrs):
+        self.network = network
+        self.addrs = addrs
+        self.db = DBMock()
+        self.psman = PSManMock()
+        self.up_to_date = False
+
+    def diagnostic_name(self):
+        return 'wallet_mock'
+
+    def get_addresses(self):
+        return list(self.addrs)
+
+    def get_addr_status(self, addr):
+        return self.db.statuses.get(addr)
+
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        self.db.history[addr] = hist
+        self.db.statuses[addr] = status
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.db.txs[tx_hash] = tx
+
+    def synchronize(self):
+        pass
+
+    def is_up_to_date(self):
+        return self.up_to_date
+
+    def set_up_to_date(self, up_to_date):
+        self.up_to_date = up_to_date
+
+
+def make_addrs(n):
+    return [hash160_to_p2pkh((i+1).to_bytes(20, 'big')) for i in range(n)]
+
+
+class TestSynchronizerBatching(SequentialTestCase):
+
+    NUM_ADDRS = 2000
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.srv = FakeElectrumX()
+        self.port = self.loop.run_until_complete(self.srv.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.srv.stop())
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        super().tearDown()
+
+    def test_session_subscribe_batch_speed(self):
+        hashes = [address_to_scripthash(a)
+                  for a in make_addrs(self.NUM_ADDRS)]
+        for h in hashes[::2]:
+            self.srv.histories[h] = [(TX_HASH, 100)]
+        batch_size = 100
+
+        async def run():
+            async with connect_rs('localhost', self.port,
+                                  session_factory=NotificationSession) as session:
+                queue = asyncio.Queue()
+                start = time.time()
+                for h in hashes[:batch_size]:
+                    await session.subscribe('blockchain.scripthash.subscribe',
+                                            [h], queue)
+                single_rps = batch_size / (time.time() - start)
+
+                messages = self.srv.messages
+                start = time.time()
+                results = []
+                for i in range(0, len(hashes), batch_size):
+                    results.extend(await session.subscribe_batch(
+                        'blockchain.scripthash.subscribe',
+                        [[h] for h in hashes[i:i+batch_size]], queue))
+                batch_rps = len(hashes) / (time.time() - start)
+                batch_messages = self.srv.messages - messages
+                return results, queue.qsize(), batch_messages, single_rps, batch_rps
+
+        results, qsize, batch_messages, single_rps, batch_rps = \
+            self.loop.run_until_complete(run())
+        print(f'subscribe requests/s: single {single_rps:.0f},'
+              f' batched {batch_rps:.0f}')
+        self.assertEqual([history_status(self.srv.histories.get(h))
+                          for h in hashes], results)
+        self.assertEqual(batch_size + len(hashes), qsize)
+        # first batch_size subscriptions are already cached
+        self.assertEqual(len(hashes) // batch_size - 1, batch_messages)
+        self.assertEqual(len(hashes), self.srv.requests)
+
+    def test_session_subscribe_batch_errors(self):
+        async def run():
+            async with connect_rs('localhost', self.port,
+                                  session_factory=NotificationSession) as session:
+                queue = asyncio.Queue()
+                h = address_to_scripthash(make_addrs(1)[0])
+                res = await session.subscribe_batch(
+                    'blockchain.scripthash.subscribe', [[h], ['bad']], queue)
+                res2 = await session.send_batch_requests(
+                    'blockchain.transaction.get', [[TX_HASH]])
+                return res, queue.qsize(), session.subscriptions, res2
+
+        res, qsize, subscriptions, res2 = self.loop.run_until_complete(run())
+        self.assertEqual(None, res[0])
+        self.assertIsInstance(res[1], RPCError)
+        self.assertEqual(1, qsize)
+        self.assertEqual(1, sum(len(v) for v in subscriptions.values()))
+        self.assertIsInstance(res2[0], RPCError)
+
+    def run_synchronizer(self, network, wallet):
+        async def run():
+            async with connect_rs('localhost', self.port,
+                                  session_factory=NotificationSession) as session:
+                network.interface = InterfaceMock(session)
+                start = time.time()
+                sync = Synchronizer(wallet)  # started on network.interface
+                while not (wallet.is_up_to_date() and wallet.db.txs):
+                    await asyncio.sleep(0.05)
+                    self.assertLess(time.time() - start, 60)
+                rps = self.srv.requests / (time.time() - start)
+                await sync.stop()
+                await network.interface.group.cancel_remaining()
+                return sync, rps
+        return self.loop.run_until_complete(run())
+
+    def test_synchronizer_bootstrap(self):
+        addrs = make_addrs(self.NUM_ADDRS)
+        for a in addrs[::4]:
+            self.srv.histories[address_to_scripthash(a)] = [(TX_HASH, 100)]
+        self.srv.txs[TX_HASH] = TX_RAW
+        config = ConfigMock(sync_batch_size=50, sync_max_inflight_batches=2)
+        network = NetworkMock(self.loop, config)
+        wallet = WalletMock(network, addrs)
+
+        sync, rps = self.run_synchronizer(network, wallet)
+        print(f'synchronizer requests/s: {rps:.0f}')
+        self.assertEqual(50, sync.batch_size)
+        self.assertEqual(2, sync.max_inflight_batches)
+        self.assertEqual(len(addrs[::4]), len(wallet.db.history))
+        self.assertEqual([TX_HASH], list(wallet.db.txs.keys()))
+        # subscriptions + histories + one tx
+        self.assertEqual(len(addrs) + len(addrs[::4]) + 1, self.srv.requests)
+        self.assertLess(self.srv.messages, len(addrs) // 10)
+
+        # on restart unchanged statuses does not trigger history requests
+        self.srv.requests = 0
+        wallet.up_to_date = False
+        self.run_synchronizer(network, wallet)
+        self.assertEqual(len(addrs), self.srv.requests)
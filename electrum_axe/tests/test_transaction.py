@@ -1,8 +1,12 @@
-from electrum_axe import transaction
-from electrum_axe.transaction import TxOutputForUI, tx_from_str
+import time
+
+from electrum_axe import transaction, ecc
+from electrum_axe.transaction import TxOutputForUI, TxOutput, tx_from_str
+from electrum_axe import bitcoin
 from electrum_axe.bitcoin import TYPE_ADDRESS
 from electrum_axe.keystore import xpubkey_to_address
 from electrum_axe.util import bh2u, bfh
+from electrum_axe.crypto import sha256d
 
 from . import SequentialTestCase, TestCaseForTestnet
 from .test_bitcoin import needs_test_with_all_ecc_implementations
@@ -590,6 +594,71 @@ class TestTransaction(SequentialTestCase):
 # txns from Bitcoin Core ends <---
 
 
+class TestTransactionSigning(SequentialTestCase):
+
+    def _make_tx(self, n_inputs, privkeys):
+        inputs = []
+        for i in range(n_inputs):
+            privkey = privkeys[i % len(privkeys)]
+            pubkey = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=True)
+            inputs.append({
+                'type': 'p2pkh',
+                'address': bitcoin.pubkey_to_address('p2pkh', pubkey),
+                'prevout_hash': bh2u(sha256d(str(i))),
+                'prevout_n': i % 3,
+                'sequence': 0xfffffffe,
+                'value': 100000,
+                'x_pubkeys': [pubkey],
+                'pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+            })
+        outputs = [TxOutput(TYPE_ADDRESS, inputs[0]['address'], 1000)]
+        return transaction.Transaction.from_io(inputs, outputs, locktime=12345)
+
+    def _naive_preimage(self, tx, txin_index):
+        nHashType = bitcoin.int_to_hex(1, 4)
+        nLocktime = bitcoin.int_to_hex(tx.locktime, 4)
+        inputs = tx.inputs()
+        outputs = tx.outputs()
+        txins = bitcoin.var_int(len(inputs)) + ''.join(
+            tx.serialize_input(txin, tx.get_preimage_script(txin)
+                               if txin_index == k else '')
+            for k, txin in enumerate(inputs))
+        txouts = bitcoin.var_int(len(outputs)) + ''.join(
+            tx.serialize_output(o) for o in outputs)
+        nVersion = bitcoin.int_to_hex(tx.version, 4)
+        return nVersion + txins + txouts + nLocktime + nHashType
+
+    def test_preimage_matches_naive_serialization(self):
+        privkeys = [bytes([k]) * 32 for k in range(1, 4)]
+        tx = self._make_tx(7, privkeys)
+        for i in range(7):
+            self.assertEqual(self._naive_preimage(tx, i),
+                             tx.serialize_preimage(i))
+
+    def test_sign_many_inputs(self):
+        privkeys = [bytes([k]) * 32 for k in range(1, 4)]
+        keypairs = {}
+        for privkey in privkeys:
+            pubkey = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=True)
+            keypairs[pubkey] = (privkey, True)
+        tx = self._make_tx(500, privkeys)
+        t0 = time.perf_counter()
+        self.assertEqual(500, tx.sign(keypairs))
+        sign_time = time.perf_counter() - t0
+        self.assertTrue(tx.is_complete())
+        # signatures are deterministic (RFC6979), compare against
+        # signing the naively serialized preimages on a sample of inputs
+        for i in (0, 1, 250, 498, 499):
+            txin = tx.inputs()[i]
+            privkey = ecc.ECPrivkey(keypairs[txin['pubkeys'][0]][0])
+            pre_hash = sha256d(bfh(self._naive_preimage(tx, i)))
+            sig = bh2u(privkey.sign_transaction(pre_hash)) + '01'
+            self.assertEqual(sig, txin['signatures'][0])
+        self.assertLess(sign_time, 60)
+
+
 class TestTransactionTestnet(TestCaseForTestnet):
 
     def _run_naive_tests_on_tx(self, raw_tx, txid):
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import random
+import time
+from unittest import mock
 
-from electrum_axe.bitcoin import hash_encode
+from electrum_axe import verifier
+from electrum_axe.bitcoin import hash_encode, hash_decode
+from electrum_axe.crypto import sha256d
 from electrum_axe.transaction import Transaction
-from electrum_axe.util import bfh
-from electrum_axe.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+from electrum_axe.util import bfh, bh2u
+from electrum_axe.verifier import (SPV, InnerNodeOfSpvProofIsValidTx,
+                                   BlockMerkleVerifier, MerkleRootMismatch,
+                                   MissingBlockHeader, is_tx_structure)
 
 from . import TestCaseForTestnet
 
@@ -48,3 +56,233 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+    def test_is_tx_structure(self):
+        """Cheap structure check agrees with full tx deserialization"""
+        raw = bfh(VALID_64_BYTE_TX)
+        self.assertTrue(is_tx_structure(raw))
+        self.assertFalse(is_tx_structure(raw[:-1]))
+        self.assertFalse(is_tx_structure(raw + b'\x00'))
+        rnd = random.Random(42)
+        samples = [bytes(rnd.getrandbits(8) for i in range(64))
+                   for j in range(500)]
+        for j in range(500):  # mutations of valid tx
+            mutated = bytearray(raw)
+            mutated[rnd.randrange(64)] = rnd.getrandbits(8)
+            samples.append(bytes(mutated))
+        for sample in samples:
+            try:
+                Transaction(bh2u(sample)).deserialize()
+                is_tx = True
+            except Exception:
+                is_tx = False
+            if is_tx:
+                self.assertTrue(is_tx_structure(sample), bh2u(sample))
+
+
+def make_merkle_tree(txids):
+    """Return merkle root and merkle branches for txids"""
+    level = [hash_decode(txid) for txid in txids]
+    branches = [[] for txid in txids]
+    indexes = list(range(len(txids)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for branch, i in zip(branches, indexes):
+            branch.append(hash_encode(level[i ^ 1]))
+        level = [sha256d(level[i] + level[i+1])
+                 for i in range(0, len(level), 2)]
+        indexes = [i >> 1 for i in indexes]
+    return hash_encode(level[0]), branches
+
+
+def make_header(merkle_root, height):
+    return {'version': 1, 'prev_block_hash': '00' * 32,
+            'merkle_root': merkle_root, 'timestamp': 1500000000 + height,
+            'bits': 0x1d00ffff, 'nonce': height, 'block_height': height}
+
+
+class BlockMerkleVerifierTestCase(TestCaseForTestnet):
+
+    def test_block_merkle_verifier(self):
+        rnd = random.Random(1)
+        txids = [bh2u(bytes(rnd.getrandbits(8) for i in range(32)))
+                 for j in range(300)]
+        merkle_root, branches = make_merkle_tree(txids)
+        header = make_header(merkle_root, 100)
+        for i in (0, 1, 150, 299):
+            self.assertEqual(merkle_root,
+                             SPV.hash_merkle_root(branches[i], txids[i], i))
+
+        block_verifier = BlockMerkleVerifier(header, 100)
+        with mock.patch.object(verifier, 'sha256d',
+                               wraps=verifier.sha256d) as hashed:
+            for i, txid in enumerate(txids):
+                block_verifier.verify(txid, branches[i], i)
+        # each inner node of the tree is hashed once
+        inner_nodes, n = 0, len(txids)
+        while n > 1:
+            n = (n + 1) // 2
+            inner_nodes += n
+        self.assertEqual(inner_nodes, hashed.call_count)
+        self.assertGreater(len(txids) * len(branches[0]), 8 * hashed.call_count)
+        self.assertEqual(len(block_verifier.header_hash), 64)
+
+        # branch of other tx, wrong pos, wrong branch
+        with self.assertRaises(MerkleRootMismatch):
+            block_verifier.verify(txids[1], branches[2], 2)
+        with self.assertRaises(MerkleRootMismatch):
+            block_verifier.verify(txids[1], branches[1], 3)
+        bad_branch = list(branches[5])
+        bad_branch[3] = bad_branch[2]
+        # leaf already verified at the same position, branch is not needed
+        block_verifier.verify(txids[5], bad_branch, 5)
+        with self.assertRaises(MerkleRootMismatch):
+            BlockMerkleVerifier(header, 100).verify(txids[5], bad_branch, 5)
+        with self.assertRaises(MissingBlockHeader):
+            BlockMerkleVerifier(None, 100).verify(txids[5], branches[5], 5)
+
+
+class SPVNetworkMock:
+
+    def __init__(self, loop, chain, proofs):
+        self.asyncio_loop = loop
+        self.config = {}
+        self.interface = None
+        self.bhi_lock = asyncio.Lock()
+        self.chain = chain
+        self.proofs = proofs
+        self.batches = []
+
+    def register_callback(self, callback, events):
+        pass
+
+    def unregister_callback(self, callback):
+        pass
+
+    def blockchain(self):
+        return self.chain
+
+    async def get_merkles_for_transactions(self, txs):
+        self.batches.append(len(txs))
+        await asyncio.sleep(0.01)
+        return [self.proofs[tx_hash] for tx_hash, tx_height in txs]
+
+
+class BlockchainMock:
+
+    def __init__(self):
+        self.headers = {}
+
+    def height(self):
+        return max(self.headers)
+
+    def read_header(self, height):
+        return self.headers.get(height)
+
+
+class SPVWalletMock:
+
+    def __init__(self):
+        self.unverified = {}
+        self.verified = {}
+
+    def diagnostic_name(self):
+        return 'spv_wallet_mock'
+
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified.pop(tx_hash, None)
+        self.verified[tx_hash] = info
+
+    def remove_unverified_tx(self, tx_hash, tx_height):
+        self.unverified.pop(tx_hash, None)
+
+
+class SPVTestCase(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.chain = BlockchainMock()
+        self.proofs = {}
+        self.wallet = SPVWalletMock()
+        self.rnd = random.Random(2)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        super().tearDown()
+
+    def add_block(self, height, txs_cnt):
+        rnd = self.rnd
+        txids = [bh2u(bytes(rnd.getrandbits(8) for i in range(32)))
+                 for j in range(txs_cnt)]
+        merkle_root, branches = make_merkle_tree(txids)
+        self.chain.headers[height] = make_header(merkle_root, height)
+        for pos, txid in enumerate(txids):
+            self.proofs[txid] = {'block_height': height, 'pos': pos,
+                                 'merkle': branches[pos]}
+        return txids
+
+    async def wait_verified(self, n):
+        start = time.time()
+        while len(self.wallet.verified) < n:
+            await asyncio.sleep(0.01)
+            self.assertLess(time.time() - start, 30)
+
+    def test_spv_batched_event_driven(self):
+        for height in range(1000, 1050):
+            for txid in self.add_block(height, 100):
+                self.wallet.unverified[txid] = height
+        txs_cnt = len(self.wallet.unverified)
+        network = SPVNetworkMock(self.loop, self.chain, self.proofs)
+
+        async def run():
+            spv = SPV(network, self.wallet)
+            task = asyncio.ensure_future(spv._start_tasks())
+            try:
+                start = time.time()
+                await self.wait_verified(txs_cnt)
+                txs_per_sec = txs_cnt / (time.time() - start)
+                batches = len(network.batches)
+
+                # idle verifier does not poll
+                with mock.patch.object(self.wallet, 'get_unverified_txs',
+                                       wraps=self.wallet.get_unverified_txs) as get:
+                    await asyncio.sleep(0.3)
+                    self.assertEqual(0, get.call_count)
+
+                    # woken up by new unverified tx
+                    txid = self.add_block(1050, 5)[0]
+                    self.wallet.unverified[txid] = 1050
+                    spv.wake_up()
+                    await self.wait_verified(txs_cnt + 1)
+
+                    # tx above local height waits for new header
+                    txid = bh2u(bytes(32))
+                    self.wallet.unverified[txid] = 1051
+                    spv.wake_up()
+                    await asyncio.sleep(0.1)
+                    self.assertNotIn(txid, self.wallet.verified)
+                    self.proofs[txid] = {'block_height': 1051, 'pos': 0,
+                                         'merkle': []}
+                    self.chain.headers[1051] = make_header(txid, 1051)
+                    spv.on_blockchain_updated('blockchain_updated')
+                    await self.wait_verified(txs_cnt + 2)
+                    self.assertEqual(3, get.call_count)
+                self.assertTrue(spv.is_up_to_date())
+                return txs_per_sec, batches
+            finally:
+                await spv.group.cancel_remaining()
+                task.cancel()
+
+        txs_per_sec, batches = self.loop.run_until_complete(run())
+        print(f'spv verified txs/s: {txs_per_sec:.0f}')
+        self.assertEqual(txs_cnt // verifier.SPV_BATCH_SIZE, batches)
+        info = next(iter(self.wallet.verified.values()))
+        self.assertEqual((1000, 0), (info.height, info.txpos))
+        self.assertEqual(self.chain.headers[1000]['timestamp'], info.timestamp)
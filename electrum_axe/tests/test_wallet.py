@@ -3,11 +3,15 @@ import tempfile
 import sys
 import os
 import json
+import copy
+import tracemalloc
+from unittest import mock
 from decimal import Decimal
 import time
 
 from io import StringIO
-from electrum_axe.storage import WalletStorage
+from electrum_axe.storage import (WalletStorage, STO_EV_USER_PW,
+                                   JOURNAL_COMPACT_RATIO, get_journal_path)
 from electrum_axe.json_db import FINAL_SEED_VERSION
 from electrum_axe.wallet import (Abstract_Wallet, Standard_Wallet,
                                   create_new_wallet,
@@ -15,9 +19,13 @@ from electrum_axe.wallet import (Abstract_Wallet, Standard_Wallet,
 from electrum_axe.exchange_rate import ExchangeBase, FxThread
 from electrum_axe.util import TxMinedInfo
 from electrum_axe.bitcoin import COIN
-from electrum_axe.json_db import JsonDB
+from electrum_axe.json_db import JsonDB, JsonDBJsonEncoder
+from electrum_axe.transaction import Transaction
+from electrum_axe import json_db
 
 from . import SequentialTestCase
+from .test_axe_tx import CB_TX
+from .test_transaction import signed_blob, v2_blob
 
 
 class FakeSynchronizer(object):
@@ -80,6 +88,179 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+
+class TestWalletStorageJournal(WalletTestCase):
+
+    def _create_storage(self, password=None):
+        storage = WalletStorage(self.wallet_path)
+        if password:
+            storage.set_password(password, enc_version=STO_EV_USER_PW)
+        for i in range(100):
+            storage.put('key%s' % i, 'value%s' % i)
+        storage.write()
+        return storage
+
+    def _read_wallet_file(self):
+        with open(self.wallet_path, "r") as f:
+            return f.read()
+
+    def test_write_appends_changes_to_journal(self):
+        storage = self._create_storage()
+        journal_path = get_journal_path(self.wallet_path)
+        self.assertFalse(os.path.exists(journal_path))
+        wallet_file = self._read_wallet_file()
+
+        storage.put('key1', 'changed')
+        storage.put('key2', None)
+        storage.write()
+        self.assertTrue(os.path.exists(journal_path))
+        self.assertEqual(wallet_file, self._read_wallet_file())
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('changed', storage.get('key1'))
+        self.assertEqual(None, storage.get('key2'))
+        self.assertEqual('value3', storage.get('key3'))
+
+    def test_db_modifiers_saved_to_journal(self):
+        storage = self._create_storage()
+        db = storage.db
+        db.add_txi_addr('txid1', 'addr1', 'prevout:0', 1000)
+        db.add_txo_addr('txid1', 'addr2', 0, 900, False)
+        db.add_verified_tx('txid1', TxMinedInfo(height=10, timestamp=1,
+                                                txpos=0, header_hash='00'))
+        db.update_tx_fees({'txid1': 100})
+        db.set_ps_data('mix_rounds', 4)
+        db._add_ps_denom('txid1:0', ['addr2', 900, 0])
+        db.add_ps_tx('txid1', 4, True)
+        storage.write()
+        db.remove_txo('txid1')
+        db._pop_ps_denom('txid1:0')
+        storage.write()
+        self.assertTrue(os.path.exists(get_journal_path(self.wallet_path)))
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual(json.loads(db.dump()), json.loads(storage2.db.dump()))
+        self.assertEqual(['txid1'], storage2.db.list_txi())
+        self.assertEqual([], storage2.db.list_txo())
+
+    def test_new_addresses_appended_to_journal(self):
+        storage = self._create_storage()
+        db = storage.db
+        db.load_addresses('standard')
+        for i in range(100):
+            db.add_receiving_address('addr%s' % i)
+        db.add_change_address('chg0')
+        storage.write()
+        db.add_receiving_address('addr100')
+        db.add_receiving_address('addr101')
+        db.add_change_address('chg1', ps_ks=True)
+        pop_changes = db.pop_changes
+        changes = []
+
+        def save_changes():
+            res = pop_changes()
+            changes.extend(json.loads(res))
+            return res
+        with mock.patch.object(db, 'pop_changes', side_effect=save_changes):
+            storage.write()
+        # only new addresses are saved
+        self.assertEqual([['extend', ['addresses', 'receiving'], 100,
+                           ['addr100', 'addr101']],
+                          ['extend', ['ps_ks_addrs', 'change'], 0,
+                           ['chg1']]],
+                         sorted(changes))
+        db.add_receiving_address('addr102')
+        storage.write()
+
+        storage2 = WalletStorage(self.wallet_path)
+        storage2.db.load_addresses('standard')
+        self.assertEqual(['addr%s' % i for i in range(103)],
+                         storage2.db.get_receiving_addresses())
+        self.assertEqual(['chg0'], storage2.db.get_change_addresses())
+        self.assertEqual((False, 102),
+                         storage2.db.get_address_index('addr102'))
+
+    def test_untracked_change_does_full_write(self):
+        storage = self._create_storage()
+        storage.db.set_modified(True)
+        storage.write()
+        self.assertFalse(os.path.exists(get_journal_path(self.wallet_path)))
+
+    def test_journal_compaction(self):
+        storage = self._create_storage()
+        journal_path = get_journal_path(self.wallet_path)
+        wallet_file = self._read_wallet_file()
+        compactions = 0
+        for i in range(100):
+            storage.put('key%s' % i, 'changed%s' % i)
+            storage.write()
+            if self._read_wallet_file() != wallet_file:
+                wallet_file = self._read_wallet_file()
+                compactions += 1
+                self.assertFalse(os.path.exists(journal_path))
+            self.assertLessEqual(os.path.getsize(journal_path)
+                                 if os.path.exists(journal_path) else 0,
+                                 len(wallet_file) * JOURNAL_COMPACT_RATIO)
+        self.assertGreater(compactions, 0)
+        storage.compact()
+        self.assertFalse(os.path.exists(journal_path))
+        d = json.loads(self._read_wallet_file())
+        self.assertEqual('changed99', d['key99'])
+
+    def test_stale_journal_is_ignored(self):
+        storage = self._create_storage()
+        storage.put('key1', 'changed')
+        storage.write()
+        # wallet file replaced, for example by restoring from backup
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({'key1': 'restored',
+                                'seed_version': FINAL_SEED_VERSION}))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('restored', storage.get('key1'))
+        storage.put('key2', 'new')
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('restored', storage.get('key1'))
+        self.assertEqual('new', storage.get('key2'))
+
+    def test_damaged_journal_tail_is_dropped(self):
+        storage = self._create_storage()
+        storage.put('key1', 'changed')
+        storage.write()
+        # interrupted write of the next record
+        with open(get_journal_path(self.wallet_path), "a") as f:
+            f.write('[["put", ["key2"], "cha')
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('changed', storage.get('key1'))
+        self.assertEqual('value2', storage.get('key2'))
+        storage.put('key3', 'changed')
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('changed', storage.get('key1'))
+        self.assertEqual('changed', storage.get('key3'))
+
+    def test_encrypted_journal_records(self):
+        storage = self._create_storage(password='secret')
+        storage.put('key1', 'changed')
+        storage.write()
+        journal_path = get_journal_path(self.wallet_path)
+        with open(journal_path, "r") as f:
+            journal = f.read()
+        self.assertNotIn('changed', journal)
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        storage.decrypt('secret')
+        self.assertEqual('changed', storage.get('key1'))
+
+        # password change rewrites wallet file with the new key
+        storage.set_password('secret2', enc_version=STO_EV_USER_PW)
+        storage.write()
+        self.assertFalse(os.path.exists(journal_path))
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt('secret2')
+        self.assertEqual('changed', storage.get('key1'))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -115,6 +296,146 @@ class FakeWallet:
 txid = 'abc'
 ccy = 'TEST'
 
+class TestJsonDBViews(WalletTestCase):
+
+    @staticmethod
+    def _make_history(n):
+        return {'addr%s' % i: [['%064x' % i, i]] for i in range(n)}
+
+    def test_view_is_read_only(self):
+        db = JsonDB('', manual_upgrades=False)
+        db.put('labels', {'a': 'b', 'l': [1, {'c': 'd'}]})
+        view = db.get_view('labels')
+        self.assertEqual(db.get('labels'), view)
+        self.assertEqual('d', view['l'][1]['c'])
+        with self.assertRaises(TypeError):
+            view['a'] = 'x'
+        with self.assertRaises(AttributeError):
+            view['l'].append(2)
+        with self.assertRaises(TypeError):
+            view['l'][1]['c'] = 'x'
+        self.assertEqual('default', db.get_view('missing', 'default'))
+        # deepcopy gives mutable copy
+        d = copy.deepcopy(view)
+        d['l'][1]['c'] = 'x'
+        self.assertEqual('d', db.get('labels')['l'][1]['c'])
+        # views are json serializable
+        self.assertEqual(db.get('labels'),
+                         json.loads(json.dumps(view, cls=JsonDBJsonEncoder)))
+
+    def test_checkout_saved_to_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'a': 'b'})
+        for i in range(100):
+            storage.put('key%s' % i, 'value%s' % i)
+        storage.write()
+        with storage.checkout('labels', {}) as labels:
+            labels['c'] = 'd'
+        with storage.checkout('frozen_coins', []) as frozen_coins:
+            frozen_coins.append('txid:0')
+        self.assertTrue(storage.db.modified())
+        storage.write()
+        self.assertTrue(os.path.exists(get_journal_path(self.wallet_path)))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'a': 'b', 'c': 'd'}, storage.get('labels'))
+        self.assertEqual(['txid:0'], storage.get('frozen_coins'))
+
+    def test_get_view_allocations(self):
+        db = JsonDB('', manual_upgrades=False)
+        db.put('addr_history', self._make_history(100000))
+
+        def traced_peak(func):
+            tracemalloc.start()
+            try:
+                res = func()
+                return tracemalloc.get_traced_memory()[1], res
+            finally:
+                tracemalloc.stop()
+        copy_peak, hist_copy = traced_peak(lambda: db.get('addr_history'))
+        view_peak, hist_view = traced_peak(lambda: db.get_view('addr_history'))
+        self.assertEqual(100000, len(hist_view))
+        self.assertEqual(hist_copy['addr99999'], hist_view['addr99999'])
+        self.assertGreater(copy_peak, 10 * 1024 * 1024)
+        self.assertLess(view_peak, copy_peak // 1000)
+
+
+class TestJsonDBTransactions(WalletTestCase):
+
+    RAW_TXS = [signed_blob, v2_blob, CB_TX]
+
+    def _make_db(self):
+        db = JsonDB('', manual_upgrades=False)
+        for raw_tx in self.RAW_TXS:
+            tx = Transaction(raw_tx)
+            db.add_transaction(tx.txid(), tx)
+        return db
+
+    def test_raw_txs_stored_and_parsed_lazily(self):
+        db = self._make_db()
+        txids = db.list_transactions()
+        data = json.loads(db.dump())
+        self.assertEqual(set(self.RAW_TXS),
+                         set(data['transactions'].values()))
+        data['txo'] = {txid: {'addr': [[0, 1, False]]} for txid in txids}
+        db = JsonDB(json.dumps(data), manual_upgrades=False)
+        self.assertEqual(0, len(db._tx_cache))
+        for txid in txids:
+            tx = db.get_transaction(txid)
+            self.assertEqual(txid, tx.txid())
+            self.assertIs(tx, db.get_transaction(txid))
+        self.assertEqual(len(txids), len(db._tx_cache))
+        self.assertIsNone(db.get_transaction('00'*32))
+
+    def test_tx_cache_is_bounded(self):
+        db = self._make_db()
+        txids = db.list_transactions()
+        db._tx_cache.clear()
+        with mock.patch.object(json_db, 'TX_CACHE_SIZE', 2):
+            tx0 = db.get_transaction(txids[0])
+            db.get_transaction(txids[1])
+            db.get_transaction(txids[2])
+            self.assertEqual(txids[1:], list(db._tx_cache.keys()))
+            # existence checks do not parse txs nor touch the cache
+            self.assertTrue(db.has_transaction(txids[0]))
+            self.assertEqual(txids[1:], list(db._tx_cache.keys()))
+            tx0_new = db.get_transaction(txids[0])
+        self.assertIsNot(tx0, tx0_new)
+        self.assertEqual(str(tx0), str(tx0_new))
+        removed_tx = db.remove_transaction(txids[1])
+        self.assertEqual(txids[1], removed_tx.txid())
+        self.assertIsNone(db.get_transaction(txids[1]))
+        self.assertFalse(db.has_transaction(txids[1]))
+        self.assertIsNone(db.get_tx_summary(txids[1]))
+
+    def test_addr_statuses(self):
+        db = self._make_db()
+        db.load_addresses('standard')
+        db.add_receiving_address('addr1')
+        db.set_addr_history('addr1', [['txid1', 10]])
+        db.set_addr_status('addr1', 'status1')
+        db.set_addr_status('addr2', 'status2')
+        db.set_addr_status('addr2', None)
+        self.assertEqual('status1', db.get_addr_status('addr1'))
+        self.assertIsNone(db.get_addr_status('addr2'))
+        db2 = JsonDB(db.dump(), manual_upgrades=False)
+        self.assertEqual('status1', db2.get_addr_status('addr1'))
+        db.remove_addr_history('addr1')
+        self.assertIsNone(db.get_addr_status('addr1'))
+        db2.clear_history()
+        self.assertIsNone(db2.get_addr_status('addr1'))
+
+    def test_tx_summary(self):
+        db = self._make_db()
+        for txid in db.list_transactions():
+            tx = db.get_transaction(txid)
+            summary = db.get_tx_summary(txid)
+            self.assertEqual(tx.tx_type, summary.tx_type)
+            self.assertEqual([(i['prevout_hash'], i['prevout_n'])
+                              for i in tx.inputs()], list(summary.inputs))
+            self.assertEqual(tx.outputs(), list(summary.outputs))
+            self.assertIs(summary, db.get_tx_summary(txid))
+
+
 class TestFiat(SequentialTestCase):
     def setUp(self):
         super().setUp()
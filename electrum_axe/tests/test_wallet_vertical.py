@@ -308,3 +308,95 @@ class TestWalletHistory_DoubleSpend(TestCaseForTestnet):
         txC = Transaction(self.transactions["a04328fbc9f28268378a8b9cf103db21ca7d673bf1cc7fa4d61b6a7265f07a6b"])
         w.add_transaction(txC.txid(), txC)
         self.assertEqual(83500163, sum(w.get_balance()))
+
+    def _get_utxos_from_history(self, w):
+        utxos = {}
+        for addr in w.get_addresses():
+            received, sent = w.get_addr_io(addr)
+            for txo in received:
+                if txo not in sent:
+                    utxos[txo] = (addr, received[txo][1])
+        return utxos
+
+    def _check_utxo_index(self, w):
+        utxos = {c['prevout_hash'] + ':%d' % c['prevout_n']:
+                 (c['address'], c['value']) for c in w.get_utxos()}
+        self.assertEqual(self._get_utxos_from_history(w), utxos)
+        w.load_utxos()
+        utxos2 = {c['prevout_hash'] + ':%d' % c['prevout_n']:
+                  (c['address'], c['value']) for c in w.get_utxos()}
+        self.assertEqual(utxos, utxos2)
+        return utxos
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_utxo_index_follows_add_remove(self, mock_write):
+        w = restore_wallet_from_text("hint shock chair puzzle shock traffic drastic note dinosaur mention suggest sweet",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5)['wallet']
+        txA = Transaction(self.transactions["0cce62d61ec87ad3e391e8cd752df62e0c952ce45f52885d6d10988e02794060"])
+        txB = Transaction(self.transactions["e7f4e47f41421e37a8600b6350befd586f30db60a88d0992d54df280498f0968"])
+        txC = Transaction(self.transactions["a04328fbc9f28268378a8b9cf103db21ca7d673bf1cc7fa4d61b6a7265f07a6b"])
+        # spending tx is added before the funding one
+        w.add_transaction(txB.txid(), txB, allow_unrelated=True)
+        self.assertEqual({}, self._check_utxo_index(w))
+        w.add_transaction(txA.txid(), txA)
+        self.assertEqual({}, self._check_utxo_index(w))
+        w.remove_transaction(txB.txid())
+        utxos = self._check_utxo_index(w)
+        self.assertEqual([txA.txid() + ':0'], list(utxos))
+        w.add_transaction(txC.txid(), txC)
+        utxos = self._check_utxo_index(w)
+        self.assertEqual([txC.txid() + ':0'], list(utxos))
+        self.assertEqual(83500163, sum(v for addr, v in utxos.values()))
+        w.remove_transaction(txA.txid())
+        self._check_utxo_index(w)
+
+    def _get_wallet_indexes(self, w):
+        txi = {txid: {addr: sorted(w.db.get_txi_addr(txid, addr))
+                      for addr in w.db.get_txi(txid)}
+               for txid in w.db.list_txi()}
+        txo = {txid: {addr: sorted(w.db.get_txo_addr(txid, addr))
+                      for addr in w.db.get_txo(txid)}
+               for txid in w.db.list_txo()}
+        return txi, txo, self._check_utxo_index(w), w.get_balance()
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_received_again(self, mock_write):
+        w = restore_wallet_from_text("hint shock chair puzzle shock traffic drastic note dinosaur mention suggest sweet",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5)['wallet']
+        txA = Transaction(self.transactions["0cce62d61ec87ad3e391e8cd752df62e0c952ce45f52885d6d10988e02794060"])
+        txC = Transaction(self.transactions["a04328fbc9f28268378a8b9cf103db21ca7d673bf1cc7fa4d61b6a7265f07a6b"])
+        w.add_transaction(txA.txid(), txA)
+        w.add_transaction(txC.txid(), txC)
+        hists = {}
+        for txid in [txA.txid(), txC.txid()]:
+            for addr in set(w.db.get_txi(txid) + w.db.get_txo(txid)):
+                hists.setdefault(addr, []).append((txid, 100))
+        # local txs appear in history, txi and txo are recomputed
+        for addr, hist in hists.items():
+            w.receive_history_callback(addr, hist, {})
+        indexes = self._get_wallet_indexes(w)
+        self.assertEqual(83500163, sum(indexes[3]))
+
+        # same history received again does not re-add txs
+        with mock.patch.object(w, 'add_transaction',
+                               wraps=w.add_transaction) as add_tx:
+            for addr, hist in hists.items():
+                w.receive_history_callback(addr, hist, {})
+            add_tx.assert_not_called()
+        self.assertEqual(indexes, self._get_wallet_indexes(w))
+
+        # new heights still reach unverified txs and balance ledger
+        unconf_hists = {addr: [(txid, TX_HEIGHT_UNCONFIRMED)
+                               for txid, height in hist]
+                        for addr, hist in hists.items()}
+        for addr, hist in unconf_hists.items():
+            w.receive_history_callback(addr, hist, {})
+        self.assertEqual(TX_HEIGHT_UNCONFIRMED,
+                         w.get_tx_height(txC.txid()).height)
+        txi, txo, utxos, balance = self._get_wallet_indexes(w)
+        self.assertEqual(indexes[:3], (txi, txo, utxos))
+        w.reset_balance_ledger()
+        self.assertEqual(balance, w.get_balance())
+        self.assertEqual(83500163, sum(balance))
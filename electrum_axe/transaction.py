@@ -27,6 +27,7 @@
 
 # Note: The deserialization code originally comes from ABE.
 
+import hashlib
 import struct
 import traceback
 import sys
@@ -37,13 +38,13 @@ from . import ecc, bitcoin, constants
 from .util import profiler, to_bytes, bh2u, bfh
 from .bitcoin import (TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT, hash_160,
                       hash160_to_p2sh, hash160_to_p2pkh,
-                      hash_encode, var_int, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
-                      push_script, int_to_hex, push_script, b58_address_to_hash160,
+                      hash_encode, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
+                      push_script, push_script, b58_address_to_hash160,
                       opcodes, add_number_to_script, base_decode)
 from .crypto import sha256d
 from .keystore import xpubkey_to_address, xpubkey_to_pubkey
 from .axe_tx import (ProTxBase, read_extra_payload, serialize_extra_payload,
-                      to_varbytes)
+                      to_compact_size, to_varbytes, tx_header_to_tx_type)
 from .logging import get_logger
 
 
@@ -81,6 +82,12 @@ class TxOutputForUI(NamedTuple):
     value: int
 
 
+class TxSummary(NamedTuple):
+    tx_type: int
+    inputs: Tuple[Tuple[str, int], ...]  # (prevout_hash, prevout_n)
+    outputs: Tuple[TxOutput, ...]
+
+
 class TxOutputHwInfo(NamedTuple):
     address_index: Tuple
     sorted_xpubs: Iterable[str]
@@ -108,7 +115,7 @@ class BCDataStream(object):
         if self.input is None:
             self.input = bytearray(_bytes)
         else:
-            self.input += bytearray(_bytes)
+            self.input += _bytes
 
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
@@ -479,7 +486,7 @@ def deserialize(raw: str, force_full_parse=False) -> dict:
         d['partial'] = is_partial = False
     full_parse = force_full_parse or is_partial
     vds = BCDataStream()
-    vds.write(raw_bytes)
+    vds.clear_and_set_bytes(raw_bytes)
     return read_vds(vds, d, full_parse, alone_data=True)
 
 
@@ -512,6 +519,29 @@ def read_vds(vds, d, full_parse, alone_data=False):
     return d
 
 
+def read_tx_summary(raw: str) -> TxSummary:
+    """Read tx type, spent outpoints and outputs from raw tx,
+    skipping input scripts and extra payload parsing."""
+    raw_bytes = bfh(raw)
+    if raw_bytes[:5] == PARTIAL_TXN_HEADER_MAGIC:
+        raw_bytes = raw_bytes[6:]
+    vds = BCDataStream()
+    vds.clear_and_set_bytes(raw_bytes)
+    tx_type = tx_header_to_tx_type(vds.read_bytes(4))
+    inputs = []
+    for i in range(vds.read_compact_size()):
+        prevout_hash = hash_encode(vds.read_bytes(32))
+        prevout_n = vds.read_uint32()
+        vds.read_bytes(vds.read_compact_size())  # scriptSig
+        vds.read_uint32()  # sequence
+        inputs.append((prevout_hash, prevout_n))
+    outputs = []
+    for i in range(vds.read_compact_size()):
+        o = parse_output(vds, i)
+        outputs.append(TxOutput(o['type'], o['address'], o['value']))
+    return TxSummary(tx_type, tuple(inputs), tuple(outputs))
+
+
 # pay & redeem scripts
 
 def multisig_script(public_keys: Sequence[str], m: int) -> str:
@@ -592,12 +622,13 @@ class Transaction:
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        preimage_parts = self._serialize_preimage_parts()
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sig = signatures[i]
             if sig in txin.get('signatures'):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            pre_hash = self._preimage_hash(i, preimage_parts)
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
@@ -830,7 +861,12 @@ class Transaction:
 
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return bh2u(self.serialize_outpoint_bytes(txin))
+
+    @classmethod
+    def serialize_outpoint_bytes(self, txin) -> bytes:
+        return (bfh(txin['prevout_hash'])[::-1] +
+                struct.pack('<I', txin['prevout_n']))
 
     @classmethod
     def get_outpoint_from_txin(cls, txin):
@@ -842,13 +878,15 @@ class Transaction:
 
     @classmethod
     def serialize_input(self, txin, script):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        return s
+        return bh2u(self.serialize_input_bytes(txin, bfh(script)))
+
+    @classmethod
+    def serialize_input_bytes(self, txin, script: bytes) -> bytes:
+        return (
+            self.serialize_outpoint_bytes(txin) +           # prev hash, index
+            to_varbytes(script) +                           # script
+            struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+        )
 
     def BIP69_sort(self, inputs=True, outputs=True):
         if inputs:
@@ -858,30 +896,65 @@ class Transaction:
 
     @classmethod
     def serialize_output(cls, output: TxOutput) -> str:
-        s = int_to_hex(output.value, 8)
-        script = cls.pay_script(output.type, output.address)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        return bh2u(cls.serialize_output_bytes(output))
+
+    @classmethod
+    def serialize_output_bytes(cls, output: TxOutput) -> bytes:
+        value = output.value
+        if not isinstance(value, int):
+            raise TypeError('{} instead of int'.format(value))
+        script = bfh(cls.pay_script(output.type, output.address))
+        return struct.pack('<q', value) + to_varbytes(script)
+
+    def _serialize_header_bytes(self) -> bytes:
+        if self.tx_type:
+            return struct.pack('<HH', self.version, self.tx_type)
+        else:
+            return struct.pack('<I', self.version)
 
     def serialize_preimage(self, txin_index: int) -> str:
-        nHashType = int_to_hex(1, 4)  # SIGHASH_ALL
-        nLocktime = int_to_hex(self.locktime, 4)
+        parts = self._serialize_preimage_parts()
+        return bh2u(b''.join(self._preimage_chunks(txin_index, parts)))
+
+    def _serialize_preimage_parts(self):
+        """Serialize the preimage parts shared by all inputs.
+
+        The SIGHASH_ALL preimage of input i only differs from the others
+        by the script of input i, so everything else is serialized once
+        and reused for every input being signed.
+        """
         inputs = self.inputs()
         outputs = self.outputs()
-        txin = inputs[txin_index]
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if txin_index==k else '')
-                                               for k, txin in enumerate(inputs))
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
+        prefix = self._serialize_header_bytes() + to_compact_size(len(inputs))
+        offsets = [0]
+        txins = []
+        for txin in inputs:
+            txins.append(self.serialize_input_bytes(txin, b''))
+            offsets.append(offsets[-1] + len(txins[-1]))
+        suffix = bytearray(to_compact_size(len(outputs)))
+        for o in outputs:
+            suffix += self.serialize_output_bytes(o)
+        suffix += struct.pack('<I', self.locktime)
         if self.tx_type:
-            uVersion = int_to_hex(self.version, 2)
-            uTxType = int_to_hex(self.tx_type, 2)
-            vExtra = bh2u(to_varbytes(serialize_extra_payload(self)))
-            preimage = uVersion + uTxType + txins + txouts + nLocktime + vExtra + nHashType
-        else:
-            nVersion = int_to_hex(self.version, 4)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-        return preimage
+            suffix += to_varbytes(serialize_extra_payload(self))
+        suffix += struct.pack('<I', 1)  # SIGHASH_ALL
+        return prefix, memoryview(b''.join(txins)), offsets, bytes(suffix)
+
+    def _preimage_chunks(self, txin_index, parts):
+        prefix, txins, offsets, suffix = parts
+        txin = self.inputs()[txin_index]
+        script = bfh(self.get_preimage_script(txin))
+        return (prefix,
+                txins[:offsets[txin_index]],
+                self.serialize_input_bytes(txin, script),
+                txins[offsets[txin_index+1]:],
+                suffix)
+
+    def _preimage_hash(self, txin_index, parts) -> bytes:
+        h = hashlib.sha256()
+        for chunk in self._preimage_chunks(txin_index, parts):
+            h.update(chunk)
+        return hashlib.sha256(h.digest()).digest()
 
     def serialize(self, estimate_size=False):
         network_ser = self.serialize_to_network(estimate_size)
@@ -894,27 +967,31 @@ class Transaction:
             return network_ser
 
     def serialize_to_network(self, estimate_size=False):
+        return bh2u(self.serialize_to_network_bytes(estimate_size))
+
+    def serialize_to_network_bytes(self, estimate_size=False) -> bytes:
         self.deserialize()
-        nLocktime = int_to_hex(self.locktime, 4)
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
+        ser = bytearray(self._serialize_header_bytes())
+        ser += to_compact_size(len(inputs))
+        for txin in inputs:
+            script = bfh(self.input_script(txin, estimate_size))
+            ser += self.serialize_input_bytes(txin, script)
+        ser += to_compact_size(len(outputs))
+        for o in outputs:
+            ser += self.serialize_output_bytes(o)
+        ser += struct.pack('<I', self.locktime)
         if self.tx_type:
-            uVersion = int_to_hex(self.version, 2)
-            uTxType = int_to_hex(self.tx_type, 2)
-            vExtra = bh2u(to_varbytes(serialize_extra_payload(self)))
-            return uVersion + uTxType + txins + txouts + nLocktime + vExtra
-        else:
-            nVersion = int_to_hex(self.version, 4)
-            return nVersion + txins + txouts + nLocktime
+            ser += to_varbytes(serialize_extra_payload(self))
+        return bytes(ser)
 
     def txid(self):
         self.deserialize()
         if not self.is_complete():
             return None
-        ser = self.serialize_to_network()
-        return bh2u(sha256d(bfh(ser))[::-1])
+        ser = self.serialize_to_network_bytes()
+        return bh2u(sha256d(ser)[::-1])
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
@@ -952,7 +1029,7 @@ class Transaction:
     def estimated_input_weight(cls, txin):
         '''Return an estimate of serialized input weight in weight units.'''
         script = cls.input_script(txin, True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        input_size = len(cls.serialize_input_bytes(txin, bfh(script)))
         return 4 * input_size
 
     @classmethod
@@ -998,6 +1075,8 @@ class Transaction:
     def sign(self, keypairs) -> int:
         # keypairs:  (x_)pubkey -> secret_bytes
         signed_txins_cnt = 0
+        preimage_parts = None
+        privkeys = {}
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
@@ -1011,7 +1090,12 @@ class Transaction:
                     continue
                 _logger.info(f"adding signature for {_pubkey}")
                 sec, compressed = keypairs.get(_pubkey)
-                sig = self.sign_txin(i, sec)
+                if preimage_parts is None:
+                    preimage_parts = self._serialize_preimage_parts()
+                privkey = privkeys.get(sec)
+                if privkey is None:
+                    privkey = privkeys[sec] = ecc.ECPrivkey(sec)
+                sig = self._sign_txin(i, privkey, preimage_parts)
                 self.add_signature_to_txin(i, j, sig)
                 signed_txins_cnt += 1
 
@@ -1020,8 +1104,12 @@ class Transaction:
         return signed_txins_cnt
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index)))
         privkey = ecc.ECPrivkey(privkey_bytes)
+        return self._sign_txin(txin_index, privkey,
+                               self._serialize_preimage_parts())
+
+    def _sign_txin(self, txin_index, privkey, preimage_parts) -> str:
+        pre_hash = self._preimage_hash(txin_index, preimage_parts)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'
         return sig
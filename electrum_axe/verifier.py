@@ -22,15 +22,18 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from collections import defaultdict
+from typing import Sequence, Optional, List, Tuple, TYPE_CHECKING
 
 import aiorpcx
 
-from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
+from .util import TxMinedInfo, NetworkJobOnDefaultServer
 from .crypto import sha256d
-from .bitcoin import hash_decode, hash_encode
-from .transaction import Transaction
+from .bitcoin import (hash_decode, hash_encode, COIN,
+                      TOTAL_COIN_SUPPLY_LIMIT_IN_BTC)
+from .axe_tx import SPEC_TX_HANDLERS
 from .blockchain import hash_header
+from .constants import CHUNK_SIZE
 from .interface import GracefulDisconnect
 from .network import UntrustedServerReturnedError
 from . import constants
@@ -46,36 +49,61 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+SPV_BATCH_SIZE = 100  # merkle requests in one JSON-RPC batch
+SPV_MAX_INFLIGHT_BATCHES = 4  # batches awaiting server response
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
+        network.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.requested_chunks = set()  # headers chunk indexes requested
+        self.inflight_batches = asyncio.Semaphore(SPV_MAX_INFLIGHT_BATCHES)
+        self.wakeup_event = asyncio.Event()
+        self.wakeup_event.set()  # look for unverified txs on start
 
     async def _start_tasks(self):
         async with self.group as group:
             await group.spawn(self.main)
 
+    async def stop(self):
+        self.network.unregister_callback(self.on_blockchain_updated)
+        await super().stop()
+
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    def _wake_up(self):
+        self.wakeup_event.set()
+
+    def wake_up(self):
+        """Schedule check of unverified txs. Can be called from any thread."""
+        self.network.asyncio_loop.call_soon_threadsafe(self._wake_up)
+
+    def on_blockchain_updated(self, event, *args):
+        self._wake_up()
+
     async def main(self):
         self.blockchain = self.network.blockchain()
         while True:
+            await self.wakeup_event.wait()
+            self.wakeup_event.clear()
             await self._maybe_undo_verifications()
             await self._request_proofs()
-            await asyncio.sleep(0.1)
 
     async def _request_proofs(self):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
 
+        txs_by_height = defaultdict(list)
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -83,62 +111,97 @@ class SPV(NetworkJobOnDefaultServer):
             # or before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            txs_by_height[tx_height].append(tx_hash)
+
+        to_request = []
+        for tx_height, tx_hashes in sorted(txs_by_height.items()):
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
                 if tx_height < constants.net.max_checkpoint():
-                    await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                    chunk_idx = tx_height // CHUNK_SIZE
+                    if chunk_idx not in self.requested_chunks:
+                        self.requested_chunks.add(chunk_idx)
+                        await self.group.spawn(self._request_chunk, tx_height)
                 continue
-            # request now
-            self.logger.info(f'requested merkle {tx_hash}')
-            self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            for tx_hash in tx_hashes:
+                self.requested_merkle.add(tx_hash)
+                to_request.append((tx_hash, tx_height))
+
+        # request now
+        for i in range(0, len(to_request), SPV_BATCH_SIZE):
+            batch = to_request[i:i+SPV_BATCH_SIZE]
+            await self.inflight_batches.acquire()
+            self.logger.info(f'requested merkle for {len(batch)} txs')
+            await self.group.spawn(self._request_and_verify_proofs, batch)
+
+    async def _request_chunk(self, height):
+        try:
+            await self.network.request_chunk(height, None, can_return_early=True)
+        finally:
+            self.requested_chunks.discard(height // CHUNK_SIZE)
+        self._wake_up()
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
+    async def _request_and_verify_proofs(self, batch: List[Tuple[str, int]]):
         try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
+            merkles = await self.network.get_merkles_for_transactions(batch)
+        finally:
+            self.inflight_batches.release()
+        txs_by_height = defaultdict(list)
+        for (tx_hash, tx_height), merkle in zip(batch, merkles):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            if tx_height != merkle.get('block_height'):
+                self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, merkle.get('block_height'), tx_hash))
+            txs_by_height[merkle.get('block_height')].append((tx_hash, merkle))
         # we need to wait if header sync/reorg is still ongoing, hence lock:
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
-            else:
-                self.logger.info(str(e))
-                raise GracefulDisconnect(e)
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        self.requested_merkle.discard(tx_hash)
-        self.logger.info(f"verified {tx_hash}")
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
-        #if self.is_up_to_date() and self.wallet.is_up_to_date():
-        #    self.wallet.save_verified_tx(write=True)
+            blockchain = self.network.blockchain()
+            headers = {tx_height: blockchain.read_header(tx_height)
+                       for tx_height in txs_by_height}
+        for tx_height, txs in txs_by_height.items():
+            header = headers[tx_height]
+            block_verifier = BlockMerkleVerifier(header, tx_height)
+            for tx_hash, merkle in txs:
+                pos = merkle.get('pos')
+                try:
+                    block_verifier.verify(tx_hash, merkle.get('merkle'), pos)
+                except MerkleVerificationFailure as e:
+                    if self.network.config.get("skipmerklecheck"):
+                        self.logger.info(f"skipping merkle proof check {tx_hash}")
+                    else:
+                        self.logger.info(str(e))
+                        raise GracefulDisconnect(e)
+                # we passed all the tests
+                self.merkle_roots[tx_hash] = header.get('merkle_root')
+                self.requested_merkle.discard(tx_hash)
+                self.logger.info(f"verified {tx_hash}")
+                tx_info = TxMinedInfo(height=tx_height,
+                                      timestamp=header.get('timestamp'),
+                                      txpos=pos,
+                                      header_hash=block_verifier.header_hash)
+                self.wallet.add_verified_tx(tx_hash, tx_info)
 
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
         """Return calculated merkle root."""
+        path = cls.hash_merkle_path(merkle_branch, tx_hash, leaf_pos_in_tree)
+        return hash_encode(path[-1][1])
+
+    @classmethod
+    def hash_merkle_path(cls, merkle_branch: Sequence[str], tx_hash: str,
+                         leaf_pos_in_tree: int, known_nodes: dict = None):
+        """Return list of ((level, index), node hash) of nodes and their
+        siblings from the leaf up to the merkle root, or up to the first node
+        found in known_nodes. Last item is the merkle root or the found node."""
         try:
             h = hash_decode(tx_hash)
             merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
@@ -148,29 +211,30 @@ class SPV(NetworkJobOnDefaultServer):
         if leaf_pos_in_tree < 0:
             raise MerkleVerificationFailure('leaf_pos_in_tree must be non-negative')
         index = leaf_pos_in_tree
-        for item in merkle_branch_bytes:
+        path = []
+        for level, item in enumerate(merkle_branch_bytes):
+            path.append(((level, index), h))
+            if known_nodes and (level, index) in known_nodes:
+                return path
             if len(item) != 32:
                 raise MerkleVerificationFailure('all merkle branch items have to 32 bytes long')
+            path.append(((level, index ^ 1), item))
             inner_node = (item + h) if (index & 1) else (h + item)
-            cls._raise_if_valid_tx(bh2u(inner_node))
+            cls._raise_if_valid_tx(inner_node)
             h = sha256d(inner_node)
             index >>= 1
         if index != 0:
             raise MerkleVerificationFailure(f'leaf_pos_in_tree too large for branch')
-        return hash_encode(h)
+        path.append(((len(merkle_branch_bytes), 0), h))
+        return path
 
     @classmethod
-    def _raise_if_valid_tx(cls, raw_tx: str):
+    def _raise_if_valid_tx(cls, raw_tx: bytes):
         # If an inner node of the merkle proof is also a valid tx, chances are, this is an attack.
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/2018-June/016105.html
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/attachments/20180609/9f4f5b1f/attachment-0001.pdf
         # https://bitcoin.stackexchange.com/questions/76121/how-is-the-leaf-node-weakness-in-merkle-trees-exploitable/76122#76122
-        tx = Transaction(raw_tx)
-        try:
-            tx.deserialize()
-        except:
-            pass
-        else:
+        if is_tx_structure(raw_tx):
             raise InnerNodeOfSpvProofIsValidTx()
 
     async def _maybe_undo_verifications(self):
@@ -197,12 +261,93 @@ def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
                           leaf_pos_in_tree: int, block_header: Optional[dict],
                           block_height: int) -> None:
     """Raise MerkleVerificationFailure if verification fails."""
-    if not block_header:
-        raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
-                                 .format(tx_hash, block_height))
-    if len(merkle_branch) > 30:
-        raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
-    calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree)
-    if block_header.get('merkle_root') != calc_merkle_root:
-        raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
-            tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+    BlockMerkleVerifier(block_header, block_height).verify(tx_hash, merkle_branch,
+                                                           leaf_pos_in_tree)
+
+
+class BlockMerkleVerifier:
+    """Verifies merkle branches of txs in the same block. Nodes of verified
+    branches are remembered, so hashing of the next branch stops on the first
+    node shared with them."""
+
+    def __init__(self, block_header: Optional[dict], block_height: int):
+        self.block_header = block_header
+        self.block_height = block_height
+        self.known_nodes = {}  # (level, index) -> node hash leading to merkle root
+        self._header_hash = None
+
+    @property
+    def header_hash(self) -> str:
+        if self._header_hash is None:
+            self._header_hash = hash_header(self.block_header)
+        return self._header_hash
+
+    def verify(self, tx_hash: str, merkle_branch: Sequence[str],
+               leaf_pos_in_tree: int) -> None:
+        """Raise MerkleVerificationFailure if verification fails."""
+        block_header = self.block_header
+        if not block_header:
+            raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
+                                     .format(tx_hash, self.block_height))
+        if len(merkle_branch) > 30:
+            raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
+        path = SPV.hash_merkle_path(merkle_branch, tx_hash, leaf_pos_in_tree,
+                                    self.known_nodes)
+        node, h = path[-1]
+        known_hash = self.known_nodes.get(node)
+        if known_hash is None:
+            calc_merkle_root = hash_encode(h)
+            if block_header.get('merkle_root') != calc_merkle_root:
+                raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
+                    tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+        elif known_hash != h:
+            raise MerkleRootMismatch("merkle verification failed for {} (node {} differs)"
+                                     .format(tx_hash, node))
+        self.known_nodes.update(path)
+
+
+def is_tx_structure(raw: bytes) -> bool:
+    """Cheap check if raw bytes can be deserialized as a transaction,
+    without building Transaction (extra payload content is not checked)."""
+    size = len(raw)
+
+    def read_compact_size(pos):
+        n = raw[pos]
+        if n < 253:
+            return n, pos + 1
+        width = 2 if n == 253 else 4 if n == 254 else 8
+        if pos + 1 + width > size:
+            raise IndexError()
+        return int.from_bytes(raw[pos+1:pos+1+width], 'little'), pos + 1 + width
+
+    try:
+        header = int.from_bytes(raw[:4], 'little')
+        tx_type = header >> 16  # DIP2 tx type
+        if tx_type and header & 0xffff < 3:
+            tx_type = 0
+        n_vin, pos = read_compact_size(4)
+        for i in range(n_vin):
+            script_len, pos = read_compact_size(pos + 36)  # prevout
+            pos += script_len + 4  # scriptSig, sequence
+            if pos > size:
+                return False
+        n_vout, pos = read_compact_size(pos)
+        for i in range(n_vout):
+            if pos + 8 > size:
+                return False
+            value = int.from_bytes(raw[pos:pos+8], 'little', signed=True)
+            if not 0 <= value <= TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
+                return False
+            script_len, pos = read_compact_size(pos + 8)
+            pos += script_len
+            if pos > size:
+                return False
+        pos += 4  # lockTime
+        if tx_type:
+            if tx_type not in SPEC_TX_HANDLERS:
+                return False
+            payload_len, pos = read_compact_size(pos)
+            pos += payload_len
+        return pos == size
+    except IndexError:
+        return False
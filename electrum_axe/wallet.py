@@ -51,7 +51,7 @@ from .bitcoin import (COIN, TYPE_ADDRESS, is_address, address_to_script,
 from .crypto import sha256d
 from . import keystore
 from .axe_tx import SPEC_TX_NAMES, PSCoinRounds
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, Xpub
 from .util import multisig_type
 from .storage import STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW, WalletStorage
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
@@ -214,8 +214,8 @@ class Abstract_Wallet(AddressSynchronizer):
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
         self.labels                = storage.get('labels', {})
-        self.frozen_addresses      = set(storage.get('frozen_addresses', []))
-        self.frozen_coins          = set(storage.get('frozen_coins', []))  # set of txid:vout strings
+        self.frozen_addresses      = set(storage.get_view('frozen_addresses', []))
+        self.frozen_coins          = set(storage.get_view('frozen_coins', []))  # set of txid:vout strings
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
 
@@ -236,7 +236,7 @@ class Abstract_Wallet(AddressSynchronizer):
 
     def stop_threads(self):
         super().stop_threads()
-        self.storage.write()
+        self.storage.compact()
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -307,11 +307,15 @@ class Abstract_Wallet(AddressSynchronizer):
                 changed = True
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
+            with self.storage.checkout('labels', {}) as labels:
+                if text:
+                    labels[name] = text
+                else:
+                    labels.pop(name, None)
         return changed
 
     def set_fiat_value(self, txid, ccy, text, fx, value_sat):
-        if not self.db.get_transaction(txid):
+        if not self.db.has_transaction(txid):
             return
         # since fx is inserting the thousands separator,
         # and not util, also have fx remove it
@@ -405,7 +409,7 @@ class Abstract_Wallet(AddressSynchronizer):
         islock = self.db.get_islock(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         if tx.is_complete():
-            if self.db.get_transaction(tx_hash):
+            if self.db.has_transaction(tx_hash):
                 label = self.get_label(tx_hash)
                 conf = tx_mined_status.conf
                 if tx_mined_status.height > 0:
@@ -1775,8 +1779,15 @@ class Deterministic_Wallet(Abstract_Wallet):
                 self._unused_change_addresses.append(address)
             return address
 
+    def prederive_pubkeys(self, for_change, n, count):
+        '''Batch derive pubkeys to keystores cache before addresses creation'''
+        for k in self.get_keystores():
+            if isinstance(k, Xpub):
+                k.derive_pubkeys(for_change, range(n, n + count))
+
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        prederived = False
         while True:
             if for_change:
                 addrs = self.get_change_addresses()
@@ -1784,6 +1795,10 @@ class Deterministic_Wallet(Abstract_Wallet):
                 addrs = self.get_receiving_addresses()
             num_addrs = len(addrs)
             if num_addrs < limit:
+                if not prederived:
+                    self.prederive_pubkeys(for_change, num_addrs,
+                                           limit - num_addrs)
+                    prederived = True
                 self.create_new_address(for_change)
                 continue
             last_few_addresses = addrs[-limit:]